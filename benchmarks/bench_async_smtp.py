@@ -0,0 +1,95 @@
+# The asyncio SMTP client against the local asyncio SMTP sink: sends the
+# same campaign through the threaded engine and through the asyncio engine
+# with many more sessions, against a sink that takes --latency seconds to
+# acknowledge each message. The protocol itself is covered by
+# tests/test_async_smtp.py.
+#
+#   python benchmarks/bench_async_smtp.py --recipients 5000 --threads 15 --sessions 300 --latency 0.2
+import argparse
+import asyncio
+import io
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from kuki_mail.campaign import compile_bulk_plan, send_bulk_emails, send_bulk_emails_async
+from kuki_mail.rate_limiter import RateLimiter
+from kuki_mail.recipients import RecipientSource
+from kuki_mail.transports import SinkTransport
+
+SENDER = "bench@example.com"
+SUBJECT = "Hello {name}, our spring update"
+CONTENT = "<p>Hi {name},</p><p>Here is what we shipped this month.</p><ul><li>Async sends</li></ul>" * 3
+
+
+def make_csv(count, refused=0):
+    lines = ["name,email"]
+    lines.extend(f"Person {i},person{i}@example.com" for i in range(count - refused))
+    lines.extend(f"Gone {i},refuse{i}@example.com" for i in range(refused))
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def expect(condition, label):
+    print(f"  {'ok' if condition else 'FAIL':<4} {label}")
+    return bool(condition)
+
+
+def send_threaded(transport, recipients, threads):
+    pool = transport.pool(SENDER, "unused", size=threads)
+    return send_bulk_emails(recipients, SENDER, "unused", SUBJECT, CONTENT, [], pool=pool, concurrency=threads,
+                            limiter=RateLimiter(per_second=None))
+
+
+def send_async(transport, recipients, sessions):
+    async def run():
+        async with transport.async_pool(SENDER, "unused", size=sessions) as pool:
+            return await send_bulk_emails_async(recipients, SENDER, "unused", SUBJECT, CONTENT, [], pool=pool,
+                                                concurrency=sessions, limiter=RateLimiter(per_second=None))
+    return asyncio.run(run())
+
+
+def measure(label, send, transport, csv, connections, refused):
+    sink = transport.sink
+    before = sink.stats.as_dict()
+    recipients = RecipientSource(io.BytesIO(csv), "bench.csv")
+    started = time.perf_counter()
+    sent = send(transport, recipients, connections)
+    elapsed = time.perf_counter() - started
+    delivered = sink.stats.messages - before['messages']
+    print(f"{label:<8} {connections:>4} connections  {sent:>7,} sent in {elapsed:6.2f}s  ->  "
+          f"{sent / elapsed:>8,.0f} messages/sec  (sink: {delivered:,} delivered, "
+          f"{sink.stats.connections - before['connections']} connections)")
+    return sent / elapsed, sent == delivered == len(recipients) - refused
+
+
+def main():
+    parser = argparse.ArgumentParser(description="asyncio SMTP fan-out throughput")
+    parser.add_argument("--recipients", type=int, default=3000)
+    parser.add_argument("--refused", type=int, default=10, help="recipients the sink refuses with a 550")
+    parser.add_argument("--threads", type=int, default=15, help="connections of the threaded engine")
+    parser.add_argument("--sessions", type=int, default=300, help="connections of the asyncio engine")
+    parser.add_argument("--latency", type=float, default=0.2, help="sink delay before acknowledging DATA")
+    args = parser.parse_args()
+
+    plan = compile_bulk_plan(SUBJECT, CONTENT)
+    assert plan.is_personalized
+    csv = make_csv(args.recipients, args.refused)
+    transport = SinkTransport(latency=args.latency)
+    transport.start()
+    print(f"{args.recipients:,} personalized messages ({args.refused} refused), "
+          f"sink latency {args.latency * 1000:.0f} ms")
+    try:
+        threaded_rate, threaded_ok = measure("threads", send_threaded, transport, csv, args.threads, args.refused)
+        async_rate, async_ok = measure("asyncio", send_async, transport, csv, args.sessions, args.refused)
+    finally:
+        transport.close()
+    ok = expect(threaded_ok and async_ok, "every accepted recipient delivered once, refusals not counted")
+    print(f"speedup: {async_rate / threaded_rate:.1f}x")
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# Messages per second when recipients repeat their template values: every row
+# rendered and built on its own against one render per distinct tuple of
+# values (MessageVariants), on a list with common first names and mostly
+# blank starting lines.
+#
+#   python benchmarks/bench_dedup.py --rows 100000 --names 300 --blank 0.8
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from kuki_mail.campaign import compile_rich_plan
+from kuki_mail.layouts import RICH_BULK_LAYOUT
+from kuki_mail.mime_builder import MessageBuilder
+from kuki_mail.recipients import Recipient
+from kuki_mail.render_cache import MessageVariants
+
+SENDER = "bench@example.com"
+SUBJECT = "Quick question for {{ name }}"
+GREETING = "Hi {{ name }},"
+BODY = (
+    "<p>{{ starting_line }}</p><p>We are launching something new and thought of you, "
+    "{{ name }}.</p><ul><li>Faster</li><li>Cheaper</li></ul><p>Cheers</p>"
+) * 4
+COLUMNS = {"name": 0, "email": 1, "starting_line": 2}
+
+
+def make_rows(count, names, blank, seed=1):
+    rng = random.Random(seed)
+    first_names = [f"Name{i}" for i in range(names)]
+    rows = []
+    for i in range(count):
+        line = "" if rng.random() < blank else f"Loved your post #{i}."
+        rows.append(Recipient(i, (rng.choice(first_names), f"user{i}@example.com", line), COLUMNS))
+    return rows
+
+
+def build_each(plan, rows):
+    builder = MessageBuilder(SENDER)
+    for row in rows:
+        rendered = plan.render({name: row.get(name) for name in plan.variables})
+        builder.build(row.email, rendered.subject, rendered.html, rendered.text)
+    return len(rows)
+
+
+def build_variants(plan, rows):
+    variants = MessageVariants(plan, MessageBuilder(SENDER), plan.variables & set(COLUMNS))
+    for row in rows:
+        variants.message(row)
+    return variants
+
+
+def measure(label, build, plan, rows):
+    started = time.perf_counter()
+    result = build(plan, rows)
+    elapsed = time.perf_counter() - started
+    print(f"{label:<12} {len(rows):>8} messages in {elapsed:7.2f}s  ->  {len(rows) / elapsed:>10,.0f} messages/sec")
+    return len(rows) / elapsed, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Message throughput with repeated template values")
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--names", type=int, default=300, help="distinct first names")
+    parser.add_argument("--blank", type=float, default=0.8, help="share of rows without a starting_line")
+    args = parser.parse_args()
+
+    plan = compile_rich_plan(SUBJECT, GREETING, BODY, RICH_BULK_LAYOUT)
+    rows = make_rows(args.rows, args.names, args.blank)
+    each_rate, _ = measure("per row", build_each, plan, rows)
+    variant_rate, variants = measure("variants", build_variants, plan, rows)
+    print(f"distinct: {variants.rendered} of {variants.messages} ({variants.ratio:.1%})")
+    print(f"speedup: {variant_rate / each_rate:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# Peak memory and time per message: MIMEMultipart + as_string() (the old
+# path, including the bytes copy smtplib makes) against MessageBuilder
+# segments written straight to a socket.
+#
+#   python benchmarks/bench_mime.py --attachment-mb 5 --messages 20
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from email import encoders
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from kuki_mail.attachments import AttachmentCache
+from kuki_mail.mime_builder import MessageBuilder
+
+HTML = "<p>Hello there, this is the campaign body.</p>" * 40
+TEXT = "Hello there, this is the campaign body.\n" * 40
+
+
+class NullSocket:
+    # Stands in for the SMTP socket, counts what would go over the wire
+    def __init__(self):
+        self.bytes_sent = 0
+
+    def sendall(self, data):
+        self.bytes_sent += len(data)
+
+
+def legacy_message(to_addr, data):
+    msg = MIMEMultipart('alternative')
+    msg["From"] = "me@example.com"
+    msg["To"] = to_addr
+    msg["Subject"] = "Benchmark"
+    msg.attach(MIMEText(TEXT, 'plain'))
+    msg.attach(MIMEText(HTML, 'html'))
+    part = MIMEBase("application", "octet-stream")
+    part.set_payload(data)
+    encoders.encode_base64(part)
+    part.add_header("Content-Disposition", 'attachment; filename="file.bin"')
+    msg.attach(part)
+    # smtplib.sendmail encodes the str to bytes again before writing it
+    return msg.as_string().encode('ascii')
+
+
+def run(label, send_one, messages):
+    tracemalloc.start()
+    peaks = []
+    started = time.perf_counter()
+    for i in range(messages):
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        send_one(f"user{i}@example.com")
+        peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+    elapsed = time.perf_counter() - started
+    tracemalloc.stop()
+    peak = max(peaks) / (1024 * 1024)
+    print(f"{label:<16} {elapsed / messages * 1000:8.2f} ms/msg   peak {peak:8.2f} MB/msg")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MIME build/serialize memory per message")
+    parser.add_argument("--attachment-mb", type=float, default=5)
+    parser.add_argument("--messages", type=int, default=20)
+    args = parser.parse_args()
+
+    data = os.urandom(int(args.attachment_mb * 1024 * 1024))
+    sock = NullSocket()
+
+    def send_legacy(to_addr):
+        sock.sendall(legacy_message(to_addr, data))
+
+    builder = MessageBuilder("me@example.com", [AttachmentCache().get(data, "file.bin")])
+
+    def send_streaming(to_addr):
+        for segment in builder.build(to_addr, "Benchmark", HTML, TEXT).segments:
+            sock.sendall(segment)
+
+    print(f"attachment: {args.attachment_mb} MB, {args.messages} messages")
+    run("as_string()", send_legacy, args.messages)
+    run("wire segments", send_streaming, args.messages)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# HTML normalization: checks normalize_html against the golden corpus (the
+# output of the old regex clean_content, the raw Quill HTML the rich UI used
+# to send, and Quill classes inlined and unsafe markup removed), then times
+# one normalization per document against the old replace/re.sub passes, and
+# what that costs per message of a campaign.
+#
+#   python benchmarks/bench_normalize.py --documents 20000 --recipients 100000
+import argparse
+import json
+import re
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from kuki_mail.html_normalizer import normalize_html
+
+GOLDEN_FILE = Path(__file__).resolve().parent / "html_golden.json"
+QUILL_BODY = (
+    "<p>{{ starting_line }}</p><p>We are launching something new and thought of you, "
+    "{{ name }}.</p><p><br></p><p><br></p><ul><li>Faster</li><li>Cheaper</li></ul><p>Cheers</p>"
+) * 4
+
+
+def clean_content_legacy(content):
+    # The regex version normalize_html replaced, as it was in campaign.py
+    content = content.replace('</p><p>', '<br>')
+    content = content.replace('<p>', '').replace('</p>', '<br>')
+    content = re.sub(r'<br>\s*<br>', '<br>', content)
+    return content.strip()
+
+
+def check_golden():
+    cases = json.loads(GOLDEN_FILE.read_text(encoding="utf-8"))["cases"]
+    failures = 0
+    for case in cases:
+        simple = normalize_html.__wrapped__(case["input"], True).html
+        rich = normalize_html.__wrapped__(case["input"]).html
+        for label, got, expected in (("simple", simple, case["simple"]), ("rich", rich, case["rich"])):
+            if got != expected:
+                failures += 1
+                print(f"MISMATCH ({label}) {case['input']!r}\n  expected {expected!r}\n  got      {got!r}")
+    print(f"golden corpus: {len(cases)} cases, {failures} mismatches")
+    return failures == 0
+
+
+def measure(label, normalize, documents):
+    started = time.perf_counter()
+    for _ in range(documents):
+        normalize(QUILL_BODY)
+    elapsed = time.perf_counter() - started
+    print(f"{label:<12} {documents:>8} documents in {elapsed:7.2f}s  ->  {elapsed / documents * 1e6:8.1f} us/document")
+    return elapsed / documents
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HTML normalization correctness and cost")
+    parser.add_argument("--documents", type=int, default=20_000)
+    parser.add_argument("--recipients", type=int, default=100_000,
+                        help="campaign size the once-per-campaign cost is spread over")
+    args = parser.parse_args()
+
+    ok = check_golden()
+    # __wrapped__ skips the lru_cache, every call does the full pass
+    normalizer = measure("normalize", lambda html: normalize_html.__wrapped__(html, True), args.documents)
+    legacy = measure("legacy", clean_content_legacy, args.documents)
+    print(f"normalize vs legacy per document: {normalizer / legacy:.1f}x the time, "
+          "plus sanitizing, CSS inlining and the plain text version")
+    # The old simple sender cleaned every recipient's body, now it is done once
+    print(f"per message, once per campaign of {args.recipients:,}: {normalizer / args.recipients * 1e9:.1f} ns "
+          f"(legacy per recipient: {legacy * 1e9:,.0f} ns)")
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# Renders per second for a whole campaign: the old per-row Template()/replace
+# path against the precompiled RenderPlan.
+#
+#   python benchmarks/bench_render.py --rows 100000
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from jinja2 import Template
+
+from kuki_mail.layouts import RICH_BULK_LAYOUT
+from kuki_mail.templating import RenderPlan, compile_jinja, compile_layout, compile_placeholders
+
+SUBJECT = "Quick question for {{ name }}"
+GREETING = "Hi {{ name }},"
+BODY = (
+    "<p>{{ starting_line }}</p><p>We are launching something new and thought of you, "
+    "{{ name }}.</p><ul><li>Faster</li><li>Cheaper</li></ul><p>Cheers</p>"
+) * 4
+
+
+def make_rows(count):
+    return [{"name": f"Person {i}", "starting_line": f"Loved your post #{i}."} for i in range(count)]
+
+
+def render_legacy(rows):
+    # Mirrors the pre-RenderPlan loop in email_sender_res.py
+    for row in rows:
+        greeting = Template(GREETING).render(**row)
+        subject = Template(SUBJECT).render(**row)
+        content = BODY.replace("{{ starting_line }}", row["starting_line"]).replace("{{ name }}", row["name"])
+        html = RICH_BULK_LAYOUT.replace("{greeting}", greeting).replace("{content}", content)
+        text = f"{greeting}\n\n{row['starting_line']}\n"
+        yield subject, html, text
+
+
+def render_plan(rows):
+    greeting = compile_jinja(GREETING)
+    body = compile_placeholders(BODY, {"{{ starting_line }}": "starting_line", "{{ name }}": "name"})
+    plan = RenderPlan(
+        subject=compile_jinja(SUBJECT),
+        html=compile_layout(RICH_BULK_LAYOUT).embed(greeting=greeting, content=body),
+        text=compile_placeholders("{greeting}\n\n{starting_line}\n",
+                                  {"{greeting}": "greeting", "{starting_line}": "starting_line"}).embed(greeting=greeting),
+    )
+    for row in rows:
+        yield plan.render(row)
+
+
+def measure(label, render, rows):
+    started = time.perf_counter()
+    count = 0
+    for _ in render(rows):
+        count += 1
+    elapsed = time.perf_counter() - started
+    print(f"{label:<12} {count:>8} renders in {elapsed:7.2f}s  ->  {count / elapsed:>10,.0f} renders/sec")
+    return count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Template render throughput")
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--legacy-rows", type=int, default=None,
+                        help="rows for the slow legacy path (default: same as --rows)")
+    args = parser.parse_args()
+
+    plan_rate = measure("render plan", render_plan, make_rows(args.rows))
+    legacy_rate = measure("legacy", render_legacy, make_rows(args.legacy_rows or args.rows))
+    print(f"speedup: {plan_rate / legacy_rate:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+# Drives synthetic recipients through the whole send path (CSV parsing,
+# rendering, MIME building, the threaded engine, SMTP) against the local
+# sink, and reports throughput and per-message latency.
+#
+#   python benchmarks/load_test.py --recipients 100000 --concurrency 8
+#   python benchmarks/load_test.py --transport null        # everything but the socket
+#   python benchmarks/load_test.py --shared                # identical message, multi-RCPT envelopes
+import argparse
+import io
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from kuki_mail.attachments import attachment_cache
+from kuki_mail.campaign import compile_bulk_plan
+from kuki_mail.mime_builder import MessageBuilder, MAX_RECIPIENTS_PER_ENVELOPE, UNDISCLOSED_RECIPIENTS
+from kuki_mail.rate_limiter import RateLimiter
+from kuki_mail.recipients import RecipientSource
+from kuki_mail.render_cache import MessageVariants
+from kuki_mail.send_engine import SendEngine, batched
+from kuki_mail.transports import SinkTransport, NullTransport, MaildirTransport, transport_from_env
+
+SENDER = "loadtest@example.com"
+SUBJECT = "Hello {name}, our spring update"
+CONTENT = (
+    "<p>Hi {name},</p><p>Here is what we shipped this month. Thanks for being with us, {name}.</p>"
+    "<ul><li>Faster sends</li><li>Resumable campaigns</li><li>Background jobs</li></ul><p>Cheers</p>"
+) * 3
+
+
+def make_csv(count):
+    lines = ["name,email"]
+    lines.extend(f"Person {i},person{i}@example.com" for i in range(count))
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def make_transport(name, latency):
+    if name == "sink":
+        return SinkTransport(latency=latency)
+    if name == "null":
+        return NullTransport()
+    if name == "maildir":
+        return MaildirTransport()
+    # KUKI_MAIL_TRANSPORT and SMTP_* from the environment, e.g. an external sink
+    return transport_from_env()
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run(args):
+    transport = make_transport(args.transport, args.latency)
+    attachments = [io.BytesIO(b"x" * (args.attachment_kb * 1024))] if args.attachment_kb else []
+    encoded = [attachment_cache.get(file, "report.bin") for file in attachments]
+
+    recipients = RecipientSource(io.BytesIO(make_csv(args.recipients)), "load.csv")
+    subject = "Our spring update" if args.shared else SUBJECT
+    content = CONTENT.replace("{name}", "there") if args.shared else CONTENT
+    plan = compile_bulk_plan(subject, content)
+    builder = MessageBuilder(SENDER, encoded)
+    # What send_bulk_emails does: one render and encode per distinct tuple of values
+    variants = MessageVariants(plan, builder, plan.variables & set(recipients.columns))
+    pool = transport.pool(SENDER, "unused", size=args.concurrency)
+    limiter = RateLimiter(args.rate) if args.rate else None
+
+    # Seconds per send_one call (build + send), appended from the worker
+    # threads; list.append is atomic
+    latencies = []
+    clock = time.perf_counter
+
+    def send_one(session, recipient):
+        started = clock()
+        session.send_wire(SENDER, recipient.email, variants.message(recipient))
+        latencies.append(clock() - started)
+
+    if not plan.is_personalized:
+        rendered = plan.render({})
+        shared_message = builder.build(UNDISCLOSED_RECIPIENTS, rendered.subject, rendered.html)
+
+    def send_batch(session, batch):
+        started = clock()
+        refused = session.send_wire(SENDER, [recipient.email for recipient in batch], shared_message)
+        latencies.append(clock() - started)
+        return refused
+
+    engine = SendEngine(pool, args.concurrency, limiter=limiter)
+    started = clock()
+    try:
+        if plan.is_personalized:
+            stats = engine.run(iter(recipients), send_one)
+        else:
+            stats = engine.run(batched(iter(recipients), MAX_RECIPIENTS_PER_ENVELOPE), send_batch, weight=len)
+    finally:
+        pool.close()
+    elapsed = clock() - started
+
+    unit = "messages" if plan.is_personalized else "envelopes"
+    latencies.sort()
+    print(f"transport    {transport.describe()}")
+    print(f"recipients   {args.recipients:,}  concurrency {args.concurrency}  attachment {args.attachment_kb} KB")
+    print(f"{unit:<12} {stats.sent:,} ok, {stats.failed:,} failed in {elapsed:.2f}s")
+    print(f"throughput   {args.recipients / elapsed:,.0f} recipients/s, {stats.sent / elapsed:,.0f} {unit}/s")
+    print("latency ms   " + "  ".join(
+        f"{label} {percentile(latencies, fraction) * 1000:.2f}"
+        for label, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("p99.9", 0.999), ("max", 1.0))))
+    if isinstance(transport, SinkTransport):
+        print(f"sink         {transport.sink.stats.as_dict()}")
+    transport.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send-path load test against a local SMTP sink")
+    parser.add_argument("--recipients", type=int, default=100_000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--transport", choices=("sink", "null", "maildir", "env"), default="sink")
+    parser.add_argument("--attachment-kb", type=int, default=0)
+    parser.add_argument("--rate", type=float, default=0, help="per-second rate limit, 0 for none")
+    parser.add_argument("--latency", type=float, default=0.0, help="sink delay before acknowledging DATA")
+    parser.add_argument("--shared", action="store_true",
+                        help="non-personalized campaign, sent as multi-recipient envelopes")
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
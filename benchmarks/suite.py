@@ -0,0 +1,360 @@
+# Per-stage benchmarks of the render -> build -> send pipeline, across
+# recipient counts and attachment sizes, with throughput and peak RSS per
+# stage. Every case runs in a forked child so peaks don't leak between cases.
+#
+#   python benchmarks/suite.py                      # standard profile, compare to baseline.json
+#   python benchmarks/suite.py --profile full       # 1k/100k/1M x 0/1MB/10MB
+#   python benchmarks/suite.py --profile quick --save-baseline
+#
+# Exits with status 1 when a case is slower (or bigger) than the stored
+# baseline by more than --tolerance.
+import argparse
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+BASELINE_FILE = Path(__file__).resolve().parent / "baseline.json"
+
+MB = 1024 * 1024
+PROFILES = {
+    "quick": ((1_000, 20_000), (0, MB)),
+    "standard": ((1_000, 100_000), (0, MB, 10 * MB)),
+    "full": ((1_000, 100_000, 1_000_000), (0, MB, 10 * MB)),
+}
+# Sending for real is the slowest stage by far; it runs on a sample of the
+# list (and of the bytes), throughput is what gets compared anyway
+TRANSPORT_SAMPLE = 5_000
+TRANSPORT_SAMPLE_BYTES = 200 * MB
+DEFAULT_TOLERANCE = 0.25
+DEFAULT_REPEAT = 3
+# Peak RSS below this is noise (allocator arenas, import side effects)
+RSS_SLACK_MB = 16
+
+SENDER = "bench@example.com"
+SUBJECT = "Quick question for {{ name }}"
+GREETING = "Hi {{ name }},"
+QUILL_BODY = (
+    "<p>{{ starting_line }}</p><p>We are launching something new and thought of you, "
+    "{{ name }}.</p><p><br></p><p><br></p><ul><li>Faster</li><li>Cheaper</li></ul><p>Cheers</p>"
+) * 4
+
+
+def make_csv(count):
+    lines = ["name,email,starting_line"]
+    lines.extend(f"Person {i},person{i}@example.com,Loved your post #{i}." for i in range(count))
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def make_plan():
+    # The rich app's bulk plan, as email_sender_res.py compiles it
+    from kuki_mail.campaign import compile_rich_plan
+    from kuki_mail.layouts import RICH_BULK_LAYOUT
+    return compile_rich_plan(SUBJECT, GREETING, QUILL_BODY, RICH_BULK_LAYOUT)
+
+
+def make_rows(count):
+    return [{"name": f"Person {i}", "starting_line": f"Loved your post #{i}.", "email": f"person{i}@example.com"}
+            for i in range(count)]
+
+
+# Each stage is split in setup (untimed) and run (timed, returns items done)
+
+def stage_csv_load(count, attachment_size):
+    from kuki_mail.recipients import RecipientSource
+    data = make_csv(count)
+
+    def run():
+        return sum(1 for _ in RecipientSource(io.BytesIO(data), "bench.csv"))
+    return run
+
+
+def stage_validate(count, attachment_size):
+    from kuki_mail.recipients import RecipientSource
+    from kuki_mail.validation import validate_recipients
+    source = RecipientSource(io.BytesIO(make_csv(count)), "bench.csv")
+
+    def run():
+        # No DNS here, deliverability is a network benchmark
+        return validate_recipients(source, check_deliverability=False).checked
+    return run
+
+
+def stage_clean_content(count, attachment_size):
+    from kuki_mail.html_normalizer import normalize_html
+    # clean_content is cached, the stage times the full normalization pass
+    normalize = normalize_html.__wrapped__
+
+    def run():
+        # Once per campaign in the app; per document throughput here
+        for _ in range(count):
+            normalize(QUILL_BODY, True)
+        return count
+    return run
+
+
+def stage_render(count, attachment_size):
+    plan = make_plan()
+    rows = make_rows(count)
+
+    def run():
+        render = plan.render
+        for row in rows:
+            render(row)
+        return count
+    return run
+
+
+def _attachment(attachment_size):
+    return [io.BytesIO(os.urandom(attachment_size))] if attachment_size else []
+
+
+def stage_mime(count, attachment_size):
+    from kuki_mail.attachments import AttachmentCache
+    from kuki_mail.mime_builder import MessageBuilder
+    plan = make_plan()
+    rendered = plan.render(make_rows(1)[0])
+    files = _attachment(attachment_size)
+    emails = [row["email"] for row in make_rows(count)]
+
+    def run():
+        # A fresh cache so the one-off attachment encoding is part of the stage
+        builder = MessageBuilder(SENDER, [AttachmentCache().get(file, "report.bin") for file in files])
+        for email in emails:
+            builder.build(email, rendered.subject, rendered.html, rendered.text)
+        return count
+    return run
+
+
+class _NullSocket:
+    def __init__(self):
+        self.bytes = 0
+
+    def sendall(self, data):
+        self.bytes += len(data)
+
+
+class _NullServer:
+    # Just enough of smtplib.SMTP for send_wire_message with one recipient
+    # per message: every command succeeds, DATA gets its 354
+    def __init__(self):
+        self.sock = _NullSocket()
+        self._replies = itertools.cycle(((250, b"OK"), (250, b"OK"), (354, b"Go ahead"), (250, b"OK")))
+
+    def ehlo_or_helo_if_needed(self):
+        pass
+
+    def has_extn(self, name):
+        return name in ("size", "pipelining")
+
+    def send(self, data):
+        self.sock.sendall(data.encode("ascii"))
+
+    def putcmd(self, command):
+        self.sock.sendall(command.encode("ascii") + b"\r\n")
+
+    def getreply(self):
+        return next(self._replies)
+
+
+def stage_serialize(count, attachment_size):
+    from kuki_mail.attachments import AttachmentCache
+    from kuki_mail.mime_builder import MessageBuilder, send_wire_message
+    plan = make_plan()
+    rendered = plan.render(make_rows(1)[0])
+    builder = MessageBuilder(SENDER, [AttachmentCache().get(file, "report.bin") for file in _attachment(attachment_size)])
+    rows = make_rows(min(count, 1000))
+    messages = [(row["email"], builder.build(row["email"], rendered.subject, rendered.html, rendered.text))
+                for row in rows]
+    server = _NullServer()
+
+    def run():
+        # Envelope, DATA framing and coalesced socket writes, minus the network
+        for i in range(count):
+            email, message = messages[i % len(messages)]
+            send_wire_message(server, SENDER, email, message)
+        return count
+    return run
+
+
+def stage_transport(count, attachment_size):
+    from kuki_mail.attachments import AttachmentCache
+    from kuki_mail.mime_builder import MessageBuilder
+    from kuki_mail.send_engine import SendEngine
+    from kuki_mail.transports import SinkTransport
+    plan = make_plan()
+    rendered = plan.render(make_rows(1)[0])
+    builder = MessageBuilder(SENDER, [AttachmentCache().get(file, "report.bin") for file in _attachment(attachment_size)])
+    sample = min(count, TRANSPORT_SAMPLE, max(20, TRANSPORT_SAMPLE_BYTES // max(1, attachment_size)))
+    rows = make_rows(sample)
+    # The sink keeps no copies, its memory would count against the stage
+    transport = SinkTransport(keep=0)
+    pool = transport.pool(SENDER, "unused", size=4)
+
+    def send_one(session, row):
+        session.send_wire(SENDER, row["email"], builder.build(row["email"], rendered.subject, rendered.html, rendered.text))
+
+    def run():
+        try:
+            stats = SendEngine(pool, 4).run(iter(rows), send_one)
+        finally:
+            pool.close()
+            transport.close()
+        if stats.failed:
+            raise RuntimeError(f"{stats.failed} sends failed")
+        return stats.sent
+    return run
+
+
+STAGES = {
+    "csv_load": (stage_csv_load, False),
+    "validate": (stage_validate, False),
+    "clean_content": (stage_clean_content, False),
+    "render": (stage_render, False),
+    "mime": (stage_mime, True),
+    "serialize": (stage_serialize, True),
+    "transport": (stage_transport, True),
+}
+
+
+def _rss_mb(field):
+    # VmRSS / VmHWM from /proc, falls back to ru_maxrss (KB on Linux)
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _reset_peak_rss():
+    # Linux >= 4.0: writing 5 resets VmHWM to the current RSS
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _run_case(stage, count, attachment_size, results):
+    try:
+        run = STAGES[stage][0](count, attachment_size)
+        _reset_peak_rss()
+        before = _rss_mb("VmRSS")
+        started = time.perf_counter()
+        items = run()
+        elapsed = time.perf_counter() - started
+        results.put({"items": items, "seconds": elapsed, "peak_rss_mb": max(0.0, _rss_mb("VmHWM") - before)})
+    except Exception as e:
+        results.put({"error": f"{type(e).__name__}: {e}"})
+
+
+def _run_once(stage, count, attachment_size):
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    child = context.Process(target=_run_case, args=(stage, count, attachment_size, results))
+    child.start()
+    result = results.get()
+    child.join()
+    if "error" in result:
+        raise RuntimeError(f"{stage} failed: {result['error']}")
+    result["per_second"] = result["items"] / result["seconds"] if result["seconds"] else float("inf")
+    return result
+
+
+def run_case(stage, count, attachment_size, repeat):
+    # Best of `repeat` runs: the fastest run is the one least disturbed by
+    # the rest of the machine, likewise the smallest peak
+    runs = [_run_once(stage, count, attachment_size) for _ in range(max(1, repeat))]
+    best = max(runs, key=lambda run: run["per_second"])
+    best["peak_rss_mb"] = min(run["peak_rss_mb"] for run in runs)
+    return best
+
+
+def case_key(stage, count, attachment_size):
+    return f"{stage}|{count}|{attachment_size // MB}MB"
+
+
+def compare(key, result, baseline, tolerance):
+    expected = baseline.get(key)
+    if expected is None:
+        return None
+    problems = []
+    if result["per_second"] < expected["per_second"] * (1 - tolerance):
+        problems.append(f"throughput {result['per_second']:,.0f}/s vs baseline {expected['per_second']:,.0f}/s")
+    if result["peak_rss_mb"] > expected["peak_rss_mb"] * (1 + tolerance) + RSS_SLACK_MB:
+        problems.append(f"peak RSS {result['peak_rss_mb']:.1f} MB vs baseline {expected['peak_rss_mb']:.1f} MB")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pipeline benchmark suite")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="standard")
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=list(STAGES))
+    parser.add_argument("--recipients", nargs="+", type=int, help="override the profile's recipient counts")
+    parser.add_argument("--attachment-mb", nargs="+", type=int, help="override the profile's attachment sizes")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="runs per case, the best one counts")
+    parser.add_argument("--output", type=Path, help="also write the results as JSON here")
+    args = parser.parse_args()
+
+    counts, sizes = PROFILES[args.profile]
+    if args.recipients:
+        counts = args.recipients
+    if args.attachment_mb:
+        sizes = [size * MB for size in args.attachment_mb]
+
+    baseline = {}
+    if args.baseline.exists() and not args.save_baseline:
+        baseline = json.loads(args.baseline.read_text())["cases"]
+
+    results = {}
+    regressions = []
+    print(f"{'stage':<14}{'recipients':>11}{'attach':>8}{'items':>10}{'seconds':>9}{'items/s':>13}{'peak MB':>9}  vs baseline")
+    for stage in args.stages:
+        uses_attachments = STAGES[stage][1]
+        for count in counts:
+            for size in (sizes if uses_attachments else (0,)):
+                key = case_key(stage, count, size)
+                result = run_case(stage, count, size, args.repeat)
+                results[key] = result
+                problems = compare(key, result, baseline, args.tolerance)
+                if problems is None:
+                    verdict = "-"
+                elif problems:
+                    verdict = "REGRESSION: " + "; ".join(problems)
+                    regressions.append((key, problems))
+                else:
+                    verdict = f"ok ({result['per_second'] / baseline[key]['per_second']:.2f}x)"
+                print(f"{stage:<14}{count:>11,}{size // MB:>6}MB{result['items']:>10,}{result['seconds']:>9.2f}"
+                      f"{result['per_second']:>13,.0f}{result['peak_rss_mb']:>9.1f}  {verdict}", flush=True)
+
+    report = {"python": sys.version.split()[0], "machine": os.uname().machine, "cases": results}
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2, sort_keys=True))
+    if args.save_baseline:
+        if args.baseline.exists():
+            stored = json.loads(args.baseline.read_text())
+            stored["cases"].update(results)
+            results = stored["cases"]
+        report["cases"] = results
+        args.baseline.write_text(json.dumps(report, indent=2, sort_keys=True) + "\n")
+        print(f"baseline saved to {args.baseline}")
+    if regressions:
+        print(f"{len(regressions)} regression(s) beyond {args.tolerance:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,28 @@
 import streamlit as st
-import pandas as pd
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.mime.application import MIMEApplication
 import os
 from dotenv import load_dotenv
 from streamlit_quill import st_quill
-import re
-from email_validator import validate_email, EmailNotValidError
-from pathlib import Path
+import io
 import time
+from datetime import datetime, timedelta
+# The UI only collects input and shows progress, sending lives in kuki_mail
+from kuki_mail.transports import get_transport
+from kuki_mail.send_engine import DEFAULT_CONCURRENCY, MAX_CONCURRENCY
+from kuki_mail.rate_limiter import RateLimiter, DEFAULT_PER_SECOND
+from kuki_mail.recipients import RecipientSource, EmptyRecipientFile
+from kuki_mail.validation import validate_recipients
+from kuki_mail.journal import campaign_id
+from kuki_mail.jobs import job_runner, owner_token, RUNNING, DONE, FAILED
+from kuki_mail.metrics import metrics, serve_from_env, STAGES
+from kuki_mail.accounts import SenderAccount, parse_accounts, LEAST_LOADED, ROUND_ROBIN
+from kuki_mail.shards import prepare_campaign, list_campaigns, cancel_campaign, STALLED
+from kuki_mail.campaign import send_test_email, run_bulk_job, run_sharded_job
+from kuki_mail.suppression import shared_index, read_addresses, REASONS, UNSUBSCRIBE
+from kuki_mail.scheduler import (shared_scheduler, schedule_campaign, ACTIVE, PAUSED, CANCELLED, PENDING, SENDING,
+                                 SENT, FAILED as ITEM_FAILED, DEFAULT_TIMEZONE)
+
+# Seconds between status refreshes while a campaign is sending
+JOB_POLL_INTERVAL = 1
 
 # Load environment variables
 load_dotenv()
@@ -21,158 +33,222 @@ def init_session_state():
     if 'progress' not in st.session_state:
         st.session_state.progress = 0
 
-def validate_emails(df):
-    invalid_emails = []
-    for idx, row in df.iterrows():
-        try:
-            validate_email(row['email'])
-        except EmailNotValidError:
-            invalid_emails.append(f"Row {idx + 2}: {row['email']}")
-    return invalid_emails
+def get_smtp_pool(sender_email, sender_password, size=1):
+    # Keep one authenticated pool per account across reruns so that the
+    # test email and the bulk send share connections
+    transport = get_transport()
+    pool_key = (sender_email, sender_password, transport.name)
+    if st.session_state.get('smtp_pool_key') != pool_key:
+        if st.session_state.get('smtp_pool') is not None:
+            st.session_state.smtp_pool.close()
+        st.session_state.smtp_pool = transport.pool(sender_email, sender_password)
+        st.session_state.smtp_pool_key = pool_key
+    pool = st.session_state.smtp_pool
+    pool.size = max(pool.size, size)
+    return pool
 
-# def clean_content(content):
-#     # Process line by line to handle tabs and spaces
-#     lines = []
-#     prev_empty = False
-    
-#     for line in content.split('\n'):
-#         # Convert tabs to spaces while preserving alignment
-#         line = line.expandtabs(4)
-#         # Keep leading spaces but remove trailing ones
-#         line = line.rstrip()
-        
-#         # Handle empty lines
-#         if not line:
-#             if not prev_empty:  # Only add <br> if previous line wasn't empty
-#                 lines.append('<br>')
-#             prev_empty = True
-#         else:
-#             lines.append(line)
-#             prev_empty = False
-    
-#     # Join lines with spaces (no <br> between consecutive non-empty lines)
-#     content = ' '.join(lines)
-#     return content
+def format_duration(seconds):
+    if seconds is None:
+        return "—"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h {minutes:02d}m" if hours else f"{minutes}m {seconds:02d}s"
 
-def clean_content(content):
-    # Convert all line break indicators to single <br> tags
-    content = content.replace('</p><p>', '<br>')  # Handle Quill's paragraph separation
-    content = content.replace('<p>', '').replace('</p>', '<br>')  # Remove <p> tags
-    content = re.sub(r'<br>\s*<br>', '<br>', content)  # Remove consecutive <br> tags
-    return content.strip()
+def show_job(job):
+    st.write(f"**{job.name}** — {job.status}")
+    st.progress(job.progress)
+    cols = st.columns(4)
+    cols[0].metric("Sent", f"{job.sent} / {job.total}")
+    cols[1].metric("Failed", job.failed)
+    cols[2].metric("Emails / second", f"{job.throughput:.1f}")
+    cols[3].metric("Time left", format_duration(job.eta))
+    if job.resumed:
+        st.caption(f"Resumed campaign: {job.resumed} recipients were already sent before")
+    if not job.finished:
+        if st.button("Cancel", key=f"cancel_{job.id}"):
+            job.cancel()
+    elif job.status == DONE:
+        if job.sent == job.total:
+            st.success(f"🎉 Successfully sent {job.sent} emails!")
+        else:
+            st.warning(f"Sent {job.sent} out of {job.total} emails")
+    elif job.status == FAILED:
+        st.error(f"Campaign stopped: {job.error}")
+    if job.errors:
+        with st.expander(f"Errors ({job.failed})"):
+            for message in job.errors:
+                st.write(message)
+    if job.dead_letters is not None and job.dead_letters.count:
+        st.download_button("Download failed recipients (CSV)", job.dead_letters.export(),
+                           file_name=f"failed_recipients_{job.id}.csv", mime="text/csv", key=f"dead_letters_{job.id}")
 
-def send_test_email(sender_email, sender_password, subject, content, attachments):
-    try:
-        # Create message
-        msg = MIMEMultipart()
-        msg['From'] = sender_email
-        msg['To'] = sender_email
-        msg['Subject'] = "Test Email"
-        
-        # Clean and format content
-        cleaned_content = clean_content(content)
-        # Add HTML content with proper styling
-        html_content = f"""
-<html>
-    <head>
-        <style>
-            body {{ font-family: Arial, sans-serif; }}
-            .content {{ 
-                white-space: pre-line;  # This respects line breaks but collapses multiple spaces
-                line-height: 1.4;       # Adjust this to control spacing between lines
-                margin: 0;
-                padding: 0;
-            }}
-            .content br {{
-                display: block;         # Makes <br> behave like line breaks
-                content: "";            # No extra content
-                margin-bottom: 0;       # Remove extra spacing
-            }}
-        </style>
-    </head>
-    <body>
-        <div class="content">{cleaned_content}</div>
-    </body>
-</html>
-"""
-        msg.attach(MIMEText(html_content, 'html'))
-        
-        # Add attachments
-        if attachments:
-            for file in attachments:
-                with open(file.name, 'rb') as f:
-                    attachment = MIMEApplication(f.read())
-                    attachment.add_header('Content-Disposition', 'attachment', filename=file.name.split('/')[-1])
-                    msg.attach(attachment)
-        
-        # Send email
-        with smtplib.SMTP('smtp.gmail.com', 587) as server:
-            server.starttls()
-            server.login(sender_email, sender_password)
-            server.send_message(msg)
-        
-        return True, "Test email sent successfully!"
-    except Exception as e:
-        return False, f"Error sending test email: {str(e)}"
+def current_owner():
+    # owner_token() of the sender and app password entered on this page, or None
+    return owner_token(st.session_state.get('sender_email'), st.session_state.get('sender_password'))
 
-def send_bulk_emails(df, sender_email, sender_password, subject_template, content, attachments):
-    total_emails = len(df)
-    success_count = 0
-    
-    for idx, row in df.iterrows():
-        try:
-            # Create message
-            msg = MIMEMultipart()
-            msg['From'] = sender_email
-            msg['To'] = row['email']
-            
-            # Replace variables in subject
-            personalized_subject = subject_template.replace('{name}', row['name'])
-            msg['Subject'] = personalized_subject
-            
-            # Clean, personalize and format content
-            personalized_content = content.replace('{name}', row['name'])
-            cleaned_content = clean_content(personalized_content)
-            html_content = f"""
-            <html>
-                <head>
-                    <style>
-                        body {{ font-family: Arial, sans-serif; }}
-                        .content {{ 
-                            white-space: pre-wrap !important;
-                            line-height: 1;
-                        }}
-                    </style>
-                </head>
-                <body>
-                    <div class="content">{cleaned_content}</div>
-                </body>
-            </html>
-            """
-            msg.attach(MIMEText(html_content, 'html'))
-            
-            # Add attachments
-            if attachments:
-                for file in attachments:
-                    with open(file.name, 'rb') as f:
-                        attachment = MIMEApplication(f.read())
-                        attachment.add_header('Content-Disposition', 'attachment', filename=file.name.split('/')[-1])
-                        msg.attach(attachment)
-            
-            # Send email
-            with smtplib.SMTP('smtp.gmail.com', 587) as server:
-                server.starttls()
-                server.login(sender_email, sender_password)
-                server.send_message(msg)
-            
-            success_count += 1
-            st.session_state.progress = (success_count / total_emails)
-            time.sleep(0.1)  # Small delay to prevent rate limiting
-            
-        except Exception as e:
-            st.error(f"Error sending email to {row['email']}: {str(e)}")
-    
-    return success_count
+def show_jobs(owner):
+    # Campaigns run in the server process, so a refreshed or reopened page
+    # finds its running send here once the same sender and password are
+    # entered; other people's campaigns on this server are never listed
+    jobs = job_runner.jobs(owner) if owner is not None else []
+    if jobs:
+        with st.expander("Campaigns", expanded=True):
+            for job in reversed(jobs):
+                show_job(job)
+
+def show_sharded_campaign(status):
+    st.write(f"**{status.name}** — {status.state} ({status.count} shards)")
+    st.progress(status.progress)
+    cols = st.columns(4)
+    cols[0].metric("Sent", f"{status.sent} / {status.total}")
+    cols[1].metric("Failed", status.failed)
+    cols[2].metric("Emails / second", f"{status.throughput:.1f}")
+    cols[3].metric("Time left", format_duration(status.eta))
+    st.table([
+        {
+            "shard": shard['index'],
+            "state": shard['state'],
+            "sent": shard['sent'],
+            "failed": shard['failed'],
+            "total": shard.get('total'),
+            "host": shard.get('host', ''),
+        }
+        for shard in status.shards
+    ])
+    if status.state == STALLED:
+        st.warning("A shard stopped reporting, restart it with: "
+                   f"python -m kuki_mail work {status.campaign} --shard <index>")
+    for error in status.errors:
+        st.error(error)
+    if not status.finished:
+        if st.button("Cancel all shards", key=f"cancel_shards_{status.campaign}"):
+            cancel_campaign(status.campaign)
+    dead_letters = status.dead_letters()
+    if dead_letters.count(b'\n') > 1:
+        st.download_button("Download failed recipients (CSV)", dead_letters,
+                           file_name=f"failed_recipients_{status.campaign}.csv", mime="text/csv",
+                           key=f"dead_letters_{status.campaign}")
+
+def show_sharded_campaigns(owner):
+    # Shards may run in worker processes of this server, the CLI, or other
+    # machines sharing the data directory: their status files are merged here,
+    # for the campaigns prepared with this page's sender and password
+    campaigns = list_campaigns(owner) if owner is not None else []
+    if campaigns:
+        with st.expander("Sharded campaigns", expanded=any(not status.finished for status in campaigns)):
+            for status in campaigns:
+                show_sharded_campaign(status)
+    return campaigns
+
+def show_schedule(summary, scheduler):
+    counts = summary['counts']
+    total = sum(counts.values())
+    st.write(f"**{summary['name']}** — {summary['state']}, {summary['steps']} step(s)")
+    st.progress((total - counts.get(PENDING, 0) - counts.get(SENDING, 0)) / total if total else 1.0)
+    cols = st.columns(4)
+    cols[0].metric("Sent", counts.get(SENT, 0))
+    cols[1].metric("Failed", counts.get(ITEM_FAILED, 0))
+    cols[2].metric("Waiting", counts.get(PENDING, 0))
+    cols[3].metric("Next send", datetime.fromtimestamp(summary['next_due']).strftime('%m-%d %H:%M')
+                   if summary['next_due'] else "—")
+    key = summary['id']
+    if summary['state'] == ACTIVE and not scheduler.has_password(summary['sender_email']):
+        # Passwords are not stored, after a restart the schedule waits for it
+        st.warning(f"Waiting for the password of {summary['sender_email']}: "
+                   "enter it under Email Configuration and resume")
+        if (st.session_state.get('sender_email') == summary['sender_email'] and st.session_state.get('sender_password')
+                and st.button("Resume sending", key=f"resume_password_{key}")):
+            scheduler.add_password(summary['sender_email'], st.session_state.sender_password)
+            st.rerun()
+    cols = st.columns(3)
+    if summary['state'] == ACTIVE and cols[0].button("Pause", key=f"pause_{key}"):
+        scheduler.set_state(key, PAUSED)
+        st.rerun()
+    if summary['state'] == PAUSED and cols[0].button("Resume", key=f"resume_{key}"):
+        scheduler.set_state(key, ACTIVE)
+        st.rerun()
+    if summary['state'] in (ACTIVE, PAUSED) and cols[1].button("Cancel", key=f"cancel_schedule_{key}"):
+        scheduler.set_state(key, CANCELLED)
+        st.rerun()
+    if counts.get(ITEM_FAILED):
+        cols[2].download_button("Failed recipients (CSV)", scheduler.queue.dead_letters(key),
+                                file_name=f"failed_recipients_{key}.csv", mime="text/csv",
+                                key=f"schedule_dead_letters_{key}")
+    if scheduler.last_error:
+        st.error(scheduler.last_error)
+
+def show_schedules():
+    # Campaigns spread over a window, by time zone or as drip sequences,
+    # sent by this server's scheduler thread as they come due
+    scheduler = shared_scheduler()
+    summaries = scheduler.queue.summaries()
+    if summaries:
+        with st.expander("Scheduled campaigns", expanded=any(summary['state'] == ACTIVE for summary in summaries)):
+            for summary in summaries:
+                show_schedule(summary, scheduler)
+    return summaries
+
+def format_ms(seconds):
+    return "—" if seconds is None else f"{seconds * 1000:.2f}"
+
+def show_metrics():
+    # Where the time goes, for everything this server process has sent:
+    # TLS handshakes, rendering, building, the SMTP round trips, throttling
+    snapshot = metrics.snapshot()
+    stages = snapshot['stages']
+    if not stages:
+        return
+    counters = snapshot['counters']
+    with st.expander("Pipeline metrics"):
+        cols = st.columns(4)
+        cols[0].metric("Sent", counters.get('sent', 0))
+        cols[1].metric("Failed", counters.get('failed', 0))
+        cols[2].metric("Retries", counters.get('retries', 0))
+        cols[3].metric("Reconnects", counters.get('reconnects', 0))
+        # Recipients with the same template values share one rendered message
+        rendered, reused = counters.get('rendered', 0), counters.get('render_reused', 0)
+        if rendered:
+            st.caption(f"Rendered {rendered} distinct messages for {rendered + reused} personalized sends "
+                       f"({rendered / (rendered + reused):.1%})")
+        names = [name for name in STAGES if name in stages] + sorted(set(stages) - set(STAGES))
+        st.table([
+            {
+                "stage": name,
+                "count": stages[name]['count'],
+                "p50 ms": format_ms(stages[name]['p50']),
+                "p99 ms": format_ms(stages[name]['p99']),
+                "mean ms": format_ms(stages[name]['mean']),
+            }
+            for name in names
+        ])
+        st.download_button("Download metrics (JSON)", metrics.to_json(),
+                           file_name="kuki_mail_metrics.json", mime="application/json")
+
+def show_suppressions():
+    # Unsubscribes, hard bounces and complaints; every send skips these
+    suppressions = shared_index()
+    with st.expander("Suppression list"):
+        counts = suppressions.counts()
+        st.write(f"{sum(counts.values())} suppressed addresses"
+                 + (f" ({', '.join(f'{count} {reason}' for reason, count in sorted(counts.items()))})" if counts else ""))
+        upload = st.file_uploader("Add addresses (CSV/Excel with an email column, or one per line)",
+                                  type=['csv', 'txt', 'xlsx', 'xls'], key="suppression_file")
+        reason = st.selectbox("Reason", REASONS, index=REASONS.index(UNSUBSCRIBE), key="suppression_reason")
+        if upload is not None and st.button("Add to suppression list"):
+            added = suppressions.add(read_addresses(upload), reason)
+            st.success(f"Added {added} addresses")
+            # A list that was already checked has to be checked again
+            st.session_state.pop('suppression_key', None)
+        if counts:
+            st.download_button("Download suppression list (CSV)", suppressions.export(),
+                               file_name="suppressions.csv", mime="text/csv")
+
+def poll_jobs(sharded_campaigns=(), schedules=()):
+    # Rerun the script while anything is sending so the status stays live
+    if (job_runner.active() or any(status.state == RUNNING for status in sharded_campaigns)
+            or any(summary['counts'].get(SENDING) for summary in schedules)):
+        time.sleep(JOB_POLL_INTERVAL)
+        st.rerun()
 
 def main():
     st.set_page_config(page_title="Bulk Email Sender", page_icon="📧")
@@ -180,39 +256,97 @@ def main():
     
     st.title("📧 Bulk Email Sender")
     
+    transport = get_transport()
+    if transport.name != 'smtp':
+        st.info(f"Sending through {transport.describe()}, nothing reaches real inboxes")
+    
+    # Prometheus text on /metrics, JSON on /metrics.json (KUKI_MAIL_METRICS_PORT)
+    serve_from_env()
+    owner = current_owner()
+    show_jobs(owner)
+    sharded_campaigns = show_sharded_campaigns(owner)
+    schedules = show_schedules()
+    show_metrics()
+    show_suppressions()
+    campaign_form()
+    poll_jobs(sharded_campaigns, schedules)
+
+def campaign_form():
     # Email Configuration
     with st.expander("Email Configuration", expanded=True):
         sender_email = st.text_input("Sender Email (Gmail)", key="sender_email")
         sender_password = st.text_input("App Password", type="password", help="Use Gmail App Password", key="sender_password")
+        concurrency = st.number_input("Parallel connections", min_value=1, max_value=MAX_CONCURRENCY,
+                                      value=DEFAULT_CONCURRENCY, help="Number of SMTP connections sending at once",
+                                      key="concurrency")
+        rate_cols = st.columns(3)
+        per_second = rate_cols[0].number_input("Max emails / second", min_value=0.0, value=float(DEFAULT_PER_SECOND),
+                                               help="Starting rate, lowered automatically when Gmail asks us to slow down",
+                                               key="per_second")
+        per_minute = rate_cols[1].number_input("Max emails / minute", min_value=0, value=0,
+                                               help="0 means no limit", key="per_minute")
+        per_day = rate_cols[2].number_input("Max emails / day", min_value=0, value=0,
+                                            help="0 means no limit (Gmail: 500, Workspace: 2000)", key="per_day")
+        # More accounts to shard the campaign across, each with the limits above
+        # unless its line sets its own daily quota
+        extra_accounts = st.text_area("Additional sender accounts (optional)", key="extra_accounts",
+                                      placeholder="email, app password[, max per day[, weight]]",
+                                      help="One account per line; the campaign is spread across all accounts")
+        strategy = st.selectbox("Spread recipients by", (LEAST_LOADED, ROUND_ROBIN), key="account_strategy",
+                                format_func={LEAST_LOADED: "Least loaded account",
+                                             ROUND_ROBIN: "Weighted round-robin"}.get)
+        # Past a few thousand messages one process is CPU bound on MIME building and TLS
+        processes = st.number_input("Worker processes", min_value=1, max_value=os.cpu_count() or 1, value=1,
+                                    help="Split the list into this many shards, each sent by its own process "
+                                         "(single sender account only)", key="processes")
     
     # File Upload
     uploaded_file = st.file_uploader("Upload file (CSV or Excel with columns: name, email)", type=['csv', 'xlsx', 'xls'])
     if uploaded_file:
         try:
-            # Determine file type and read accordingly
-            file_extension = uploaded_file.name.split('.')[-1].lower()
-            if file_extension == 'csv':
-                df = pd.read_csv(uploaded_file)
-            else:  # xlsx or xls
-                df = pd.read_excel(uploaded_file)
-            if not all(col in df.columns for col in ['name', 'email']):
+            # Stream the file in chunks (CSV, or XLSX in openpyxl read-only mode)
+            recipients = RecipientSource(uploaded_file)
+            if recipients.missing_columns():
                 st.error("File must contain 'name' and 'email' columns!")
                 return
-        except pd.errors.EmptyDataError:
+        except EmptyRecipientFile:
             st.error("The uploaded file is empty!")
             return
         except Exception as e:
             st.error(f"Error reading file: {str(e)}")
             return
-        # Validate emails
-        invalid_emails = validate_emails(df)
+        # Validate emails (regex pre-filter, cached per-domain checks, duplicates dropped).
+        # The page reruns every second while a campaign is sending, so the
+        # report is kept per file instead of validating again each time
+        file_key = campaign_id(uploaded_file)
+        if st.session_state.get('validation_key') != file_key:
+            st.session_state.validation_report = validate_recipients(recipients)
+            st.session_state.validation_key = file_key
+        report = st.session_state.validation_report
+        invalid_emails = report.invalid
         if invalid_emails:
             st.error("Invalid emails found:")
             for email in invalid_emails:
                 st.write(email)
             return
+        if report.duplicates:
+            st.info(f"Skipping {len(report.duplicates)} duplicate addresses")
+            recipients.skip_rows = report.duplicates
+        skip_mailed = st.checkbox("Skip addresses earlier campaigns already reached", key="skip_mailed")
+        suppression_key = (file_key, skip_mailed)
+        if st.session_state.get('suppression_key') != suppression_key:
+            st.session_state.suppressed_rows = shared_index().suppressed_rows(recipients, skip_mailed)
+            st.session_state.suppression_key = suppression_key
+        if st.session_state.suppressed_rows:
+            st.info(f"Skipping {len(st.session_state.suppressed_rows)} suppressed addresses")
+            recipients.skip_rows = recipients.skip_rows | st.session_state.suppressed_rows
+        # Counting parses the whole file, once per file and skip choice, not every rerun
+        if st.session_state.get('recipient_count_key') != suppression_key:
+            st.session_state.recipient_count = len(recipients)
+            st.session_state.recipient_count_key = suppression_key
+        recipient_count = st.session_state.recipient_count
         
-        st.success(f"✅ CSV loaded successfully with {len(df)} recipients")
+        st.success(f"✅ CSV loaded successfully with {recipient_count} recipients")
         
         # Email Content
         subject = st.text_input("Email Subject (Use {name} for recipient's name)", 
@@ -226,6 +360,9 @@ def main():
         attachments = st.file_uploader("Attach Files", 
                                      accept_multiple_files=True)
         
+        # Delivery: everything now, or queued for the scheduler
+        schedule = schedule_form()
+        
         col1, col2 = st.columns(2)
         
         # Test Email
@@ -235,7 +372,8 @@ def main():
                         st.error("Please fill in all required fields!")
                     else:
                         success, message = send_test_email(
-                            sender_email, sender_password, subject, content, attachments
+                            sender_email, sender_password, subject, content, attachments,
+                            pool=get_smtp_pool(sender_email, sender_password)
                         )
                         if success:
                             st.success(message)
@@ -246,21 +384,99 @@ def main():
                 if not all([sender_email, sender_password, subject, content]):
                     st.error("Please fill in all required fields!")
                 else:
-                    progress_bar = st.progress(0)
-                    
-                    success_count = send_bulk_emails(
-                        df, sender_email, sender_password, subject, content, attachments
+                    if schedule is not None:
+                        if extra_accounts.strip() or processes > 1:
+                            st.error("Scheduled campaigns send from one account in one process")
+                            return
+                        if not all(step['subject'] and step['content'] for step in schedule['follow_ups']):
+                            st.error("Every follow-up needs a subject and content!")
+                            return
+                        steps = [{'subject': subject, 'content': content, 'delay': 0}] + schedule.pop('follow_ups')
+                        try:
+                            schedule_campaign(
+                                uploaded_file, sender_email, steps, attachments,
+                                name=f"{subject} ({uploaded_file.name})", concurrency=concurrency,
+                                per_second=per_second or None, per_minute=per_minute or None,
+                                per_day=per_day or None, **schedule
+                            )
+                        except ValueError as e:
+                            st.error(str(e))
+                            return
+                        shared_scheduler().add_password(sender_email, sender_password)
+                        st.rerun()
+                    account_limits = dict(per_second=per_second or None, per_minute=per_minute or None,
+                                          per_day=per_day or None, connections=concurrency)
+                    try:
+                        accounts = parse_accounts(extra_accounts, **account_limits)
+                    except ValueError as e:
+                        st.error(f"Additional sender accounts: {e}")
+                        return
+                    if accounts:
+                        accounts.insert(0, SenderAccount(sender_email, sender_password, **account_limits))
+                    elif processes > 1:
+                        campaign = prepare_campaign(
+                            uploaded_file, sender_email, subject, content, attachments,
+                            shards=processes, name=f"{subject} ({uploaded_file.name})", concurrency=concurrency,
+                            per_second=per_second or None, per_minute=per_minute or None, per_day=per_day or None,
+                            skip_mailed=skip_mailed, owner=owner_token(sender_email, sender_password)
+                        )
+                        job_runner.submit(f"{subject} ({uploaded_file.name})", recipient_count, run_sharded_job,
+                                          campaign, sender_password, key=campaign,
+                                          owner=owner_token(sender_email, sender_password))
+                        st.rerun()
+                    # Same list + content + sender resumes the same journal after a crash or rerun
+                    campaign = campaign_id(sender_email, subject, content, uploaded_file)
+                    # The job gets its own copy of the file, the page keeps re-reading the upload
+                    job_recipients = RecipientSource(io.BytesIO(uploaded_file.getvalue()), uploaded_file.name)
+                    job_recipients.skip_rows = recipients.skip_rows
+                    job_runner.submit(
+                        f"{subject} ({uploaded_file.name})", recipient_count, run_bulk_job,
+                        job_recipients, sender_email, sender_password, subject, content,
+                        attachments,
+                        concurrency, RateLimiter(per_second or None, per_minute or None, per_day or None),
+                        campaign, accounts or None, strategy, skip_mailed, key=campaign,
+                        owner=owner_token(sender_email, sender_password)
                     )
-                    
-                    if success_count == len(df):
-                        st.balloons()
-                        st.success(f"🎉 Successfully sent {success_count} emails!")
-                    else:
-                        st.warning(f"Sent {success_count} out of {len(df)} emails")
-            
-        # Progress Bar
-        if st.session_state.progress > 0:
-            st.progress(st.session_state.progress)
+                    # Show the campaign panel straight away
+                    st.rerun()
+
+def schedule_form():
+    # None to send now, otherwise the schedule_campaign() timing options
+    # plus the follow-up steps of a drip sequence
+    when = st.radio("When", ("Now", "Spread over a time window", "At a local time in each recipient's time zone"),
+                    key="schedule_mode", horizontal=True)
+    follow_up_count = st.number_input("Follow-up emails", min_value=0, max_value=5, value=0, key="follow_ups",
+                                      help="Drip sequence: each follow-up goes out some days after the previous email")
+    if when == "Now" and not follow_up_count:
+        return None
+    schedule = {'follow_ups': []}
+    now = datetime.now()
+    if when == "Spread over a time window":
+        cols = st.columns(2)
+        start_day = cols[0].date_input("Start day", value=now.date(), key="window_start_day")
+        start_time = cols[1].time_input("Start time", value=now.time().replace(second=0, microsecond=0),
+                                        key="window_start_time")
+        hours = st.number_input("Spread over (hours)", min_value=0.0, value=8.0, step=0.5, key="window_hours")
+        start = datetime.combine(start_day, start_time).timestamp()
+        schedule.update(start=start, end=start + hours * 3600)
+    elif when.startswith("At a local time"):
+        st.caption("Uses the optional 'timezone' column (e.g. Europe/Berlin)")
+        cols = st.columns(3)
+        day = cols[0].date_input("Day", value=(now + timedelta(days=1)).date(), key="local_day")
+        local_time = cols[1].time_input("Local time", value=now.replace(hour=9, minute=0).time(), key="local_time")
+        default_timezone = cols[2].text_input("Default time zone", value=DEFAULT_TIMEZONE, key="default_timezone")
+        spread = st.number_input("Spread each time zone over (minutes)", min_value=0, value=60, key="local_spread")
+        schedule.update(start=datetime.combine(day, datetime.min.time()).timestamp(), local_time=local_time,
+                        default_timezone=default_timezone, spread=spread * 60)
+    for index in range(int(follow_up_count)):
+        st.write(f"Follow-up {index + 1}")
+        cols = st.columns([1, 3])
+        days = cols[0].number_input("After (days)", min_value=0.0, value=3.0, step=0.5, key=f"follow_up_days_{index}")
+        follow_up_subject = cols[1].text_input("Subject", key=f"follow_up_subject_{index}")
+        follow_up_content = st.text_area("Content (HTML, {name} works here too)", key=f"follow_up_content_{index}")
+        schedule['follow_ups'].append({'subject': follow_up_subject, 'content': follow_up_content,
+                                       'delay': days * 86400})
+    return schedule
 
 if __name__ == "__main__":
     main()
@@ -1,12 +1,19 @@
 import streamlit as st
-import pandas as pd
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email import encoders
-from jinja2 import Template
 from streamlit_quill import st_quill
+# The page only collects input and shows progress, sending lives in kuki_mail
+from kuki_mail.transports import get_transport
+from kuki_mail.send_engine import DEFAULT_CONCURRENCY, MAX_CONCURRENCY
+from kuki_mail.layouts import RICH_TEST_LAYOUT, RICH_BULK_LAYOUT
+from kuki_mail.attachments import attachment_cache
+from kuki_mail.mime_builder import MessageBuilder
+from kuki_mail.render_cache import render_cache
+from kuki_mail.metrics import metrics
+from kuki_mail.recipients import RecipientSource
+from kuki_mail.journal import SendJournal, campaign_id
+from kuki_mail.retry import RetryPolicy, DeadLetters
+from kuki_mail.accounts import SenderAccount, parse_accounts, LEAST_LOADED, ROUND_ROBIN
+from kuki_mail.campaign import compile_rich_plan, send_bulk_emails
+from kuki_mail.suppression import shared_index
 
 st.set_page_config(page_title="Smart Email Sender", layout="wide")
 st.title("📧 Smart Personalized Email Sender")
@@ -29,6 +36,11 @@ uploaded_file = st.file_uploader("📄 Upload Contacts CSV", type="csv")
 # Step 2: Gmail Info
 your_email = st.text_input("📬 Your Gmail Address")
 app_password = st.text_input("🔐 App Password", type="password")
+concurrency = st.number_input("⚡ Parallel connections", min_value=1, max_value=MAX_CONCURRENCY, value=DEFAULT_CONCURRENCY)
+with st.expander("👥 More sender accounts (optional)"):
+    extra_accounts = st.text_area("One per line: email, app password[, max per day[, weight]]")
+    strategy = st.radio("Spread recipients by", (LEAST_LOADED, ROUND_ROBIN), horizontal=True,
+                        format_func={LEAST_LOADED: "Least loaded", ROUND_ROBIN: "Weighted round-robin"}.get)
 
 # Step 3: Email Subject
 subject = st.text_input("📌 Email Subject (You can use {{ name }} and {{ starting_line }} here too)")
@@ -43,12 +55,6 @@ editor_content = st_quill(placeholder="Start typing your promotional message..."
 # Step 6: Attachments
 attachments = st.file_uploader("📎 Upload Attachments (Optional)", type=None, accept_multiple_files=True)
 
-# Function to apply template variables to any text content
-def apply_template_variables(content, variables):
-    # Replace template placeholders like {{ name }} with actual values
-    template = Template(content)
-    return template.render(**variables)
-
 # ------------------------------
 # Send Test Email Section
 # ------------------------------
@@ -58,137 +64,24 @@ test_button = st.button("📤 Send Test Email to Myself")
 
 if test_button and your_email and app_password and subject and editor_content:
     try:
-        server = smtplib.SMTP("smtp.gmail.com", 587)
-        server.starttls()
-        server.login(your_email, app_password)
-
         test_name = "YourName"
         test_line = "This is a sample starting line just for preview."
         
-        # Create proper email HTML structure
-        # First apply the template variables to the greeting
         personal_vars = {"name": test_name, "starting_line": test_line}
-        personalized_greeting = Template(greeting_line).render(**personal_vars)
-        
-        # Personalize the subject line
-        personalized_subject = apply_template_variables(subject, personal_vars)
-        
-        # Process the main editor content for template variables
-        if "{{ starting_line }}" in editor_content:
-            editor_content = editor_content.replace("{{ starting_line }}", test_line)
-        if "{{ name }}" in editor_content:
-            editor_content = editor_content.replace("{{ name }}", test_name)
-        
-        # Full HTML email with proper structure and styling
-        html_email = f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <style>
-                body {{ 
-                    font-family: Arial, sans-serif; 
-                    line-height: 1.4; 
-                    color: #333333; 
-                    margin: 0;
-                    padding: 0;
-                }}
-                .email-container {{ 
-                    max-width: 600px; 
-                    margin: 0 auto; 
-                    padding: 20px; 
-                }}
-                .greeting {{ 
-                    font-size: 16px; 
-                    margin-bottom: 15px; 
-                }}
-                .content p {{
-                    margin-top: 0;
-                    margin-bottom: 10px;
-                }}
-                .content {{
-                    margin: 0;
-                    padding: 0;
-                }}
-                /* List styles */
-                ul, ol {{ 
-                    padding-left: 25px; 
-                    margin: 10px 0; 
-                }}
-                li {{ 
-                    margin-bottom: 5px; 
-                }}
-                strong {{ font-weight: bold; }}
-                em {{ font-style: italic; }}
-                u {{ text-decoration: underline; }}
-                pre, code {{
-                    white-space: pre-wrap;
-                    font-family: monospace;
-                    background-color: #f5f5f5;
-                    padding: 5px;
-                    border-radius: 3px;
-                }}
-                blockquote {{
-                    margin-left: 0;
-                    padding-left: 10px;
-                    border-left: 3px solid #ccc;
-                    color: #555;
-                }}
-                /* Fix spacing */
-                .ql-editor p {{
-                    margin: 0 !important;
-                }}
-                /* Fix alignment */
-                .ql-align-justify {{
-                    text-align: justify;
-                }}
-                .ql-align-center {{
-                    text-align: center;
-                }}
-                .ql-align-right {{
-                    text-align: right;
-                }}
-                /* Tab spacing */
-                .tab {{
-                    display: inline-block;
-                    width: 2em;
-                }}
-            </style>
-        </head>
-        <body>
-            <div class="email-container">
-                <div class="greeting">{personalized_greeting}</div>
-                <div class="content">{editor_content}</div>
-            </div>
-        </body>
-        </html>
-        """
-
-        msg = MIMEMultipart('alternative')
-        msg["From"] = your_email
-        msg["To"] = your_email
-        msg["Subject"] = f"[TEST] {personalized_subject}"
+        plan = compile_rich_plan(subject, greeting_line, editor_content, RICH_TEST_LAYOUT)
+        # Rerunning the page or clicking again reuses the rendered and built message
+        rendered = render_cache.render(plan, personal_vars, persist=True)
+        personalized_subject = rendered.subject
+        html_email = rendered.html
         
-        # Add plain text version (fallback)
-        plain_text = f"{personalized_greeting}\n\n{test_line}\n"
-        msg.attach(MIMEText(plain_text, 'plain'))
-        
-        # Add HTML version with proper content type
-        msg.attach(MIMEText(html_email, 'html'))
-
-        # Attach files
-        for file in attachments:
-            file.seek(0)  # Reset file pointer
-            part = MIMEBase("application", "octet-stream")
-            part.set_payload(file.read())
-            encoders.encode_base64(part)
-            part.add_header("Content-Disposition", f'attachment; filename="{file.name}"')
-            msg.attach(part)
-            file.seek(0)  # Reset for reuse
-
-        server.sendmail(your_email, your_email, msg.as_string())
-        server.quit()
+        # Plain text fallback plus HTML; attachments are encoded once and the bulk send reuses them
+        builder = MessageBuilder(your_email, attachment_cache.encode_all(attachments))
+        message = render_cache.message(plan, personal_vars, builder, your_email, subject_prefix="[TEST] ",
+                                       rendered=rendered, persist=True)
+
+        # Closed even when the send fails
+        with get_transport().pool(your_email, app_password) as pool:
+            pool.send_wire(your_email, your_email, message)
         st.success("✅ Test email sent to your address!")
         
         # Show a preview of the email
@@ -197,6 +90,8 @@ if test_button and your_email and app_password and subject and editor_content:
             st.code(personalized_subject)
             st.markdown("### HTML Content Preview")
             st.code(html_email[:500] + "..." if len(html_email) > 500 else html_email)
+            st.markdown("### Plain Text Preview")
+            st.code(rendered.text)
 
     except Exception as e:
         st.error(f"❌ Error sending test email: {e}")
@@ -208,160 +103,69 @@ st.markdown("---")
 st.markdown("### 🚀 Send to All Recipients")
 
 if uploaded_file and your_email and app_password and subject and editor_content:
-    df = pd.read_csv(uploaded_file)
+    # Streamed in chunks, the send pipeline starts before the whole file is parsed
+    recipients = RecipientSource(uploaded_file)
     
-    st.write(f"Found {len(df)} recipients in your CSV file")
+    st.write(f"Found {len(recipients)} recipients in your CSV file")
     
     if st.button("📨 Send Emails to Everyone"):
         progress_bar = st.progress(0)
         status_text = st.empty()
         
         try:
-            server = smtplib.SMTP("smtp.gmail.com", 587)
-            server.starttls()
-            server.login(your_email, app_password)
+            # Extra accounts shard the campaign, each with its own connections and limiter
+            accounts = parse_accounts(extra_accounts, connections=concurrency)
+            if accounts:
+                accounts.insert(0, SenderAccount(your_email, app_password, connections=concurrency))
+            
+            # Unsubscribed and bounced addresses are never mailed again
+            suppressions = shared_index()
+            recipients.skip_rows = suppressions.suppressed_rows(recipients)
+            if recipients.skip_rows:
+                st.info(f"Skipping {len(recipients.skip_rows)} suppressed addresses")
+            total_emails = len(recipients)
+            
+            # Rerunning the same campaign after a crash picks up where it stopped
+            campaign = campaign_id(your_email, subject, greeting_line, editor_content, uploaded_file)
+            # Recipients that still fail after the retries end up here
+            dead_letters = DeadLetters(campaign)
             
-            total_emails = len(df)
-            emails_sent = 0
+            # Called on the Streamlit thread as the workers report back, only
+            # with final results: transient failures were already retried
+            def show_progress(sent, total):
+                status_text.text(f"✅ Sent {sent} of {total} emails")
+                progress_bar.progress(sent / total if total else 1.0)
             
-            for index, row in df.iterrows():
-                name = row["name"]
-                to_email = row["email"]
-                starting_line = row.get("starting_line", "")
-                
-                # Create proper email HTML structure
-                # First apply the template variables to the greeting
-                personal_vars = {"name": name, "starting_line": starting_line}
-                personalized_greeting = Template(greeting_line).render(**personal_vars)
-                
-                # Personalize the subject line
-                personalized_subject = apply_template_variables(subject, personal_vars)
-                
-                # Process the main editor content for template variables
-                personalized_content = editor_content
-                if "{{ starting_line }}" in personalized_content:
-                    personalized_content = personalized_content.replace("{{ starting_line }}", starting_line)
-                if "{{ name }}" in personalized_content:
-                    personalized_content = personalized_content.replace("{{ name }}", name)
-                
-                # Full HTML email with proper structure and styling
-                html_email = f"""
-                <!DOCTYPE html>
-                <html>
-                <head>
-                    <meta charset="UTF-8">
-                    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-                    <style>
-                        body {{ 
-                            font-family: Arial, sans-serif; 
-                            line-height: 1.2; 
-                            color: #333333; 
-                            margin: 0;
-                            padding: 0;
-                        }}
-                        .email-container {{ 
-                            max-width: 600px; 
-                            margin: 0 auto; 
-                            padding: 20px; 
-                        }}
-                        .greeting {{ 
-                            font-size: 16px; 
-                            margin-bottom: 15px; 
-                        }}
-                        .content p {{
-                            margin-top: 0;
-                            margin-bottom: 10px;
-                        }}
-                        .content {{
-                            margin: 0;
-                            padding: 0;
-                        }}
-                        /* List styles */
-                        ul, ol {{ 
-                            padding-left: 25px; 
-                            margin: 10px 0; 
-                        }}
-                        li {{ 
-                            margin-bottom: 5px; 
-                        }}
-                        strong {{ font-weight: bold; }}
-                        em {{ font-style: italic; }}
-                        u {{ text-decoration: underline; }}
-                        pre, code {{
-                            white-space: pre-wrap;
-                            font-family: monospace;
-                            background-color: #f5f5f5;
-                            padding: 5px;
-                            border-radius: 3px;
-                        }}
-                        blockquote {{
-                            margin-left: 0;
-                            padding-left: 10px;
-                            border-left: 3px solid #ccc;
-                            color: #555;
-                        }}
-                        /* Fix spacing */
-                        .ql-editor p {{
-                            margin: 0 !important;
-                        }}
-                        /* Fix alignment */
-                        .ql-align-justify {{
-                            text-align: justify;
-                        }}
-                        .ql-align-center {{
-                            text-align: center;
-                        }}
-                        .ql-align-right {{
-                            text-align: right;
-                        }}
-                        /* Tab spacing */
-                        .tab {{
-                            display: inline-block;
-                            width: 2em;
-                        }}
-                    </style>
-                </head>
-                <body>
-                    <div class="email-container">
-                        <div class="greeting">{personalized_greeting}</div>
-                        <div class="content">{personalized_content}</div>
-                    </div>
-                </body>
-                </html>
-                """
-                
-                msg = MIMEMultipart('alternative')
-                msg["From"] = your_email
-                msg["To"] = to_email
-                msg["Subject"] = personalized_subject
-                
-                # Add plain text version (fallback)
-                plain_text = f"{personalized_greeting}\n\n{starting_line}\n"
-                msg.attach(MIMEText(plain_text, 'plain'))
-                
-                # Add HTML version with proper content type
-                msg.attach(MIMEText(html_email, 'html'))
-                
-                # Attach files
-                for file in attachments:
-                    file.seek(0)  # Reset file pointer
-                    part = MIMEBase("application", "octet-stream")
-                    part.set_payload(file.read())
-                    encoders.encode_base64(part)
-                    part.add_header("Content-Disposition", f'attachment; filename="{file.name}"')
-                    msg.attach(part)
-                    file.seek(0)  # Reset for reuse
-                
-                server.sendmail(your_email, to_email, msg.as_string())
-                
-                # Update progress
-                emails_sent += 1
-                status_text.text(f"✅ Email sent to {name} ({to_email})")
-                progress_bar.progress(emails_sent / total_emails)
+            def show_error(row, error):
+                # One bad address no longer stops the campaign
+                status_text.text(f"⚠️ Could not send to {row['name']} ({row['email']}): {error}")
             
-            server.quit()
-            st.balloons()
-            st.success("🎉 All emails sent successfully!")
+            counters = metrics.snapshot()['counters']
+            with SendJournal(campaign) as journal:
+                done_rows = journal.completed_rows()
+                if done_rows:
+                    st.info(f"Resuming campaign: {len(done_rows)} recipients were already sent")
+                emails_sent = send_bulk_emails(
+                    recipients, your_email, app_password, None, None, attachments,
+                    concurrency=concurrency, on_progress=show_progress, on_error=show_error, journal=journal,
+                    retry=RetryPolicy(), dead_letters=dead_letters, accounts=accounts, strategy=strategy,
+                    suppressions=suppressions,
+                    # Templates are parsed once for the whole campaign
+                    plan=compile_rich_plan(subject, greeting_line, editor_content, RICH_BULK_LAYOUT),
+                )
+            # Recipients with the same name and starting line share one rendered message
+            after = metrics.snapshot()['counters']
+            rendered = after.get('rendered', 0) - counters.get('rendered', 0)
+            reused = after.get('render_reused', 0) - counters.get('render_reused', 0)
+            if rendered:
+                st.caption(f"Rendered {rendered} distinct messages for {rendered + reused} recipients")
+            if dead_letters.count:
+                st.warning(f"Sent {emails_sent} of {total_emails} emails, {dead_letters.count} could not be delivered")
+                st.download_button("⬇️ Download failed recipients (CSV)", dead_letters.export(),
+                                   file_name="failed_recipients.csv", mime="text/csv")
+            else:
+                st.balloons()
+                st.success("🎉 All emails sent successfully!")
             
         except Exception as e:
             st.error(f"❌ Error: {e}")
@@ -0,0 +1,53 @@
+import importlib
+
+# The sending core, usable without Streamlit: `python -m kuki_mail` for the
+# CLI, or import what you need. Submodules load on first use, so importing
+# the package is free and pandas, jinja2 and openpyxl are only imported by a
+# step that actually needs them.
+_EXPORTS = {
+    'RecipientSource': 'recipients',
+    'validate_recipients': 'validation',
+    'RenderPlan': 'templating',
+    'normalize_html': 'html_normalizer',
+    'compile_bulk_plan': 'campaign',
+    'compile_rich_plan': 'campaign',
+    'campaign_plan': 'campaign',
+    'MessageBuilder': 'mime_builder',
+    'RenderCache': 'render_cache',
+    'send_test_email': 'campaign',
+    'send_bulk_emails': 'campaign',
+    'send_test_email_async': 'campaign',
+    'send_bulk_emails_async': 'campaign',
+    'SendEngine': 'send_engine',
+    'AsyncSendEngine': 'send_engine',
+    'AsyncSMTP': 'async_smtp',
+    'AsyncSMTPPool': 'async_smtp',
+    'RateLimiter': 'rate_limiter',
+    'RetryPolicy': 'retry',
+    'DeadLetters': 'retry',
+    'SendJournal': 'journal',
+    'SenderAccount': 'accounts',
+    'SuppressionIndex': 'suppression',
+    'normalize_address': 'suppression',
+    'get_transport': 'transports',
+    'prepare_campaign': 'shards',
+    'run_local': 'shards',
+    'read_campaign': 'shards',
+    'schedule_campaign': 'scheduler',
+    'Scheduler': 'scheduler',
+}
+
+__all__ = sorted(_EXPORTS)
+
+
+def __getattr__(name):
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f'.{module}', __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
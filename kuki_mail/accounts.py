@@ -0,0 +1,178 @@
+import threading
+from contextlib import contextmanager
+
+from .rate_limiter import RateLimiter, DEFAULT_PER_SECOND
+from .send_engine import DEFAULT_CONCURRENCY
+from .transports import get_transport
+
+# How AccountPool picks the account for the next message
+LEAST_LOADED = 'least_loaded'
+ROUND_ROBIN = 'round_robin'
+STRATEGIES = (LEAST_LOADED, ROUND_ROBIN)
+
+
+class SenderAccount:
+    # One set of sender credentials with its own quotas. `weight` is the
+    # account's share of the campaign under weighted round-robin.
+
+    def __init__(self, email, password, per_second=DEFAULT_PER_SECOND, per_minute=None, per_day=None,
+                 weight=1, connections=DEFAULT_CONCURRENCY):
+        self.email = email
+        self.password = password
+        self.weight = max(1, int(weight))
+        self.connections = max(1, int(connections))
+        self.limiter = RateLimiter(per_second, per_minute, per_day)
+        self.pool = None
+        self.in_flight = 0
+        self.sent = 0
+        self.failed = 0
+        # Smooth weighted round-robin state
+        self.current_weight = 0
+
+    def __repr__(self):
+        return f"SenderAccount({self.email!r})"
+
+
+def parse_accounts(text, **defaults):
+    # One account per line: "email, app password[, daily quota[, weight]]".
+    # Blank lines and lines starting with # are skipped; `defaults` go to
+    # every SenderAccount (per_second, connections, ...).
+    accounts = []
+    for number, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = [field.strip() for field in line.split(',')]
+        if len(fields) < 2 or not fields[0] or not fields[1]:
+            raise ValueError(f"Line {number}: expected 'email, app password[, daily quota[, weight]]'")
+        options = dict(defaults)
+        try:
+            if len(fields) > 2 and fields[2]:
+                options['per_day'] = int(fields[2])
+            if len(fields) > 3 and fields[3]:
+                options['weight'] = int(fields[3])
+        except ValueError:
+            raise ValueError(f"Line {number}: daily quota and weight must be whole numbers")
+        accounts.append(SenderAccount(fields[0], fields[1], **options))
+    return accounts
+
+
+class AccountSession:
+    # What an engine worker gets from AccountPool.session(): call select() to
+    # pick the account for the next message (this waits for the account's
+    # rate limiter), build the message with that account as From, then
+    # send_wire(). A connection of the chosen account is only held for the
+    # send itself, so an idle worker never sits on another account's
+    # connection while a busy one waits for it.
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.account = None
+        self.tokens = 0
+
+    def select(self, tokens=1):
+        if self.account is not None:
+            # The previous selection never got sent (e.g. the build failed)
+            self.pool._done(self.account, self.tokens, failed=True)
+        account = self.pool._choose(tokens)
+        account.limiter.acquire(tokens)
+        self.account = account
+        self.tokens = tokens
+        return account
+
+    def send_wire(self, from_addr, to_addrs, message):
+        account = self.account
+        if account is None:
+            raise RuntimeError("select() an account before sending")
+        self.account = None
+        try:
+            with account.pool.session() as session:
+                refused = session.send_wire(from_addr, to_addrs, message)
+        except Exception as e:
+            account.limiter.on_error(e)
+            self.pool._done(account, self.tokens, failed=True)
+            raise
+        account.limiter.on_success()
+        self.pool._done(account, self.tokens)
+        return refused
+
+    def close(self):
+        if self.account is not None:
+            self.pool._done(self.account, self.tokens, failed=True)
+            self.account = None
+
+
+class AccountPool:
+    # Shards a campaign across sender accounts, each with its own connection
+    # pool and rate limiter. Used in place of an SMTPPool: the engine gets one
+    # worker per connection across all accounts and no shared limiter.
+    #
+    # Accounts that can send right now are preferred; among those,
+    # ROUND_ROBIN follows the weights (smooth weighted round-robin) and
+    # LEAST_LOADED picks the fewest messages in flight per weight. An account
+    # whose quota is used up is skipped until every account is waiting.
+
+    def __init__(self, accounts, transport=None, strategy=LEAST_LOADED):
+        if not accounts:
+            raise ValueError("At least one sender account is needed")
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown strategy {strategy!r}, expected one of {', '.join(STRATEGIES)}")
+        transport = transport or get_transport()
+        self.accounts = list(accounts)
+        self.strategy = strategy
+        for account in self.accounts:
+            account.pool = transport.pool(account.email, account.password, size=account.connections)
+        self.size = sum(account.connections for account in self.accounts)
+        self._lock = threading.Lock()
+
+    def _choose(self, tokens):
+        waits = {account: account.limiter.wait_time(tokens) for account in self.accounts}
+        with self._lock:
+            ready = [account for account in self.accounts if waits[account] <= 0]
+            if not ready:
+                ready = [min(self.accounts, key=waits.get)]
+            if self.strategy == ROUND_ROBIN:
+                total = sum(account.weight for account in ready)
+                for account in ready:
+                    account.current_weight += account.weight
+                chosen = max(ready, key=lambda account: account.current_weight)
+                chosen.current_weight -= total
+            else:
+                chosen = min(ready, key=lambda account: (account.in_flight / account.weight,
+                                                         account.sent / account.weight))
+            chosen.in_flight += 1
+        return chosen
+
+    def _done(self, account, recipients=1, failed=False):
+        with self._lock:
+            account.in_flight -= 1
+            if failed:
+                account.failed += recipients
+            else:
+                account.sent += recipients
+
+    @contextmanager
+    def session(self):
+        session = AccountSession(self)
+        try:
+            yield session
+        finally:
+            session.close()
+
+    def stats(self):
+        return [
+            {'email': account.email, 'sent': account.sent, 'failed': account.failed,
+             'in_flight': account.in_flight, 'rate': account.limiter.rate}
+            for account in self.accounts
+        ]
+
+    def close(self):
+        for account in self.accounts:
+            if account.pool is not None:
+                account.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,398 @@
+import asyncio
+import base64
+import re
+import smtplib
+import socket
+import ssl
+import time
+from contextlib import asynccontextmanager
+from functools import lru_cache
+
+from .metrics import metrics
+from .smtp_pool import (SMTP_HOST, SMTP_PORT, SECURITY_STARTTLS, SECURITY_SSL, MAX_MESSAGES_PER_CONNECTION)
+
+# Big enough for any reply line, and for the stream buffer of a connection
+_READ_LIMIT = 64 * 1024
+# Preferred first, like smtplib.SMTP.login (no CRAM-MD5: nobody offers it anymore)
+AUTH_MECHANISMS = ('PLAIN', 'LOGIN')
+# An EHLO keyword, the rest of the line are its parameters
+_EXTENSION = re.compile(r'([A-Za-z0-9][A-Za-z0-9\-]*) ?')
+# asyncio.timeout (3.11+) arms a timer; wait_for wraps every read in a task
+_timeout = getattr(asyncio, 'timeout', None)
+
+
+@lru_cache(maxsize=None)
+def _local_hostname():
+    # What smtplib says in EHLO; getfqdn can do a DNS lookup, so once per process
+    return socket.getfqdn()
+
+
+def _b64(value):
+    return base64.b64encode(value.encode('utf-8')).decode('ascii')
+
+
+class AsyncSMTP:
+    # One SMTP client connection on an asyncio event loop, the counterpart of
+    # smtplib.SMTP plus mime_builder.send_wire_message: EHLO (HELO fallback),
+    # STARTTLS or implicit TLS, AUTH PLAIN/LOGIN, SIZE, 8BITMIME and
+    # PIPELINING. Waiting on the server costs a suspended coroutine instead
+    # of a blocked thread, so hundreds of connections share one loop.
+    # Errors are smtplib's exception types (and socket.timeout), so
+    # rate_limiter.reply_code and retry.classify treat them like the
+    # threaded path's. One transaction at a time per connection.
+
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, security=SECURITY_STARTTLS, timeout=30,
+                 tls_context=None, local_hostname=None):
+        self.host = host
+        self.port = port
+        self.security = security
+        self.timeout = timeout
+        # None verifies the server against the system CAs
+        self.tls_context = tls_context
+        self.local_hostname = local_hostname or _local_hostname()
+        # EHLO keywords (lower case) to their parameters
+        self.extensions = {}
+        self.reader = None
+        self.writer = None
+
+    def has_extn(self, name):
+        return name.lower() in self.extensions
+
+    async def _timed(self, awaitable):
+        # The timeout is per server round trip, like smtplib's socket timeout,
+        # so a big message on a slow link isn't cut off as a whole
+        try:
+            if _timeout is None:
+                return await asyncio.wait_for(awaitable, self.timeout)
+            async with _timeout(self.timeout):
+                return await awaitable
+        except asyncio.TimeoutError:
+            self.close()
+            raise socket.timeout('timed out') from None
+
+    async def connect(self):
+        self.close()
+        if self.security in (SECURITY_SSL, SECURITY_STARTTLS) and self.tls_context is None:
+            self.tls_context = ssl.create_default_context()
+        implicit_tls = self.tls_context if self.security == SECURITY_SSL else None
+        # asyncio sets TCP_NODELAY on its TCP sockets already
+        self.reader, self.writer = await self._timed(
+            asyncio.open_connection(self.host, self.port, ssl=implicit_tls, limit=_READ_LIMIT))
+        try:
+            code, message = await self._reply()
+            if code != 220:
+                raise smtplib.SMTPConnectError(code, message)
+            await self.ehlo()
+            if self.security == SECURITY_STARTTLS:
+                await self.starttls()
+        except BaseException:
+            self.close()
+            raise
+
+    async def _read_reply(self):
+        lines = []
+        while True:
+            try:
+                line = await self.reader.readline()
+            except ConnectionError:
+                line = b''
+            if not line:
+                self.close()
+                raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+            lines.append(line[4:].strip(b' \t\r\n'))
+            if line[3:4] != b'-':
+                break
+        try:
+            code = int(line[:3])
+        except ValueError:
+            code = -1
+        return code, b'\n'.join(lines)
+
+    async def _reply(self):
+        return await self._timed(self._read_reply())
+
+    def _write(self, data):
+        if self.writer is None:
+            raise smtplib.SMTPServerDisconnected('please run connect() first')
+        self.writer.write(data)
+
+    async def _drain(self):
+        # Only waits when the transport's buffer is over its high-water mark
+        try:
+            await self._timed(self.writer.drain())
+        except ConnectionError:
+            self.close()
+            raise smtplib.SMTPServerDisconnected('Server not connected') from None
+
+    async def command(self, line):
+        self._write(f'{line}\r\n'.encode('ascii'))
+        return await self._reply()
+
+    async def ehlo(self):
+        code, message = await self.command(f'EHLO {self.local_hostname}')
+        if code != 250:
+            code, message = await self.command(f'HELO {self.local_hostname}')
+            if code != 250:
+                raise smtplib.SMTPHeloError(code, message)
+            self.extensions = {}
+            return
+        extensions = {}
+        # First line is the greeting, then one keyword and its parameters per line
+        for line in message.decode('latin-1').split('\n')[1:]:
+            # Old servers announce AUTH=LOGIN as well, smtplib merges the two
+            if line.upper().startswith('AUTH='):
+                extensions['auth'] = f"{extensions.get('auth', '')} {line[5:]}".strip()
+                continue
+            match = _EXTENSION.match(line)
+            if match is not None:
+                keyword = match.group(1).lower()
+                params = line[match.end():].strip()
+                if keyword == 'auth' and 'auth' in extensions:
+                    params = f"{extensions['auth']} {params}"
+                extensions[keyword] = params
+        self.extensions = extensions
+
+    async def starttls(self):
+        if not self.has_extn('starttls'):
+            raise smtplib.SMTPNotSupportedError("STARTTLS extension not supported by server.")
+        code, message = await self.command('STARTTLS')
+        if code != 220:
+            raise smtplib.SMTPResponseException(code, message)
+        # StreamWriter.start_tls is Python 3.11+
+        await self._timed(self.writer.start_tls(self.tls_context, server_hostname=self.host))
+        # The server forgets what it knew about us, and we about it (RFC 3207)
+        self.extensions = {}
+        await self.ehlo()
+
+    async def login(self, user, password, mechanism=None):
+        if not self.has_extn('auth'):
+            raise smtplib.SMTPNotSupportedError("SMTP AUTH extension not supported by server.")
+        offered = self.extensions['auth'].upper().split()
+        mechanisms = [mechanism.upper()] if mechanism else [name for name in AUTH_MECHANISMS if name in offered]
+        if not mechanisms:
+            raise smtplib.SMTPException("No suitable authentication method found.")
+        if mechanisms[0] == 'PLAIN':
+            token = _b64(f'\0{user}\0{password}')
+            code, message = await self.command(f'AUTH PLAIN {token}')
+        elif mechanisms[0] == 'LOGIN':
+            code, message = await self.command(f'AUTH LOGIN {_b64(user)}')
+            if code == 334:
+                code, message = await self.command(_b64(password))
+        else:
+            raise smtplib.SMTPException(f"Unsupported authentication method {mechanism!r}")
+        # 503: already authenticated
+        if code not in (235, 503):
+            raise smtplib.SMTPAuthenticationError(code, message)
+        return code, message
+
+    async def _reset(self, code):
+        # Same clean-up as mime_builder._reset after a refused transaction
+        if code == 421:
+            self.close()
+            return
+        try:
+            await self.command('RSET')
+        except smtplib.SMTPServerDisconnected:
+            pass
+
+    async def send_wire(self, from_addr, to_addrs, message, eight_bit=False):
+        # mime_builder.send_wire_message: same refusal semantics and return
+        # value (the refused-recipients dict). With PIPELINING, MAIL, every
+        # RCPT and DATA go out in one write (RFC 2920 allows DATA last in a
+        # group), one round trip before the body instead of two. MessageBuilder
+        # output is 7bit (base64 for anything else); `eight_bit` declares
+        # BODY=8BITMIME for other callers' raw 8-bit messages.
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+        options = ''
+        if self.has_extn('size'):
+            options += f' SIZE={message.size}'
+        if eight_bit:
+            if not self.has_extn('8bitmime'):
+                raise smtplib.SMTPNotSupportedError("8BITMIME extension not supported by server.")
+            options += ' BODY=8BITMIME'
+
+        data_started = envelope_started = time.perf_counter()
+        if self.has_extn('pipelining'):
+            commands = [f'MAIL FROM:{smtplib.quoteaddr(from_addr)}{options}\r\n']
+            commands.extend(f'RCPT TO:{smtplib.quoteaddr(addr)}\r\n' for addr in to_addrs)
+            commands.append('DATA\r\n')
+            self._write(''.join(commands).encode('ascii'))
+            code, response = mail_reply = await self._reply()
+            if code == 421:
+                # The server is closing the connection, no more replies are coming
+                self.close()
+                raise smtplib.SMTPSenderRefused(code, response, from_addr)
+            rcpt_replies = [await self._reply() for _ in to_addrs]
+            data_reply = await self._reply()
+        else:
+            code, response = mail_reply = await self.command(f'MAIL FROM:{smtplib.quoteaddr(from_addr)}{options}')
+            rcpt_replies = []
+            if code == 250:
+                for addr in to_addrs:
+                    rcpt_replies.append(await self.command(f'RCPT TO:{smtplib.quoteaddr(addr)}'))
+            data_reply = None
+        metrics.observe('envelope', time.perf_counter() - envelope_started)
+
+        refused = {}
+        for addr, (code, response) in zip(to_addrs, rcpt_replies):
+            if code not in (250, 251):
+                refused[addr] = (code, response)
+        if mail_reply[0] != 250 or len(refused) == len(to_addrs):
+            if data_reply is not None and data_reply[0] == 354:
+                # A server that accepted the pipelined DATA anyway gets an
+                # empty message ended right away
+                self._write(b'.\r\n')
+                await self._reply()
+            await self._reset(mail_reply[0])
+            if mail_reply[0] != 250:
+                raise smtplib.SMTPSenderRefused(mail_reply[0], mail_reply[1], from_addr)
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        if data_reply is None:
+            data_started = time.perf_counter()
+            data_reply = await self.command('DATA')
+        if data_reply[0] != 354:
+            await self._reset(data_reply[0])
+            raise smtplib.SMTPDataError(*data_reply)
+        serialize_started = time.perf_counter()
+        # Segments are dot-stuffed already; the transport buffers them and
+        # drain() only waits while that buffer is over its limit
+        segments = message.segments
+        for segment in segments:
+            self._write(segment)
+            if len(segment) >= _READ_LIMIT:
+                await self._drain()
+        last = segments[-1] if segments else b''
+        self._write(b'.\r\n' if last[-2:] == b'\r\n' else b'\r\n.\r\n')
+        await self._drain()
+        metrics.observe('serialize', time.perf_counter() - serialize_started)
+        code, response = await self._reply()
+        # DATA command through the server's final reply
+        metrics.observe('data', time.perf_counter() - data_started)
+        if code != 250:
+            await self._reset(code)
+            raise smtplib.SMTPDataError(code, response)
+        return refused
+
+    async def quit(self):
+        try:
+            await self.command('QUIT')
+        finally:
+            self.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+class AsyncSMTPSession:
+    # smtp_pool.SMTPSession on asyncio: one authenticated connection reused
+    # for many messages, recycled after max_messages and re-established when
+    # the server drops it
+
+    def __init__(self, sender_email, sender_password, host=SMTP_HOST, port=SMTP_PORT,
+                 max_messages=MAX_MESSAGES_PER_CONNECTION, timeout=30, security=SECURITY_STARTTLS, login=True,
+                 tls_context=None):
+        self.sender_email = sender_email
+        self.sender_password = sender_password
+        self.host = host
+        self.port = port
+        self.security = security
+        self.login = login
+        self.max_messages = max_messages
+        self.timeout = timeout
+        self.tls_context = tls_context
+        self.client = None
+        self.messages_sent = 0
+
+    async def connect(self):
+        await self.close()
+        metrics.increment('connections')
+        client = AsyncSMTP(self.host, self.port, self.security, self.timeout, self.tls_context)
+        # TCP connect, greeting and TLS handshake
+        with metrics.timer('connect'):
+            await client.connect()
+        try:
+            if self.login:
+                with metrics.timer('login'):
+                    await client.login(self.sender_email, self.sender_password)
+        except BaseException:
+            client.close()
+            raise
+        self.client = client
+        self.messages_sent = 0
+
+    async def close(self):
+        if self.client is None:
+            return
+        client, self.client = self.client, None
+        try:
+            await client.quit()
+        except (smtplib.SMTPException, OSError):
+            client.close()
+
+    async def send_wire(self, from_addr, to_addrs, message):
+        if self.client is None or self.client.writer is None or self.messages_sent >= self.max_messages:
+            await self.connect()
+        try:
+            result = await self.client.send_wire(from_addr, to_addrs, message)
+        except smtplib.SMTPServerDisconnected:
+            # The server closed an idle or exhausted connection, retry once on a fresh one
+            metrics.increment('reconnects')
+            await self.connect()
+            result = await self.client.send_wire(from_addr, to_addrs, message)
+        self.messages_sent += 1
+        return result
+
+
+class AsyncSMTPPool:
+    # smtp_pool.SMTPPool for coroutines: up to `size` sessions, created (and
+    # connected) on first use and handed out most recently used first.
+    # Create it anywhere, use it from one event loop.
+
+    def __init__(self, sender_email, sender_password, size=1, session_class=AsyncSMTPSession, **session_options):
+        self.sender_email = sender_email
+        self.sender_password = sender_password
+        self.size = size
+        self.session_class = session_class
+        self.session_options = session_options
+        self._idle = None
+        self._created = 0
+        self._sessions = []
+
+    async def acquire(self):
+        if self._idle is None:
+            # Made here so it belongs to the running loop
+            self._idle = asyncio.LifoQueue()
+        if self._idle.empty() and self._created < self.size:
+            self._created += 1
+            session = self.session_class(self.sender_email, self.sender_password, **self.session_options)
+            self._sessions.append(session)
+            return session
+        return await self._idle.get()
+
+    def release(self, session):
+        self._idle.put_nowait(session)
+
+    @asynccontextmanager
+    async def session(self):
+        session = await self.acquire()
+        try:
+            yield session
+        finally:
+            self.release(session)
+
+    async def send_wire(self, from_addr, to_addrs, message):
+        async with self.session() as session:
+            return await session.send_wire(from_addr, to_addrs, message)
+
+    async def close(self):
+        await asyncio.gather(*(session.close() for session in self._sessions), return_exceptions=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
@@ -0,0 +1,205 @@
+import base64
+import hashlib
+import mmap
+import os
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+from email.utils import encode_rfc2231
+
+# In-memory budget for encoded attachments kept around between sends
+DEFAULT_MEMORY_LIMIT = 64 * 1024 * 1024
+# Encoded parts bigger than this live in a memory-mapped temp file instead
+DEFAULT_SPILL_THRESHOLD = 4 * 1024 * 1024
+# Disk budget and file count for the spilled ones
+DEFAULT_SPILL_LIMIT = 1024 * 1024 * 1024
+DEFAULT_MAX_SPILLED = 16
+
+# 57 raw bytes encode to exactly one 76 character base64 line
+_LINE_BYTES = 57
+_CHUNK_BYTES = _LINE_BYTES * 4096
+_READ_SIZE = 1024 * 1024
+
+
+def _content_disposition(filename):
+    try:
+        filename.encode('ascii')
+        return f'attachment; filename="{filename}"'
+    except UnicodeEncodeError:
+        return f"attachment; filename*={encode_rfc2231(filename, 'utf-8')}"
+
+
+def _iter_source(source):
+    # Raw bytes, a path or any binary file object
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        yield bytes(source)
+        return
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            yield from iter(lambda: f.read(_READ_SIZE), b'')
+        return
+    source.seek(0)
+    yield from iter(lambda: source.read(_READ_SIZE), b'')
+    source.seek(0)
+
+
+def _encode_lines(chunk):
+    encoded = base64.b64encode(chunk)
+    return b''.join(encoded[i:i + 76] + b'\r\n' for i in range(0, len(encoded), 76))
+
+
+class EncodedAttachment:
+    # One attachment, base64 encoded and wrapped exactly once. `headers` and
+    # `body` are the wire bytes of the MIME part (CRLF line endings) and never
+    # change, so every message of a campaign can share them.
+
+    def __init__(self, filename, digest, raw_size, headers, body, spill_file=None):
+        self.filename = filename
+        self.digest = digest
+        self.raw_size = raw_size
+        self.headers = headers
+        self.body = body
+        self._spill_file = spill_file
+
+    @property
+    def spilled(self):
+        return self._spill_file is not None
+
+    @property
+    def encoded_size(self):
+        return len(self.headers) + len(self.body)
+
+    def close(self):
+        if self._spill_file is not None:
+            self.body.close()
+            self._spill_file.close()
+
+
+class AttachmentCache:
+    # Content-addressed, so the same file uploaded again (test email, then the
+    # bulk send, then a resend) is only encoded once. Entries are evicted
+    # least recently used to stay under `memory_limit`, and spilled ones under
+    # `spill_limit` bytes and `max_spilled` files. Eviction only drops the
+    # cache's reference: builders and cached messages of a running campaign
+    # keep the body, and a spilled one is unmapped and its temp file deleted
+    # once the last of them lets go.
+
+    def __init__(self, memory_limit=DEFAULT_MEMORY_LIMIT, spill_threshold=DEFAULT_SPILL_THRESHOLD,
+                 spill_limit=DEFAULT_SPILL_LIMIT, max_spilled=DEFAULT_MAX_SPILLED):
+        self.memory_limit = memory_limit
+        self.spill_threshold = spill_threshold
+        self.spill_limit = spill_limit
+        self.max_spilled = max_spilled
+        self.memory_used = 0
+        self.spill_used = 0
+        self.spilled_count = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, source, filename):
+        if hasattr(source, 'getvalue'):
+            # Streamlit UploadedFile already holds the bytes in memory
+            source = source.getvalue()
+        hasher = hashlib.sha256()
+        for chunk in _iter_source(source):
+            hasher.update(chunk)
+        key = (filename, hasher.hexdigest())
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+
+        entry = self._encode(source, filename, key[1])
+        with self._lock:
+            existing = self._entries.get(key)
+            if existing is not None:
+                entry.close()
+                return existing
+            self._entries[key] = entry
+            if entry.spilled:
+                self.spill_used += entry.encoded_size
+                self.spilled_count += 1
+            else:
+                self.memory_used += entry.encoded_size
+            self._evict()
+        return entry
+
+    def encode_all(self, files):
+        # Encode a list of uploaded files (anything with .name) once per campaign
+        return [self.get(file, os.path.basename(file.name)) for file in files or []]
+
+    def _encode(self, source, filename, digest):
+        headers = (
+            'Content-Type: application/octet-stream\r\n'
+            'MIME-Version: 1.0\r\n'
+            'Content-Transfer-Encoding: base64\r\n'
+            f'Content-Disposition: {_content_disposition(filename)}\r\n'
+            '\r\n'
+        ).encode('utf-8')
+
+        raw_size = 0
+        buffer = []
+        buffered = 0
+        pending = b''
+        spill_file = None
+        for chunk in _iter_source(source):
+            raw_size += len(chunk)
+            data = pending + chunk
+            cut = len(data) - len(data) % _LINE_BYTES
+            pending = data[cut:]
+            for start in range(0, cut, _CHUNK_BYTES):
+                encoded = _encode_lines(data[start:min(cut, start + _CHUNK_BYTES)])
+                if spill_file is not None:
+                    spill_file.write(encoded)
+                    continue
+                buffer.append(encoded)
+                buffered += len(encoded)
+                if buffered > self.spill_threshold:
+                    # Too big to keep in memory, move what we have to disk
+                    spill_file = tempfile.TemporaryFile(prefix='kuki_attachment_')
+                    spill_file.writelines(buffer)
+                    buffer = []
+        tail = _encode_lines(pending) if pending else b''
+
+        if spill_file is None:
+            body = b''.join(buffer) + tail
+        else:
+            spill_file.write(tail)
+            spill_file.flush()
+            body = mmap.mmap(spill_file.fileno(), 0, access=mmap.ACCESS_READ)
+            # The temp file lives as long as the mapping, whoever holds it
+            weakref.finalize(body, spill_file.close)
+        return EncodedAttachment(filename, digest, raw_size, headers, body, spill_file)
+
+    def _evict(self):
+        # The newest entry is never evicted, even when it alone is over budget
+        for key in list(self._entries)[:-1]:
+            over_spill = self.spill_used > self.spill_limit or self.spilled_count > self.max_spilled
+            if self.memory_used <= self.memory_limit and not over_spill:
+                break
+            entry = self._entries[key]
+            if entry.spilled:
+                if not over_spill:
+                    continue
+                del self._entries[key]
+                self.spill_used -= entry.encoded_size
+                self.spilled_count -= 1
+            elif self.memory_used > self.memory_limit:
+                del self._entries[key]
+                self.memory_used -= entry.encoded_size
+
+    def clear(self):
+        # Entries still referenced by a running campaign stay valid, the temp
+        # files behind spilled ones go away once they are garbage collected
+        with self._lock:
+            self._entries.clear()
+            self.memory_used = 0
+            self.spill_used = 0
+            self.spilled_count = 0
+
+
+# Shared by the Streamlit apps so reruns reuse the encoded files
+attachment_cache = AttachmentCache()
@@ -0,0 +1,358 @@
+from .accounts import AccountPool, LEAST_LOADED
+from .attachments import attachment_cache
+from .journal import SendJournal
+from .html_normalizer import normalize_html
+from .layouts import SIMPLE, RICH, SIMPLE_TEST_LAYOUT, SIMPLE_BULK_LAYOUT, RICH_BULK_LAYOUT
+from .mime_builder import MessageBuilder, MAX_RECIPIENTS_PER_ENVELOPE, UNDISCLOSED_RECIPIENTS
+from .rate_limiter import RateLimiter, reply_code
+from .retry import RetryPolicy, DeadLetters, FATAL, classify
+from .send_engine import SendEngine, AsyncSendEngine, DEFAULT_CONCURRENCY, batched, split_batch_result
+from .shards import run_local
+from .render_cache import render_cache, content_key, MessageVariants
+from .suppression import shared_index
+from .templating import RenderPlan, compile_jinja, compile_layout, compile_placeholders
+from .transports import get_transport
+
+DEFAULT_GREETING = "Hi {{ name }},"
+
+BODY_PLACEHOLDERS = {"{{ starting_line }}": "starting_line", "{{ name }}": "name"}
+# The text/plain part of rich emails: greeting, then the body's plain text version
+PLAIN_TEXT_LAYOUT = compile_placeholders("{greeting}\n\n{content}\n", {"{greeting}": "greeting", "{content}": "content"})
+# Delivered addresses go to the suppression index's history in batches
+MAILED_FLUSH_SIZE = 1000
+# SMTP sessions of an asyncio send. Each is a socket and a coroutine, not a
+# thread, so the relay's connection limit is what bounds it (Gmail allows
+# send_engine.MAX_CONCURRENCY per account)
+DEFAULT_ASYNC_CONCURRENCY = 100
+
+
+def clean_content(content):
+    # Quill paragraphs as <br> lines, sanitized, Quill classes inlined; see
+    # html_normalizer.normalize_html. Cached, so once per campaign.
+    return normalize_html(content, collapse_paragraphs=True).html
+
+
+def send_test_email(sender_email, sender_password, subject, content, attachments, pool=None):
+    try:
+        # Create message, attachments are encoded once and reused by the bulk
+        # send; clicking again with the same content reuses the built message
+        builder = MessageBuilder(sender_email, attachment_cache.encode_all(attachments))
+        message = render_cache.message(compile_test_plan(content), {}, builder, sender_email, persist=True)
+        
+        # Send email
+        if pool is None:
+            with get_transport().pool(sender_email, sender_password) as test_pool:
+                test_pool.send_wire(sender_email, sender_email, message)
+        else:
+            pool.send_wire(sender_email, sender_email, message)
+        
+        return True, "Test email sent successfully!"
+    except Exception as e:
+        return False, f"Error sending test email: {str(e)}"
+
+
+async def send_test_email_async(sender_email, sender_password, subject, content, attachments, pool=None):
+    # send_test_email for coroutines, over an async pool (transports' async_pool)
+    try:
+        builder = MessageBuilder(sender_email, attachment_cache.encode_all(attachments))
+        message = render_cache.message(compile_test_plan(content), {}, builder, sender_email, persist=True)
+        if pool is None:
+            async with get_transport().async_pool(sender_email, sender_password) as test_pool:
+                await test_pool.send_wire(sender_email, sender_email, message)
+        else:
+            await pool.send_wire(sender_email, sender_email, message)
+        return True, "Test email sent successfully!"
+    except Exception as e:
+        return False, f"Error sending test email: {str(e)}"
+
+
+def compile_test_plan(content):
+    # The simple UI's test email: cleaned content in the test layout, no placeholders
+    normalized = normalize_html(content, collapse_paragraphs=True)
+    return RenderPlan(
+        subject=compile_placeholders("Test Email", {}),
+        html=compile_layout(SIMPLE_TEST_LAYOUT).embed(content=compile_placeholders(normalized.html, {})),
+        text=compile_placeholders(normalized.text, {}),
+        key=content_key('test', content, SIMPLE_TEST_LAYOUT),
+    )
+
+
+def compile_bulk_plan(subject_template, content):
+    # Clean the body and split out the {name} slots once per campaign. The
+    # text/plain part is converted from the same HTML here, recipients only
+    # get their slots filled in, in both parts.
+    placeholders = {'{name}': 'name'}
+    normalized = normalize_html(content, collapse_paragraphs=True)
+    return RenderPlan(
+        subject=compile_placeholders(subject_template, placeholders),
+        html=compile_layout(SIMPLE_BULK_LAYOUT).embed(content=compile_placeholders(normalized.html, placeholders)),
+        text=compile_placeholders(normalized.text, placeholders),
+        key=content_key(SIMPLE, subject_template, content, SIMPLE_BULK_LAYOUT),
+    )
+
+
+def compile_rich_plan(subject, greeting_line, editor_content, layout=RICH_BULK_LAYOUT):
+    # Jinja subject and greeting, {{ name }} / {{ starting_line }} in the body,
+    # plus a plain text part (greeting and the whole body as text), as
+    # written in email_sender_res.py
+    greeting = compile_jinja(greeting_line)
+    normalized = normalize_html(editor_content)
+    return RenderPlan(
+        subject=compile_jinja(subject),
+        html=compile_layout(layout).embed(greeting=greeting,
+                                          content=compile_placeholders(normalized.html, BODY_PLACEHOLDERS)),
+        text=PLAIN_TEXT_LAYOUT.embed(greeting=greeting,
+                                     content=compile_placeholders(normalized.text, BODY_PLACEHOLDERS)),
+        key=content_key(RICH, subject, greeting_line, editor_content, layout),
+    )
+
+
+def campaign_plan(subject, content, layout=SIMPLE, greeting=None):
+    # The render plan of either front end's templates, for headless sends
+    if layout == RICH:
+        return compile_rich_plan(subject, greeting or DEFAULT_GREETING, content)
+    if layout == SIMPLE:
+        return compile_bulk_plan(subject, content)
+    raise ValueError(f"Unknown layout {layout!r}, expected {SIMPLE} or {RICH}")
+
+
+class _CampaignResults:
+    # What a campaign's send loop does around the sending, shared by the
+    # threaded and the asyncio one: which rows still need a message, and
+    # what each final result means for the journal, the suppression index,
+    # dead letters and the progress/error callbacks
+
+    def __init__(self, recipients, journal=None, suppressions=None, skip_mailed=False, on_progress=None,
+                 on_error=None, dead_letters=None):
+        self.recipients = recipients
+        self.journal = journal
+        self.suppressions = suppressions
+        self.on_progress = on_progress
+        self.on_error = on_error
+        self.dead_letters = dead_letters
+        self.total = len(recipients)
+        self.campaign = journal.campaign if journal is not None else None
+        self.is_suppressed = suppressions.checker(skip_mailed, self.campaign) if suppressions is not None else None
+        self.mailed = []
+        # Rows a previous (interrupted) run of this campaign already delivered
+        self.done_rows = journal.completed_rows() if journal is not None else set()
+        self.sent = len(self.done_rows)
+
+    def pending(self):
+        # Skips rows sent before a crash/rerun; runs on the engine's producer
+        for recipient in self.recipients:
+            if recipient.row in self.done_rows:
+                continue
+            # Usually already left out by skip_rows, this catches what was
+            # suppressed since (an unsubscribe, a bounce earlier in this run)
+            if self.is_suppressed is not None and self.is_suppressed(recipient.email):
+                self.total -= 1
+                continue
+            if self.journal is not None:
+                self.journal.queued(recipient.row, recipient.email)
+            yield recipient
+
+    def handle(self, result):
+        recipient = result.item
+        if result.ok:
+            self.sent += 1
+            if self.journal is not None:
+                self.journal.sent(recipient.row, recipient.email)
+            if self.suppressions is not None and self.campaign is not None:
+                self.mailed.append(recipient.email)
+                if len(self.mailed) >= MAILED_FLUSH_SIZE:
+                    self.flush()
+        else:
+            if classify(result.error) == FATAL:
+                # Nothing to do with this recipient, and the next row would
+                # log in again: the engine cancels the run and this reaches
+                # the caller, the row stays queued in the journal
+                raise result.error
+            # Final: permanent, or still failing after every retry
+            if self.on_error is not None:
+                self.on_error(recipient, result.error)
+            if self.dead_letters is not None:
+                self.dead_letters.add(recipient.row, recipient.email, result.error, result.attempts)
+            if self.journal is not None:
+                self.journal.failed(recipient.row, recipient.email, reply_code(result.error), str(result.error))
+            if self.suppressions is not None:
+                self.suppressions.add_bounce(recipient.email, result.error)
+        self.progress()
+
+    def progress(self):
+        if self.on_progress is not None:
+            self.on_progress(self.sent, self.total)
+
+    def flush(self):
+        # Delivered addresses into the suppression index's history
+        if self.mailed:
+            self.suppressions.record_mailed(self.campaign, self.mailed)
+            self.mailed.clear()
+
+
+def send_bulk_emails(recipients, sender_email, sender_password, subject_template, content, attachments,
+                     pool=None, concurrency=DEFAULT_CONCURRENCY, on_progress=None, on_error=None, limiter=None,
+                     journal=None, cancel_event=None, retry=None, dead_letters=None, accounts=None,
+                     strategy=LEAST_LOADED, plan=None, suppressions=None, skip_mailed=False):
+    # With `accounts` (SenderAccount list) the campaign is sharded across them:
+    # each account gets its own connections and rate limiter and every message
+    # goes out From the account picked for it. A compiled `plan` (see
+    # campaign_plan) replaces subject_template/content. With `suppressions`
+    # (a SuppressionIndex) suppressed addresses are skipped, hard bounces are
+    # added to it and delivered addresses recorded against the journal's
+    # campaign; `skip_mailed` also skips anyone other campaigns reached.
+    results = _CampaignResults(recipients, journal, suppressions, skip_mailed, on_progress, on_error, dead_letters)
+    # Reuse authenticated connections for the whole campaign
+    owns_pool = pool is None
+    if accounts:
+        pool = AccountPool(accounts, get_transport(), strategy)
+        concurrency = pool.size
+        owns_pool = True
+    elif owns_pool:
+        pool = get_transport().pool(sender_email, sender_password, size=concurrency)
+    
+    # Templates and attachments are prepared once, workers only fill in the slots
+    if plan is None:
+        plan = compile_bulk_plan(subject_template, content)
+    encoded_attachments = attachment_cache.encode_all(attachments)
+    senders = [account.email for account in accounts] if accounts else [sender_email]
+    builders = {sender: MessageBuilder(sender, encoded_attachments) for sender in senders}
+    # Variables the file has no column for render empty for everyone, so only
+    # a column actually used by the templates makes messages differ
+    variables = plan.variables & set(recipients.columns)
+    # One render per distinct tuple of those values (and account)
+    variants = {sender: MessageVariants(plan, builder, variables) for sender, builder in builders.items()}
+    
+    # Runs on the worker threads, each with its own connection
+    def send_row(session, recipient):
+        sender = session.select().email if accounts else sender_email
+        session.send_wire(sender, recipient.email, variants[sender].message(recipient))
+    
+    personalized = bool(variables)
+    # Nothing personalized: build the message once (per account) and send it
+    # to up to MAX_RECIPIENTS_PER_ENVELOPE recipients per transaction, BCC style
+    if not personalized:
+        shared_messages = {
+            sender: render_cache.message(plan, {}, builder, UNDISCLOSED_RECIPIENTS, persist=True)
+            for sender, builder in builders.items()
+        }
+    
+    def send_batch(session, batch):
+        sender = session.select(len(batch)).email if accounts else sender_email
+        return session.send_wire(sender, [recipient.email for recipient in batch], shared_messages[sender])
+    
+    # Runs on the calling thread as results come back from the workers
+    def handle_batch_result(result):
+        for recipient_result in split_batch_result(result):
+            # Recipients refused with a 4xx are retried on their own later
+            if not recipient_result.ok and engine.requeue([recipient_result.item], recipient_result.attempts,
+                                                          recipient_result.error):
+                continue
+            results.handle(recipient_result)
+    
+    results.progress()
+    
+    try:
+        # One limiter shared by all workers keeps us under the account quotas,
+        # sharded sends use each account's own limiter instead
+        if accounts:
+            limiter = None
+        elif limiter is None:
+            limiter = RateLimiter()
+        # The engine's producer thread parses the file while the workers send
+        engine = SendEngine(pool, concurrency, limiter=limiter, cancel_event=cancel_event, retry=retry)
+        if personalized:
+            engine.run(results.pending(), send_row, results.handle)
+        else:
+            engine.run(batched(results.pending(), MAX_RECIPIENTS_PER_ENVELOPE), send_batch,
+                       handle_batch_result, weight=len)
+    finally:
+        if owns_pool:
+            pool.close()
+        results.flush()
+    return results.sent
+
+
+async def send_bulk_emails_async(recipients, sender_email, sender_password, subject_template, content, attachments,
+                                 pool=None, concurrency=DEFAULT_ASYNC_CONCURRENCY, on_progress=None, on_error=None,
+                                 limiter=None, journal=None, cancel_event=None, retry=None, dead_letters=None,
+                                 plan=None, suppressions=None, skip_mailed=False):
+    # send_bulk_emails on an asyncio event loop: `concurrency` SMTP sessions
+    # from an async pool (transports' async_pool, async_smtp.AsyncSMTPPool)
+    # driven by AsyncSendEngine, hundreds of them on one thread. Same
+    # journal, suppression, retry and callback handling; callbacks run on the
+    # loop. One sender, no `accounts` sharding.
+    results = _CampaignResults(recipients, journal, suppressions, skip_mailed, on_progress, on_error, dead_letters)
+    owns_pool = pool is None
+    if owns_pool:
+        pool = get_transport().async_pool(sender_email, sender_password, size=concurrency)
+    if plan is None:
+        plan = compile_bulk_plan(subject_template, content)
+    builder = MessageBuilder(sender_email, attachment_cache.encode_all(attachments))
+    variables = plan.variables & set(recipients.columns)
+    
+    if variables:
+        variants = MessageVariants(plan, builder, variables)
+        
+        async def send_one(session, recipient):
+            return await session.send_wire(sender_email, recipient.email, variants.message(recipient))
+    else:
+        shared_message = render_cache.message(plan, {}, builder, UNDISCLOSED_RECIPIENTS, persist=True)
+        
+        async def send_one(session, batch):
+            return await session.send_wire(sender_email, [recipient.email for recipient in batch], shared_message)
+    
+    def handle_batch_result(result):
+        for recipient_result in split_batch_result(result):
+            if not recipient_result.ok and engine.requeue([recipient_result.item], recipient_result.attempts,
+                                                          recipient_result.error):
+                continue
+            results.handle(recipient_result)
+    
+    results.progress()
+    
+    try:
+        if limiter is None:
+            limiter = RateLimiter()
+        engine = AsyncSendEngine(pool, concurrency, limiter=limiter, cancel_event=cancel_event, retry=retry)
+        if variables:
+            await engine.run(results.pending(), send_one, results.handle)
+        else:
+            await engine.run(batched(results.pending(), MAX_RECIPIENTS_PER_ENVELOPE), send_one,
+                             handle_batch_result, weight=len)
+    finally:
+        if owns_pool:
+            await pool.close()
+        results.flush()
+    return results.sent
+
+
+def run_bulk_job(job, recipients, sender_email, sender_password, subject_template, content, attachments,
+                 concurrency, limiter, campaign, accounts=None, strategy=LEAST_LOADED, skip_mailed=False):
+    # Runs on a job runner thread: no Streamlit calls in here, the page
+    # reads progress and errors off the job
+    def report_error(recipient, error):
+        job.add_error(f"Error sending email to {recipient.email}: {str(error)}")
+    
+    # 4xx blips are retried with backoff, what still fails is exported from the panel
+    job.dead_letters = DeadLetters(campaign)
+    with SendJournal(campaign) as journal:
+        return send_bulk_emails(
+            recipients, sender_email, sender_password, subject_template, content, attachments,
+            concurrency=concurrency, limiter=limiter, journal=journal,
+            on_progress=job.set_progress, on_error=report_error, cancel_event=job.cancel_event,
+            retry=RetryPolicy(), dead_letters=job.dead_letters, accounts=accounts, strategy=strategy,
+            suppressions=shared_index(), skip_mailed=skip_mailed
+        )
+
+
+def run_sharded_job(job, campaign, sender_password):
+    # Coordinator on a job runner thread: every shard sends in its own worker
+    # process, the merged shard status is copied onto the job for the panel
+    def update(status):
+        job.set_progress(status.sent, status.total)
+        job.failed = status.failed
+    
+    status = run_local(campaign, sender_password, on_status=update, cancel_event=job.cancel_event)
+    update(status)
+    return status.sent
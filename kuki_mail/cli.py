@@ -0,0 +1,330 @@
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime, time as dt_time
+
+from .layouts import SIMPLE, LAYOUTS
+from .rate_limiter import DEFAULT_PER_SECOND
+from .scheduler import (ACTIVE, PAUSED, CANCELLED, SENT, FAILED, SKIPPED, DEFAULT_SPREAD, DEFAULT_TIMEZONE,
+                        schedule_campaign, shared_scheduler)
+from .send_engine import DEFAULT_CONCURRENCY
+from .suppression import MANUAL, REASONS, SuppressionIndex, read_addresses
+from .jobs import owner_token
+from . import shards
+
+# The app password never goes on the command line (shell history, ps)
+PASSWORD_ENV = 'KUKI_MAIL_PASSWORD'
+# Config keys holding file names, resolved relative to the config file
+_CONFIG_PATHS = ('recipients', 'content', 'attach')
+
+
+def format_status(status):
+    lines = [f"{status.name} [{status.campaign}] {status.state}: "
+             f"{status.sent} sent, {status.failed} failed of {status.total}, {status.throughput:.1f}/s"
+             + (f", {status.suppressed} suppressed" if status.suppressed else "")]
+    for shard in status.shards:
+        where = f" on {shard['host']} (pid {shard['pid']})" if shard.get('host') else ""
+        error = f" - {shard['error']}" if shard.get('error') else ""
+        lines.append(f"  shard {shard['index']}: {shard['state']}, {shard['sent']} sent, "
+                     f"{shard['failed']} failed of {'?' if shard.get('total') is None else shard['total']}{where}{error}")
+    return '\n'.join(lines)
+
+
+def _password():
+    password = os.getenv(PASSWORD_ENV)
+    if not password:
+        sys.exit(f"Set {PASSWORD_ENV} to the sender's app password")
+    return password
+
+
+def _read_text(path):
+    with open(path, encoding='utf-8') as f:
+        return f.read()
+
+
+def _print_progress(status):
+    print(f"{status.state}: {status.sent + status.failed}/{status.total} "
+          f"({status.failed} failed, {status.throughput:.1f}/s)", flush=True)
+
+
+def _run(campaign, password, args):
+    started = time.time()
+    status = shards.run_local(campaign, password, shards=args.shard, processes=args.processes,
+                              on_status=_print_progress)
+    print(format_status(status))
+    print(f"Finished in {time.time() - started:.1f}s")
+    return 0
+
+
+def load_config(path):
+    # JSON object with the `send` options as keys, e.g.
+    # {"sender": "...", "subject": "Hi {name}", "content": "body.html", "shards": 4}
+    with open(path, encoding='utf-8') as f:
+        config = json.load(f)
+    if not isinstance(config, dict):
+        raise ValueError(f"{path}: expected a JSON object")
+    base = os.path.dirname(os.path.abspath(path))
+    config = {key.replace('-', '_'): value for key, value in config.items()}
+    for key in _CONFIG_PATHS:
+        if isinstance(config.get(key), str):
+            config[key] = os.path.join(base, config[key])
+        elif isinstance(config.get(key), list):
+            config[key] = [os.path.join(base, value) for value in config[key]]
+    return config
+
+
+def cmd_send(args):
+    missing = [option for option in ('recipients', 'sender', 'subject', 'content') if not getattr(args, option)]
+    if missing:
+        raise ValueError(f"Missing {', '.join(missing)} (give them as options or in --config)")
+    password = None if args.prepare_only else _password()
+    campaign = shards.prepare_campaign(
+        args.recipients, args.sender, args.subject, _read_text(args.content), args.attach, shards=args.shards,
+        name=args.name, concurrency=args.concurrency, per_second=args.per_second or None,
+        per_minute=args.per_minute or None, per_day=args.per_day or None,
+        check_deliverability=not args.no_dns_check, layout=args.layout, greeting=args.greeting,
+        skip_mailed=args.skip_mailed, use_asyncio=args.asyncio, owner=owner_token(args.sender, password),
+    )
+    print(f"Campaign {campaign} ({args.shards} shards)", flush=True)
+    if args.prepare_only:
+        return 0
+    return _run(campaign, password, args)
+
+
+def cmd_work(args):
+    # Another machine (sharing KUKI_MAIL_DATA_DIR) takes some of the shards
+    return _run(args.campaign, _password(), args)
+
+
+def cmd_status(args):
+    statuses = [shards.read_campaign(args.campaign)] if args.campaign else shards.list_campaigns()
+    for status in statuses:
+        print(format_status(status))
+    if not statuses:
+        print("No sharded campaigns")
+    return 0
+
+
+def cmd_cancel(args):
+    queue = shared_scheduler().queue
+    if queue.exists(args.campaign):
+        queue.set_state(args.campaign, CANCELLED)
+        print(f"Cancelled the pending messages of {args.campaign}")
+        return 0
+    shards.cancel_campaign(args.campaign)
+    print(f"Cancel requested for {args.campaign}")
+    return 0
+
+
+def _timestamp(value):
+    # ISO date/time, local time unless it names an offset
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not an ISO date/time: {value!r}") from None
+
+
+def _local_time(value):
+    try:
+        return dt_time.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not a HH:MM time: {value!r}") from None
+
+
+def format_schedule(summary):
+    counts = summary['counts']
+    done = sum(counts.get(state, 0) for state in (SENT, FAILED, SKIPPED, CANCELLED))
+    next_due = (datetime.fromtimestamp(summary['next_due']).strftime('%Y-%m-%d %H:%M')
+                if summary['next_due'] else '-')
+    parts = ', '.join(f"{count} {state}" for state, count in sorted(counts.items()))
+    return (f"{summary['name']} [{summary['id']}] {summary['state']}: {summary['steps']} step(s), "
+            f"{done}/{sum(counts.values())} done ({parts}), next {next_due}")
+
+
+def cmd_schedule(args):
+    missing = [option for option in ('recipients', 'sender', 'subject', 'content') if not getattr(args, option)]
+    if missing:
+        raise ValueError(f"Missing {', '.join(missing)} (give them as options or in --config)")
+    steps = [{'subject': args.subject, 'content': _read_text(args.content), 'delay': 0}]
+    for days, subject, content in args.follow_up:
+        steps.append({'subject': subject, 'content': _read_text(content), 'delay': float(days) * 86400})
+    campaign = schedule_campaign(
+        args.recipients, args.sender, steps, args.attach, name=args.name, start=args.start, end=args.end,
+        local_time=args.local_time, spread=args.spread_minutes * 60, default_timezone=args.default_timezone,
+        layout=args.layout, greeting=args.greeting, concurrency=args.concurrency,
+        per_second=args.per_second or None, per_minute=args.per_minute or None, per_day=args.per_day or None,
+        check_deliverability=not args.no_dns_check,
+    )
+    print(f"Scheduled {campaign}; run `python -m kuki_mail scheduler --sender {args.sender}` to send it")
+    return 0
+
+
+def cmd_scheduler(args):
+    scheduler = shared_scheduler()
+    password = _password()
+    for sender in args.sender:
+        scheduler.add_password(sender, password)
+    try:
+        while True:
+            for summary in scheduler.queue.summaries():
+                if summary['sender_email'] in args.sender and summary['state'] == ACTIVE:
+                    print(format_schedule(summary), flush=True)
+            if scheduler.last_error:
+                print(f"Error: {scheduler.last_error}", flush=True)
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        scheduler.stop()
+    return 0
+
+
+def cmd_schedules(args):
+    summaries = shared_scheduler().queue.summaries()
+    for summary in summaries:
+        print(format_schedule(summary))
+    if not summaries:
+        print("No scheduled campaigns")
+    return 0
+
+
+def cmd_schedule_state(args):
+    queue = shared_scheduler().queue
+    if not queue.exists(args.campaign):
+        raise ValueError(f"No scheduled campaign {args.campaign!r}")
+    queue.set_state(args.campaign, PAUSED if args.state == 'pause' else ACTIVE)
+    print(f"{args.campaign} {'paused' if args.state == 'pause' else 'resumed'}")
+    return 0
+
+
+def cmd_suppress(args):
+    started = time.time()
+    with SuppressionIndex() as index:
+        for path in args.files:
+            if args.remove:
+                print(f"{path}: {index.remove(read_addresses(path))} removed", flush=True)
+            else:
+                print(f"{path}: {index.add(read_addresses(path), args.reason)} added", flush=True)
+        counts = ', '.join(f"{count} {reason}" for reason, count in sorted(index.counts().items()))
+        print(f"{len(index)} suppressed ({counts or 'none'}) in {time.time() - started:.1f}s")
+    return 0
+
+
+def build_parser(config=None):
+    parser = argparse.ArgumentParser(prog='python -m kuki_mail',
+                                     description="Send Kuki_mail campaigns without the Streamlit UI")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_options = argparse.ArgumentParser(add_help=False)
+    run_options.add_argument('--processes', type=int, help="Worker processes on this machine (default: one per shard)")
+
+    # What a campaign is, shared by `send` and `schedule`
+    campaign_options = argparse.ArgumentParser(add_help=False)
+    campaign_options.add_argument('recipients', nargs='?', help="CSV or Excel file with name and email columns")
+    campaign_options.add_argument('--config', help="JSON file with any of these options; options given here win")
+    campaign_options.add_argument('--sender', help=f"Sender address, the password is read from {PASSWORD_ENV}")
+    campaign_options.add_argument('--subject', help="Subject template")
+    campaign_options.add_argument('--content', help="HTML body template file")
+    campaign_options.add_argument('--layout', choices=LAYOUTS, default=SIMPLE,
+                                  help="simple: {name} placeholders (email_sender.py); "
+                                       "rich: jinja {{ name }} / {{ starting_line }} with a greeting and a plain "
+                                       "text part (email_sender_res.py)")
+    campaign_options.add_argument('--greeting', help="Greeting line of the rich layout, default 'Hi {{ name }},'")
+    campaign_options.add_argument('--attach', action='append', default=[], help="Attachment, may be repeated")
+    campaign_options.add_argument('--name', help="Campaign name shown in status output and the UI")
+    campaign_options.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                                  help="SMTP connections per shard")
+    campaign_options.add_argument('--per-second', type=float, default=DEFAULT_PER_SECOND,
+                                  help="Campaign-wide limit, 0 for none")
+    campaign_options.add_argument('--per-minute', type=int, default=0, help="Campaign-wide limit, 0 for none")
+    campaign_options.add_argument('--per-day', type=int, default=0, help="Campaign-wide limit, 0 for none")
+    campaign_options.add_argument('--no-dns-check', action='store_true',
+                                  help="Validate address syntax only, no MX lookups")
+
+    send = commands.add_parser('send', parents=[run_options, campaign_options],
+                               help="Prepare a campaign and send its shards")
+    send.add_argument('--shards', type=int, default=1, help="Number of deterministic shards")
+    send.add_argument('--skip-mailed', action='store_true',
+                      help="Also skip addresses an earlier campaign already delivered to")
+    send.add_argument('--asyncio', action='store_true',
+                      help="Send over an asyncio SMTP client, --concurrency connections per shard on one thread; "
+                           "for relays that allow hundreds of connections")
+    send.add_argument('--prepare-only', action='store_true',
+                      help="Only write the campaign folder, e.g. for workers on other machines")
+    send.set_defaults(func=cmd_send, shard=None)
+    if config:
+        send.set_defaults(**config)
+
+    schedule = commands.add_parser('schedule', parents=[campaign_options],
+                                   help="Queue a campaign for later, spread out or as a drip sequence; "
+                                        "the `scheduler` command sends it")
+    schedule.add_argument('--start', type=_timestamp, help="ISO date/time of the first send (default: now)")
+    schedule.add_argument('--end', type=_timestamp,
+                          help="Spread the first step evenly until this ISO date/time")
+    schedule.add_argument('--local-time', type=_local_time,
+                          help="Send at this HH:MM in each recipient's time zone (the timezone column) "
+                               "on the day of --start")
+    schedule.add_argument('--spread-minutes', type=float, default=DEFAULT_SPREAD / 60,
+                          help="With --local-time, spread each time zone's recipients over this many minutes")
+    schedule.add_argument('--default-timezone', default=DEFAULT_TIMEZONE,
+                          help="Zone for recipients without a valid timezone value")
+    schedule.add_argument('--follow-up', nargs=3, action='append', default=[],
+                          metavar=('DAYS', 'SUBJECT', 'CONTENT'),
+                          help="Drip step sent DAYS after the previous one, may be repeated")
+    schedule.set_defaults(func=cmd_schedule)
+    if config:
+        schedule.set_defaults(**config)
+
+    scheduler = commands.add_parser('scheduler', help="Send scheduled campaigns as they come due, until Ctrl-C")
+    scheduler.add_argument('--sender', action='append', required=True,
+                           help=f"Send the schedules of this sender (password from {PASSWORD_ENV}), may be repeated")
+    scheduler.add_argument('--interval', type=float, default=60, help="Seconds between status lines")
+    scheduler.set_defaults(func=cmd_scheduler)
+
+    schedules = commands.add_parser('schedules', help="Scheduled campaigns and how far along they are")
+    schedules.set_defaults(func=cmd_schedules)
+
+    for action, help_text in (('pause', "Hold a scheduled campaign's pending messages"),
+                              ('resume', "Let a paused scheduled campaign send again")):
+        command = commands.add_parser(action, help=help_text)
+        command.add_argument('campaign')
+        command.set_defaults(func=cmd_schedule_state, state=action)
+
+    work = commands.add_parser('work', parents=[run_options], help="Send some shards of a prepared campaign")
+    work.add_argument('campaign')
+    work.add_argument('--shard', type=int, action='append', required=True, help="Shard index, may be repeated")
+    work.set_defaults(func=cmd_work)
+
+    status = commands.add_parser('status', help="Merged status of sharded campaigns")
+    status.add_argument('campaign', nargs='?')
+    status.set_defaults(func=cmd_status)
+
+    cancel = commands.add_parser('cancel', help="Stop a sharded campaign, or drop a scheduled one's pending messages")
+    cancel.add_argument('campaign')
+    cancel.set_defaults(func=cmd_cancel)
+
+    suppress = commands.add_parser('suppress', help="Add addresses to the suppression list, never mailed again")
+    suppress.add_argument('files', nargs='+',
+                          help="CSV/Excel with an email column, or one address per line")
+    suppress.add_argument('--reason', choices=REASONS, default=MANUAL)
+    suppress.add_argument('--remove', action='store_true', help="Take the addresses off the list instead")
+    suppress.set_defaults(func=cmd_suppress)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        if getattr(args, 'config', None):
+            # Parse again with the file's values as defaults, so the command line overrides them
+            args = build_parser(load_config(args.config)).parse_args(argv)
+        return args.func(args)
+    except (ValueError, RuntimeError, OSError) as e:
+        # Bad arguments or files, or a shard that failed (its status has the details)
+        sys.exit(str(e))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,358 @@
+import re
+import textwrap
+from collections import namedtuple
+from functools import lru_cache
+from html import unescape
+
+# Quill's editor classes as inline CSS: mail clients drop or ignore most of a
+# <style> block, an inline style attribute is what they all keep
+QUILL_STYLES = {
+    'ql-align-center': 'text-align: center',
+    'ql-align-right': 'text-align: right',
+    'ql-align-justify': 'text-align: justify',
+    'ql-direction-rtl': 'direction: rtl',
+    'ql-size-small': 'font-size: 0.75em',
+    'ql-size-large': 'font-size: 1.5em',
+    'ql-size-huge': 'font-size: 2.5em',
+    'ql-font-serif': 'font-family: Georgia, "Times New Roman", serif',
+    'ql-font-monospace': 'font-family: Monaco, "Courier New", monospace',
+}
+# Quill indents by 3em per level, list items get 1.5em more for the marker
+QUILL_INDENT_EM = 3
+QUILL_LIST_INDENT_EM = 1.5
+# Quill 2 writes every list as <ol> and says what kind each item is
+QUILL_LIST_STYLES = {
+    'bullet': 'list-style-type: disc',
+    'ordered': 'list-style-type: decimal',
+    'checked': 'list-style-type: none',
+    'unchecked': 'list-style-type: none',
+}
+
+# Removed with everything inside them
+DROPPED_ELEMENTS = frozenset({'script', 'iframe', 'frame', 'frameset', 'object', 'embed', 'applet', 'template'})
+# Removed, their text stays
+DROPPED_TAGS = frozenset({'form', 'input', 'button', 'select', 'option', 'textarea', 'link', 'meta', 'base'})
+URL_ATTRIBUTES = frozenset({'href', 'src', 'action', 'formaction', 'background', 'poster', 'xlink:href'})
+UNSAFE_SCHEMES = ('javascript:', 'vbscript:', 'data:text/html')
+
+# Plain text lines are wrapped to this width (RFC 3676 suggests under 78)
+TEXT_WIDTH = 76
+
+# Tags that start a new line of the plain text version
+_TEXT_BLOCKS = frozenset({'p', 'div', 'li', 'ul', 'ol', 'blockquote', 'pre', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+                          'table', 'tr', 'hr'})
+
+# One token per match: a comment, a tag (quoted attribute values may hold
+# '>'), a doctype/processing instruction, or text up to the next '<'
+_TOKEN_RE = re.compile(r"""
+    (?P<comment><!--.*?(?:-->|\Z))
+  | <(?P<end>/)?(?P<tag>[A-Za-z][A-Za-z0-9:-]*)(?P<attrs>(?:"[^"]*"|'[^']*'|[^'">])*)>
+  | (?P<declaration><[!?][^>]*>)
+  | (?P<text>[^<]+|<)
+""", re.S | re.X)
+_ATTR_RE = re.compile(r"""([^\s"'>/=]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'=<>`]+)))?""")
+_SPACE_RE = re.compile(r'\s+')
+_CONTROL_RE = re.compile(r'[\x00-\x20]+')
+# Template placeholders, never split across lines of the plain text
+_PLACEHOLDER_RE = re.compile(r'\{\{.*?\}\}|\{%.*?%\}')
+_LIST_MARKER_RE = re.compile(r' *(?:- |\d+\. )')
+_close_tag_patterns = {}
+
+NormalizedHTML = namedtuple('NormalizedHTML', ['html', 'text'])
+
+
+def _parse_attrs(raw):
+    # [(name, raw value or None)], values stay escaped as written
+    attrs = []
+    for match in _ATTR_RE.finditer(raw):
+        name, double, single, bare = match.groups()
+        value = double if double is not None else single if single is not None else bare
+        attrs.append((name.lower(), value))
+    return attrs
+
+
+def _is_unsafe_url(value):
+    return _CONTROL_RE.sub('', unescape(value)).lower().startswith(UNSAFE_SCHEMES)
+
+
+def _quill_styles(tag, attrs):
+    # Inline CSS for the Quill classes and list markers of one tag, plus the
+    # attributes with those classes taken out
+    styles = []
+    kept = []
+    for name, value in attrs:
+        if name == 'class' and value:
+            classes = []
+            for cls in value.split():
+                style = QUILL_STYLES.get(cls)
+                if style is None and cls.startswith('ql-indent-') and cls[10:].isdigit():
+                    em = int(cls[10:]) * QUILL_INDENT_EM + (QUILL_LIST_INDENT_EM if tag == 'li' else 0)
+                    style = f'padding-left: {em:g}em'
+                if style is None:
+                    classes.append(cls)
+                else:
+                    styles.append(style)
+            if classes:
+                kept.append((name, ' '.join(classes)))
+        elif name == 'data-list' and tag == 'li' and value in QUILL_LIST_STYLES:
+            styles.append(QUILL_LIST_STYLES[value])
+            kept.append((name, value))
+        else:
+            kept.append((name, value))
+    return styles, kept
+
+
+def _sanitize_attrs(attrs):
+    kept = []
+    for name, value in attrs:
+        # Event handlers never survive a mail client, and shouldn't
+        if name.startswith('on'):
+            continue
+        if value is not None and name in URL_ATTRIBUTES and _is_unsafe_url(value):
+            continue
+        if name == 'style' and value is not None:
+            lowered = unescape(value).lower()
+            if 'expression(' in lowered or 'javascript:' in lowered:
+                continue
+        kept.append((name, value))
+    return kept
+
+
+def _start_tag(tag, attrs, self_closing):
+    parts = [tag]
+    for name, value in attrs:
+        parts.append(name if value is None else f'{name}="{value.replace(chr(34), "&quot;")}"')
+    return f"<{' '.join(parts)}{' /' if self_closing else ''}>"
+
+
+def _rewrite_tag(source, tag, raw_attrs):
+    # The tag as written when nothing in it needs changing, which keeps
+    # Quill's markup byte for byte; rebuilt from its attributes otherwise
+    attrs = _parse_attrs(raw_attrs)
+    kept = _sanitize_attrs(attrs)
+    styles, kept = _quill_styles(tag, kept)
+    if len(kept) == len(attrs) and not styles:
+        return source
+    if styles:
+        # Added after any style the tag already has
+        existing = [value.strip().rstrip(';') for name, value in kept if name == 'style' and value]
+        kept = [(name, value) for name, value in kept if name != 'style']
+        kept.append(('style', '; '.join(existing[:1] + styles) + ';'))
+    return _start_tag(tag, kept, raw_attrs.rstrip().endswith('/'))
+
+
+class _PlainText:
+    # The plain text version, built from the same tokens: a line per block
+    # (paragraph, list item, heading), <br> breaks lines, links keep their
+    # URL, list items get "- " or "1. ", long lines are wrapped
+
+    def __init__(self):
+        self.lines = []
+        self.line = []
+        self.lists = []
+        self.links = []
+        self.preformatted = 0
+
+    def text(self, data):
+        if self.preformatted:
+            # Line breaks and spacing of <pre> blocks are kept as written
+            first, *rest = unescape(data).split('\n')
+            self.line.append(first)
+            for line in rest:
+                self.end_line(force=True)
+                self.line.append(line)
+            return
+        data = _SPACE_RE.sub(' ', unescape(data))
+        if not self.line:
+            data = data.lstrip()
+        if data:
+            self.line.append(data)
+
+    def end_line(self, force=False):
+        line = ''.join(self.line).rstrip()
+        if line and not self.preformatted:
+            self.lines.extend(_wrap(line))
+        elif line or force:
+            self.lines.append(line)
+        self.line = []
+
+    def start(self, tag, attrs):
+        if tag == 'br':
+            self.end_line(force=True)
+            return
+        if tag in _TEXT_BLOCKS:
+            self.end_line()
+        if tag in ('ul', 'ol'):
+            self.lists.append([tag, 0])
+        elif tag == 'pre':
+            self.preformatted += 1
+        elif tag == 'li':
+            attrs = dict(attrs)
+            kind = attrs.get('data-list')
+            depth = len(self.lists) - 1
+            indent = attrs.get('class') or ''
+            for cls in indent.split():
+                if cls.startswith('ql-indent-') and cls[10:].isdigit():
+                    depth += int(cls[10:])
+            ordered = bool(self.lists) and (kind == 'ordered' or (kind is None and self.lists[-1][0] == 'ol'))
+            if ordered:
+                self.lists[-1][1] += 1
+            marker = f'{self.lists[-1][1]}. ' if ordered else '- '
+            self.line.append('  ' * max(depth, 0) + marker)
+        elif tag == 'a':
+            href = dict(attrs).get('href')
+            if href and _is_unsafe_url(href):
+                href = None
+            self.links.append((unescape(href) if href else None, len(self.line)))
+        elif tag == 'img':
+            alt = dict(attrs).get('alt')
+            if alt:
+                self.text(alt)
+        elif tag == 'hr':
+            self.lines.append('-' * 20)
+
+    def end(self, tag):
+        if tag == 'a' and self.links:
+            href, start = self.links.pop()
+            label = ''.join(self.line[start:]).strip()
+            if href and not href.startswith('#') and href != label and href != f'mailto:{label}':
+                self.line.append(f' ({href})')
+        elif tag in ('ul', 'ol') and self.lists:
+            self.lists.pop()
+        elif tag == 'pre' and self.preformatted:
+            # Its last line is still unwrapped
+            self.end_line()
+            self.preformatted -= 1
+        if tag in _TEXT_BLOCKS:
+            self.end_line()
+
+    def result(self):
+        self.end_line()
+        # Drop blank lines at either end, keep at most one blank line in a row
+        lines = []
+        for line in self.lines:
+            if line or (lines and lines[-1]):
+                lines.append(line)
+        while lines and not lines[-1]:
+            lines.pop()
+        return '\n'.join(lines)
+
+
+def _wrap(line):
+    # Continuation lines of a list item line up with its text
+    if len(line) <= TEXT_WIDTH:
+        return [line]
+    marker = _LIST_MARKER_RE.match(line)
+    protected = _PLACEHOLDER_RE.sub(lambda match: match.group(0).replace(' ', '\0'), line)
+    wrapped = textwrap.wrap(protected, TEXT_WIDTH, subsequent_indent=' ' * (marker.end() if marker else 0),
+                            break_long_words=False, break_on_hyphens=False)
+    return [part.replace('\0', ' ') for part in wrapped]
+
+
+def _collapse_breaks(out, run):
+    # A run of <br>s with only whitespace in between (run[i] is the
+    # whitespace before the i-th), collapsed the way the old
+    # re.sub(r'<br>\s*<br>', '<br>') did: left to right every pair becomes
+    # one <br>, the whitespace between pairs stays
+    for index in range(0, len(run), 2):
+        out.append(run[index])
+        out.append('<br>')
+
+
+def _normalize(source, collapse_paragraphs):
+    html = []
+    text = _PlainText()
+    run = []
+    pending_space = ''
+    styled_paragraph = False
+
+    def emit(piece):
+        nonlocal pending_space
+        if run:
+            _collapse_breaks(html, run)
+            run.clear()
+        html.append(pending_space)
+        html.append(piece)
+        pending_space = ''
+
+    def line_break():
+        nonlocal pending_space
+        if not run:
+            html.append(pending_space)
+            pending_space = ''
+        run.append(pending_space)
+        pending_space = ''
+
+    position = 0
+    length = len(source)
+    while position < length:
+        match = _TOKEN_RE.match(source, position)
+        position = match.end()
+        piece = match.group(0)
+        tag = match.group('tag')
+        if tag is None:
+            data = match.group('text')
+            if data is not None:
+                text.text(data)
+                if collapse_paragraphs and run and data.isspace():
+                    pending_space += data
+                    continue
+            emit(piece)
+            continue
+
+        tag = tag.lower()
+        if match.group('end'):
+            text.end(tag)
+            if tag in DROPPED_TAGS:
+                continue
+            if collapse_paragraphs and tag == 'p':
+                if styled_paragraph:
+                    styled_paragraph = False
+                    emit('</p>')
+                else:
+                    line_break()
+                continue
+            emit(piece)
+            continue
+
+        raw_attrs = match.group('attrs')
+        if tag in DROPPED_ELEMENTS:
+            # Skip to the matching end tag, or to the end of the document
+            pattern = _close_tag_patterns.get(tag)
+            if pattern is None:
+                pattern = _close_tag_patterns[tag] = re.compile(rf'</{tag}\s*>', re.I)
+            closing = pattern.search(source, position)
+            position = closing.end() if closing else length
+            continue
+        if tag in DROPPED_TAGS:
+            continue
+        text.start(tag, _parse_attrs(raw_attrs))
+        if collapse_paragraphs:
+            if piece == '<br>':
+                line_break()
+                continue
+            if piece == '<p>':
+                continue
+        rewritten = _rewrite_tag(piece, tag, raw_attrs)
+        if collapse_paragraphs and tag == 'p':
+            if rewritten == '<p>':
+                continue
+            # Kept as a real paragraph so its inlined alignment ends with it
+            styled_paragraph = True
+        emit(rewritten)
+
+    emit('')
+    result = ''.join(html)
+    return NormalizedHTML(result.strip() if collapse_paragraphs else result, text.result())
+
+
+@lru_cache(maxsize=64)
+def normalize_html(source, collapse_paragraphs=False):
+    # One pass over an editor's HTML, once per campaign (not per recipient):
+    # sanitized (scripts, frames, forms, event handlers and javascript: URLs
+    # removed), Quill classes inlined as CSS, and a plain text version of the
+    # same content. `collapse_paragraphs` is email_sender.py's flavour: <p>
+    # paragraphs turned into <br> lines, repeated <br>s collapsed, trimmed.
+    # Template placeholders ({name}, {{ name }}) are plain text here and come
+    # through untouched in both versions.
+    return _normalize(source or '', collapse_paragraphs)
@@ -0,0 +1,168 @@
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED = (DONE, FAILED, CANCELLED)
+
+# Campaigns that may send at the same time, more queue up behind them
+DEFAULT_MAX_RUNNING = 2
+# Finished jobs kept around so a refreshed page can still show the outcome
+MAX_FINISHED_JOBS = 20
+# Only the most recent errors are kept per job
+MAX_JOB_ERRORS = 200
+
+
+def owner_token(sender_email, password):
+    # Who a campaign belongs to: whoever enters the same sender and app
+    # password. Only this digest is kept, never the password
+    if not sender_email or not password:
+        return None
+    return hashlib.sha256(f'{sender_email.strip().lower()}\0{password}'.encode('utf-8')).hexdigest()
+
+
+class Job:
+    # Status of one background campaign. Counters are written by the job's
+    # thread and only read by the UI, so plain attributes are enough.
+
+    def __init__(self, name, total, key=None, owner=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.key = key
+        # owner_token() of the sender that submitted it
+        self.owner = owner
+        self.total = total
+        self.sent = 0
+        self.failed = 0
+        # Recipients already sent by an earlier run of the same campaign
+        self.resumed = None
+        self.errors = deque(maxlen=MAX_JOB_ERRORS)
+        # retry.DeadLetters of a send job, for the failed-recipients export
+        self.dead_letters = None
+        self.status = QUEUED
+        self.error = None
+        self.result = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_event = threading.Event()
+
+    def set_progress(self, sent, total=None):
+        if self.resumed is None:
+            self.resumed = sent
+        self.sent = sent
+        if total is not None:
+            self.total = total
+
+    def add_error(self, message):
+        self.failed += 1
+        self.errors.append(message)
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    @property
+    def finished(self):
+        return self.status in FINISHED
+
+    @property
+    def progress(self):
+        if not self.total:
+            return 1.0 if self.finished else 0.0
+        return min(1.0, (self.sent + self.failed) / self.total)
+
+    @property
+    def elapsed(self):
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+    @property
+    def throughput(self):
+        # Messages per second handled by this run, resumed rows don't count
+        elapsed = self.elapsed
+        handled = self.sent - (self.resumed or 0) + self.failed
+        return handled / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self):
+        # Seconds left at the current throughput, None until there is one
+        if self.finished:
+            return 0.0
+        rate = self.throughput
+        if rate <= 0:
+            return None
+        return max(0, self.total - self.sent - self.failed) / rate
+
+
+class JobRunner:
+    # Runs campaigns on background threads owned by the server process, so a
+    # send keeps going whatever the browser does (reruns, refreshes, closed
+    # tabs). The UI submits a job and polls it by id.
+
+    def __init__(self, max_running=DEFAULT_MAX_RUNNING):
+        self._executor = ThreadPoolExecutor(max_workers=max_running, thread_name_prefix='kuki_job')
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, name, total, target, *args, key=None, owner=None, **kwargs):
+        # target(job, *args, **kwargs) runs on a runner thread; a job with the
+        # same key that is still queued or running is returned instead of a
+        # second copy. `owner` is an owner_token(), see jobs()
+        with self._lock:
+            if key is not None:
+                for job in self._jobs.values():
+                    if job.key == key and not job.finished:
+                        return job
+            job = Job(name, total, key, owner)
+            self._jobs[job.id] = job
+            self._prune()
+        self._executor.submit(self._run, job, target, args, kwargs)
+        return job
+
+    def _run(self, job, target, args, kwargs):
+        job.started_at = time.time()
+        if job.cancelled:
+            job.status = CANCELLED
+            job.finished_at = job.started_at
+            return
+        job.status = RUNNING
+        try:
+            job.result = target(job, *args, **kwargs)
+            job.status = CANCELLED if job.cancelled else DONE
+        except Exception as e:
+            job.error = str(e)
+            job.status = FAILED
+        finally:
+            job.finished_at = time.time()
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def jobs(self, owner=None):
+        # Every job, or only those submitted with this owner_token()
+        with self._lock:
+            return [job for job in self._jobs.values() if owner is None or job.owner == owner]
+
+    def active(self):
+        return [job for job in self.jobs() if not job.finished]
+
+
+# One runner per server process, shared by every browser session
+job_runner = JobRunner()
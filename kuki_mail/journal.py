@@ -0,0 +1,133 @@
+import hashlib
+import sqlite3
+import threading
+import time
+
+from .settings import data_path
+
+QUEUED = 'queued'
+SENT = 'sent'
+FAILED = 'failed'
+
+JOURNAL_FILE = 'journal.sqlite3'
+# Group commit: flush when this many updates are pending or after the interval
+FLUSH_BATCH_SIZE = 500
+FLUSH_INTERVAL = 0.5
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS send_events (
+    id INTEGER PRIMARY KEY,
+    campaign TEXT NOT NULL,
+    row INTEGER NOT NULL,
+    email TEXT NOT NULL,
+    state TEXT NOT NULL,
+    code INTEGER,
+    error TEXT,
+    at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS send_events_campaign ON send_events (campaign, state);
+"""
+
+
+def campaign_id(*parts):
+    # Stable id for "this list, this content, this sender": re-clicking Send
+    # after a crash or rerun finds the same journal entries
+    digest = hashlib.sha256()
+    for part in parts:
+        if hasattr(part, 'getvalue'):
+            part = part.getvalue()
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        digest.update(part or b'')
+        digest.update(b'\0')
+    return digest.hexdigest()[:32]
+
+
+class SendJournal:
+    # Append-only record of every recipient's state, in SQLite WAL mode.
+    # Writers only append to an in-memory buffer; a background thread commits
+    # the buffer in one transaction per batch so the journal never holds up
+    # the send workers.
+
+    def __init__(self, campaign, path=None, batch_size=FLUSH_BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.campaign = campaign
+        self.path = path or data_path(JOURNAL_FILE)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(_SCHEMA)
+        self._pending = []
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def completed_rows(self):
+        # Loaded once into a set so resume checks are O(1) per row
+        with self._db_lock:
+            cursor = self._conn.execute(
+                'SELECT row FROM send_events WHERE campaign = ? AND state = ?', (self.campaign, SENT))
+            return {row for (row,) in cursor}
+
+    def counts(self):
+        self.flush()
+        with self._db_lock:
+            # Latest event per row wins (SQLite takes the bare column from the MAX row)
+            cursor = self._conn.execute(
+                'SELECT state, COUNT(*) FROM ('
+                '  SELECT state, MAX(id) FROM send_events WHERE campaign = ? GROUP BY row'
+                ') GROUP BY state', (self.campaign,))
+            return dict(cursor.fetchall())
+
+    def record(self, row, email, state, code=None, error=None):
+        with self._lock:
+            self._pending.append((self.campaign, row, email, state, code, error, time.time()))
+            if len(self._pending) >= self.batch_size:
+                self._wake.set()
+
+    def queued(self, row, email):
+        self.record(row, email, QUEUED)
+
+    def sent(self, row, email):
+        self.record(row, email, SENT)
+
+    def failed(self, row, email, code=None, error=None):
+        self.record(row, email, FAILED, code, error)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        with self._db_lock:
+            self._conn.execute('BEGIN')
+            self._conn.executemany(
+                'INSERT INTO send_events (campaign, row, email, state, code, error, at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)', pending)
+            self._conn.execute('COMMIT')
+
+    def _write_loop(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        self._writer.join()
+        self.flush()
+        with self._db_lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
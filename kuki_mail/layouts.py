@@ -0,0 +1,219 @@
+# HTML layouts wrapped around the email body. {greeting} and {content} are
+# slots filled by templating.compile_layout, every other brace is CSS.
+
+# Template styles: email_sender.py's {name} placeholders in a simple layout,
+# or email_sender_res.py's jinja greeting + body with a plain text part
+SIMPLE = 'simple'
+RICH = 'rich'
+LAYOUTS = (SIMPLE, RICH)
+
+SIMPLE_TEST_LAYOUT = """
+<html>
+    <head>
+        <style>
+            body { font-family: Arial, sans-serif; }
+            .content { 
+                white-space: pre-line;  # This respects line breaks but collapses multiple spaces
+                line-height: 1.4;       # Adjust this to control spacing between lines
+                margin: 0;
+                padding: 0;
+            }
+            .content br {
+                display: block;         # Makes <br> behave like line breaks
+                content: "";            # No extra content
+                margin-bottom: 0;       # Remove extra spacing
+            }
+        </style>
+    </head>
+    <body>
+        <div class="content">{content}</div>
+    </body>
+</html>
+"""
+
+SIMPLE_BULK_LAYOUT = """
+            <html>
+                <head>
+                    <style>
+                        body { font-family: Arial, sans-serif; }
+                        .content { 
+                            white-space: pre-wrap !important;
+                            line-height: 1;
+                        }
+                    </style>
+                </head>
+                <body>
+                    <div class="content">{content}</div>
+                </body>
+            </html>
+            """
+
+RICH_TEST_LAYOUT = """
+        <!DOCTYPE html>
+        <html>
+        <head>
+            <meta charset="UTF-8">
+            <meta name="viewport" content="width=device-width, initial-scale=1.0">
+            <style>
+                body { 
+                    font-family: Arial, sans-serif; 
+                    line-height: 1.4; 
+                    color: #333333; 
+                    margin: 0;
+                    padding: 0;
+                }
+                .email-container { 
+                    max-width: 600px; 
+                    margin: 0 auto; 
+                    padding: 20px; 
+                }
+                .greeting { 
+                    font-size: 16px; 
+                    margin-bottom: 15px; 
+                }
+                .content p {
+                    margin-top: 0;
+                    margin-bottom: 10px;
+                }
+                .content {
+                    margin: 0;
+                    padding: 0;
+                }
+                /* List styles */
+                ul, ol { 
+                    padding-left: 25px; 
+                    margin: 10px 0; 
+                }
+                li { 
+                    margin-bottom: 5px; 
+                }
+                strong { font-weight: bold; }
+                em { font-style: italic; }
+                u { text-decoration: underline; }
+                pre, code {
+                    white-space: pre-wrap;
+                    font-family: monospace;
+                    background-color: #f5f5f5;
+                    padding: 5px;
+                    border-radius: 3px;
+                }
+                blockquote {
+                    margin-left: 0;
+                    padding-left: 10px;
+                    border-left: 3px solid #ccc;
+                    color: #555;
+                }
+                /* Fix spacing */
+                .ql-editor p {
+                    margin: 0 !important;
+                }
+                /* Fix alignment */
+                .ql-align-justify {
+                    text-align: justify;
+                }
+                .ql-align-center {
+                    text-align: center;
+                }
+                .ql-align-right {
+                    text-align: right;
+                }
+                /* Tab spacing */
+                .tab {
+                    display: inline-block;
+                    width: 2em;
+                }
+            </style>
+        </head>
+        <body>
+            <div class="email-container">
+                <div class="greeting">{greeting}</div>
+                <div class="content">{content}</div>
+            </div>
+        </body>
+        </html>
+        """
+
+RICH_BULK_LAYOUT = """
+                <!DOCTYPE html>
+                <html>
+                <head>
+                    <meta charset="UTF-8">
+                    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+                    <style>
+                        body { 
+                            font-family: Arial, sans-serif; 
+                            line-height: 1.2; 
+                            color: #333333; 
+                            margin: 0;
+                            padding: 0;
+                        }
+                        .email-container { 
+                            max-width: 600px; 
+                            margin: 0 auto; 
+                            padding: 20px; 
+                        }
+                        .greeting { 
+                            font-size: 16px; 
+                            margin-bottom: 15px; 
+                        }
+                        .content p {
+                            margin-top: 0;
+                            margin-bottom: 10px;
+                        }
+                        .content {
+                            margin: 0;
+                            padding: 0;
+                        }
+                        /* List styles */
+                        ul, ol { 
+                            padding-left: 25px; 
+                            margin: 10px 0; 
+                        }
+                        li { 
+                            margin-bottom: 5px; 
+                        }
+                        strong { font-weight: bold; }
+                        em { font-style: italic; }
+                        u { text-decoration: underline; }
+                        pre, code {
+                            white-space: pre-wrap;
+                            font-family: monospace;
+                            background-color: #f5f5f5;
+                            padding: 5px;
+                            border-radius: 3px;
+                        }
+                        blockquote {
+                            margin-left: 0;
+                            padding-left: 10px;
+                            border-left: 3px solid #ccc;
+                            color: #555;
+                        }
+                        /* Fix spacing */
+                        .ql-editor p {
+                            margin: 0 !important;
+                        }
+                        /* Fix alignment */
+                        .ql-align-justify {
+                            text-align: justify;
+                        }
+                        .ql-align-center {
+                            text-align: center;
+                        }
+                        .ql-align-right {
+                            text-align: right;
+                        }
+                        /* Tab spacing */
+                        .tab {
+                            display: inline-block;
+                            width: 2em;
+                        }
+                    </style>
+                </head>
+                <body>
+                    <div class="email-container">
+                        <div class="greeting">{greeting}</div>
+                        <div class="content">{content}</div>
+                    </div>
+                </body>
+                </html>
+                """
@@ -0,0 +1,191 @@
+import bisect
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Histogram bucket upper bounds in seconds: 10us doubling up to ~84s, enough
+# for anything from a template render to a stalled DATA reply
+DEFAULT_BOUNDS = tuple(0.00001 * 2 ** i for i in range(24))
+PREFIX = 'kuki_mail'
+# Serve /metrics (Prometheus text) and /metrics.json on this port when set
+METRICS_PORT_ENV = 'KUKI_MAIL_METRICS_PORT'
+
+# Pipeline stages in the order a message goes through them
+STAGES = ('connect', 'login', 'render', 'build', 'envelope', 'serialize', 'data', 'throttle')
+
+
+class Histogram:
+    # Fixed buckets, so observe() is a bisect and two additions under a lock
+    # and percentiles are estimated by interpolating inside a bucket
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def percentile(self, fraction):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.count
+        if not total:
+            return None
+        rank = fraction * total
+        seen = 0
+        for index, count in enumerate(counts):
+            if count and seen + count >= rank:
+                lower = self.bounds[index - 1] if index else 0.0
+                upper = self.bounds[index] if index < len(self.bounds) else self.bounds[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.bounds[-1]
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+        }
+
+
+class Timer:
+    # `with metrics.timer('render'):` - a plain class, cheaper than @contextmanager
+    __slots__ = ('histogram', 'started')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+class Metrics:
+    # Process-wide registry of stage timings and counters, written from the
+    # send workers and read by the UI panel and the metrics endpoint
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(name, Histogram())
+        return histogram
+
+    def timer(self, name):
+        return Timer(self.histogram(name))
+
+    def observe(self, name, seconds):
+        self.histogram(name).observe(seconds)
+
+    def increment(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            histograms = dict(self.histograms)
+            counters = dict(self.counters)
+        return {
+            'uptime': time.time() - self.started,
+            'counters': counters,
+            'stages': {name: histogram.snapshot() for name, histogram in histograms.items()},
+        }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+    def prometheus(self):
+        lines = []
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+        for name, value in counters:
+            lines.append(f'# TYPE {PREFIX}_{name}_total counter')
+            lines.append(f'{PREFIX}_{name}_total {value}')
+        if histograms:
+            metric = f'{PREFIX}_stage_seconds'
+            lines.append(f'# TYPE {metric} histogram')
+            for name, histogram in histograms:
+                with histogram._lock:
+                    counts = list(histogram.counts)
+                    total, total_sum = histogram.count, histogram.sum
+                cumulative = 0
+                for bound, count in zip(histogram.bounds, counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{stage="{name}",le="{bound:.6g}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{stage="{name}",le="+Inf"}} {total}')
+                lines.append(f'{metric}_sum{{stage="{name}"}} {total_sum}')
+                lines.append(f'{metric}_count{{stage="{name}"}} {total}')
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.counters = {}
+            self.started = time.time()
+
+
+metrics = Metrics()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith('/metrics.json'):
+            body, content_type = metrics.to_json(), 'application/json'
+        elif self.path.startswith('/metrics'):
+            body, content_type = metrics.prometheus(), 'text/plain; version=0.0.4'
+        else:
+            self.send_error(404)
+            return
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(port, host='127.0.0.1'):
+    # Idempotent, Streamlit reruns call it every time
+    global _server
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+            threading.Thread(target=_server.serve_forever, name='kuki_metrics', daemon=True).start()
+        return _server
+
+
+def serve_from_env():
+    port = os.getenv(METRICS_PORT_ENV)
+    if port:
+        return start_metrics_server(int(port))
+    return None
@@ -0,0 +1,222 @@
+import base64
+import smtplib
+import time
+import uuid
+from collections import namedtuple
+from email.header import Header
+
+from .metrics import metrics
+
+# Small segments are coalesced into writes of about this size, big ones
+# (attachment bodies) go to the socket as they are
+_WRITE_SIZE = 64 * 1024
+
+# Text parts longer than this per line must not go out as 7bit (RFC 5322)
+_MAX_LINE = 998
+
+# RFC 5321 requires servers to accept at least 100 RCPT commands per envelope
+MAX_RECIPIENTS_PER_ENVELOPE = 100
+# To header of messages sent to a whole batch, the real recipients are only
+# in the envelope (like BCC)
+UNDISCLOSED_RECIPIENTS = 'undisclosed-recipients:;'
+
+# A message as a list of wire-ready byte segments (CRLF line endings, already
+# dot-stuffed) that can be written to the socket one after another. Shared
+# segments such as attachment bodies are the cached objects themselves, not
+# copies.
+WireMessage = namedtuple('WireMessage', ['segments', 'size'])
+# A WireMessage without its To header, the empty segment at `to_index`
+PreparedMessage = namedtuple('PreparedMessage', ['segments', 'size', 'to_index'])
+
+
+def _header(name, value):
+    try:
+        value.encode('ascii')
+    except UnicodeEncodeError:
+        value = Header(value, 'utf-8').encode()
+    return f'{name}: {value}\r\n'
+
+
+def _text_part(text, subtype):
+    # 7bit when possible (cheap, readable), base64 for anything non-ASCII
+    lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    try:
+        text.encode('ascii')
+        is_ascii = True
+    except UnicodeEncodeError:
+        is_ascii = False
+    if is_ascii and max(map(len, lines)) <= _MAX_LINE:
+        headers = (f'Content-Type: text/{subtype}; charset="us-ascii"\r\n'
+                   'MIME-Version: 1.0\r\n'
+                   'Content-Transfer-Encoding: 7bit\r\n\r\n')
+        # Dot-stuffing happens here so the DATA stream can be written verbatim
+        body = '\r\n'.join('.' + line if line.startswith('.') else line for line in lines)
+        return (headers + body).encode('ascii')
+    encoded = base64.b64encode(text.encode('utf-8'))
+    headers = (f'Content-Type: text/{subtype}; charset="utf-8"\r\n'
+               'MIME-Version: 1.0\r\n'
+               'Content-Transfer-Encoding: base64\r\n\r\n').encode('ascii')
+    return headers + b'\r\n'.join(encoded[i:i + 76] for i in range(0, len(encoded), 76))
+
+
+class MessageBuilder:
+    # Assembles messages from precomputed pieces. Everything that is the same
+    # for the whole campaign (boundaries, attachment parts, the From header) is
+    # built once in __init__; build() only encodes the per-recipient headers
+    # and text parts.
+
+    def __init__(self, from_addr, attachments=()):
+        self.from_addr = from_addr
+        self.attachments = list(attachments)
+        token = uuid.uuid4().hex
+        self.mixed_boundary = f'===============kuki_{token}_m=='
+        self.alt_boundary = f'===============kuki_{token}_a=='
+        self._from_header = _header('From', from_addr).encode('utf-8')
+
+        self._attachment_segments = []
+        for attachment in self.attachments:
+            self._attachment_segments.append(f'\r\n--{self.mixed_boundary}\r\n'.encode('ascii') + attachment.headers)
+            self._attachment_segments.append(attachment.body)
+        # Bytes of every message that are the shared attachment parts
+        self.shared_size = sum(len(segment) for segment in self._attachment_segments)
+        self._mixed_headers = (f'Content-Type: multipart/mixed; boundary="{self.mixed_boundary}"\r\n'
+                               'MIME-Version: 1.0\r\n').encode('ascii')
+        self._mixed_open = f'\r\n--{self.mixed_boundary}\r\n'.encode('ascii')
+        self._mixed_close = f'\r\n--{self.mixed_boundary}--\r\n'.encode('ascii')
+        self._alt_headers = (f'Content-Type: multipart/alternative; boundary="{self.alt_boundary}"\r\n'
+                             'MIME-Version: 1.0\r\n\r\n').encode('ascii')
+        self._alt_open = f'--{self.alt_boundary}\r\n'.encode('ascii')
+        self._alt_next = f'\r\n--{self.alt_boundary}\r\n'.encode('ascii')
+        self._alt_close = f'\r\n--{self.alt_boundary}--'.encode('ascii')
+
+    def prepare(self, subject, html, text=None):
+        # Everything but the To header, which is left as an empty segment:
+        # recipients whose subject and parts come out the same share one
+        # PreparedMessage and only get their own To header (see address())
+        subject_header = _header('Subject', subject).encode('utf-8')
+        html_part = _text_part(html, 'html')
+
+        if text is None:
+            body = [html_part]
+        else:
+            body = [self._alt_open, _text_part(text, 'plain'), self._alt_next, html_part, self._alt_close]
+
+        if self.attachments:
+            segments = [self._mixed_headers, self._from_header, b'', subject_header, self._mixed_open]
+            if text is not None:
+                segments.append(self._alt_headers)
+            segments.extend(body)
+            segments.extend(self._attachment_segments)
+            segments.append(self._mixed_close)
+        elif text is not None:
+            segments = [self._alt_headers[:-2], self._from_header, b'', subject_header, b'\r\n']
+            segments.extend(body)
+            segments.append(b'\r\n')
+        else:
+            # A lone HTML part: its own Content-* headers become the message headers
+            segments = [self._from_header, b'', subject_header, html_part, b'\r\n']
+        return PreparedMessage(segments, sum(len(segment) for segment in segments), segments.index(b''))
+
+    def address(self, prepared, to_addr):
+        to_header = _header('To', to_addr).encode('utf-8')
+        segments = list(prepared.segments)
+        segments[prepared.to_index] = to_header
+        return WireMessage(segments, prepared.size + len(to_header))
+
+    def build(self, to_addr, subject, html, text=None):
+        return self.address(self.prepare(subject, html, text), to_addr)
+
+    def build_bytes(self, to_addr, subject, html, text=None):
+        # Single buffer, for callers (previews, file transports) that want one
+        return b''.join(self.build(to_addr, subject, html, text).segments)
+
+
+def _envelope(server, from_addr, to_addrs, options):
+    # Returns the MAIL reply and one reply per RCPT. With PIPELINING (RFC 2920)
+    # the whole envelope goes out in one write and the replies are read back
+    # in order: one round trip instead of one per command.
+    if not server.has_extn('pipelining'):
+        mail_reply = server.mail(from_addr, options)
+        if mail_reply[0] != 250:
+            return mail_reply, []
+        return mail_reply, [server.rcpt(addr) for addr in to_addrs]
+    option_list = ''.join(' ' + option for option in options)
+    commands = [f'mail FROM:{smtplib.quoteaddr(from_addr)}{option_list}\r\n']
+    commands.extend(f'rcpt TO:{smtplib.quoteaddr(addr)}\r\n' for addr in to_addrs)
+    server.send(''.join(commands))
+    mail_reply = server.getreply()
+    if mail_reply[0] == 421:
+        # The server is closing the connection, no more replies are coming
+        return mail_reply, []
+    # Every other pipelined command still gets a reply, even after a refused MAIL
+    return mail_reply, [server.getreply() for _ in to_addrs]
+
+
+def send_wire_message(server, from_addr, to_addrs, message):
+    # smtplib.sendmail without the full-message copy: run MAIL/RCPT (pipelined
+    # when the server allows it), then write the precomputed segments straight
+    # to the socket during DATA. Returns the refused-recipients dict like
+    # sendmail does.
+    if isinstance(to_addrs, str):
+        to_addrs = [to_addrs]
+    server.ehlo_or_helo_if_needed()
+    options = []
+    if server.has_extn('size'):
+        options.append(f'SIZE={message.size}')
+    with metrics.timer('envelope'):
+        (code, resp), rcpt_replies = _envelope(server, from_addr, to_addrs, options)
+    if code != 250:
+        _reset(server, code)
+        raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+    refused = {}
+    for addr, (code, resp) in zip(to_addrs, rcpt_replies):
+        if code not in (250, 251):
+            refused[addr] = (code, resp)
+    if len(refused) == len(to_addrs):
+        _reset(server, 250)
+        raise smtplib.SMTPRecipientsRefused(refused)
+
+    data_started = time.perf_counter()
+    server.putcmd('data')
+    code, resp = server.getreply()
+    if code != 354:
+        _reset(server, code)
+        raise smtplib.SMTPDataError(code, resp)
+    serialize_started = time.perf_counter()
+    sock = server.sock
+    pending = []
+    pending_size = 0
+    for segment in message.segments:
+        if len(segment) >= _WRITE_SIZE:
+            if pending:
+                sock.sendall(b''.join(pending))
+                pending, pending_size = [], 0
+            sock.sendall(segment)
+            continue
+        pending.append(segment)
+        pending_size += len(segment)
+        if pending_size >= _WRITE_SIZE:
+            sock.sendall(b''.join(pending))
+            pending, pending_size = [], 0
+    last = message.segments[-1] if message.segments else b''
+    pending.append(b'.\r\n' if last[-2:] == b'\r\n' else b'\r\n.\r\n')
+    sock.sendall(b''.join(pending))
+    metrics.observe('serialize', time.perf_counter() - serialize_started)
+    code, resp = server.getreply()
+    # DATA command through the server's final reply
+    metrics.observe('data', time.perf_counter() - data_started)
+    if code != 250:
+        _reset(server, code)
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
+
+
+def _reset(server, code):
+    # Same clean-up smtplib.sendmail does after a refused transaction
+    if code == 421:
+        server.close()
+        return
+    try:
+        server.rset()
+    except smtplib.SMTPServerDisconnected:
+        pass
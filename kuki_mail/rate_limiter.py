@@ -0,0 +1,155 @@
+import asyncio
+import smtplib
+import threading
+import time
+
+from .metrics import metrics
+
+DEFAULT_PER_SECOND = 10
+# Reply codes Gmail (and most relays) use for "slow down / try again later"
+TEMPORARY_REPLY_CODES = {421, 450, 451, 452, 454}
+
+
+def reply_code(error):
+    # Pull the SMTP reply code out of whatever smtplib raised, if any
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in error.recipients.values()]
+        return min(codes) if codes else None
+    return getattr(error, 'smtp_code', None)
+
+
+class TokenBucket:
+    # Classic token bucket: `rate` tokens per second up to `capacity`
+
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated = clock()
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated = now
+
+    def wait_time(self, now, tokens=1):
+        self._refill(now)
+        # Small epsilon so float rounding in the refill can't spin us forever
+        if self.tokens >= tokens - 1e-9:
+            return 0.0
+        return (tokens - self.tokens) / self.rate
+
+    def take(self, tokens=1):
+        self.tokens -= tokens
+
+
+class RateLimiter:
+    # Shared by every sender worker. Enforces per-second/minute/day quotas and
+    # adapts the per-second rate AIMD style: additive increase while the server
+    # accepts messages, multiplicative decrease plus a pause on 4xx "try later"
+    # replies.
+
+    def __init__(self, per_second=DEFAULT_PER_SECOND, per_minute=None, per_day=None,
+                 min_rate=0.2, decrease_factor=0.5, increase_step=0.5, backoff=5.0,
+                 max_backoff=300.0, clock=time.monotonic, sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self.max_rate = float(per_second) if per_second else None
+        self.min_rate = min_rate
+        self.decrease_factor = decrease_factor
+        self.increase_step = increase_step
+        self.base_backoff = backoff
+        self.max_backoff = max_backoff
+        self._backoff = backoff
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+        self.second_bucket = None
+        self.buckets = []
+        if per_second:
+            self.second_bucket = TokenBucket(per_second, max(1.0, per_second), clock)
+            self.buckets.append(self.second_bucket)
+        if per_minute:
+            self.buckets.append(TokenBucket(per_minute / 60.0, per_minute, clock))
+        if per_day:
+            self.buckets.append(TokenBucket(per_day / 86400.0, per_day, clock))
+
+    @property
+    def rate(self):
+        return self.second_bucket.rate if self.second_bucket else None
+
+    def _wait_time(self, now, tokens):
+        wait = self._paused_until - now
+        for bucket in self.buckets:
+            wait = max(wait, bucket.wait_time(now, min(tokens, bucket.capacity)))
+        return wait
+
+    def wait_time(self, tokens=1):
+        # Seconds until acquire(tokens) would go through, without taking anything
+        with self._lock:
+            return max(0.0, self._wait_time(self.clock(), tokens))
+
+    def acquire(self, tokens=1):
+        # Block until every quota has the tokens available, then consume them.
+        # A multi-recipient envelope costs one token per recipient; if that is
+        # more than a bucket can ever hold, the bucket goes into debt and
+        # later sends wait it off.
+        waited = 0.0
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait <= 0:
+                break
+            self.sleep(wait)
+            waited += wait
+        if waited:
+            # Time held back by quotas or a server-requested pause
+            metrics.observe('throttle', waited)
+
+    async def acquire_async(self, tokens=1):
+        # acquire() for coroutines: waits with asyncio.sleep, so the other
+        # sessions on the event loop keep going meanwhile
+        waited = 0.0
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+            waited += wait
+        if waited:
+            metrics.observe('throttle', waited)
+
+    def try_acquire(self, tokens=1):
+        # Consumes the tokens and returns 0.0 if every quota has them,
+        # otherwise takes nothing and returns the seconds to wait
+        with self._lock:
+            wait = self._wait_time(self.clock(), tokens)
+            if wait <= 0:
+                for bucket in self.buckets:
+                    bucket.take(tokens)
+                return 0.0
+            return wait
+
+    def on_success(self):
+        with self._lock:
+            self._backoff = self.base_backoff
+            if self.second_bucket and self.second_bucket.rate < self.max_rate:
+                # Roughly +increase_step msgs/sec for every second of clean sending
+                bucket = self.second_bucket
+                bucket.rate = min(self.max_rate, bucket.rate + self.increase_step / bucket.rate)
+
+    def on_error(self, error):
+        if reply_code(error) in TEMPORARY_REPLY_CODES:
+            self.throttle()
+
+    def throttle(self):
+        metrics.increment('throttled')
+        with self._lock:
+            now = self.clock()
+            self._paused_until = max(self._paused_until, now + self._backoff)
+            self._backoff = min(self.max_backoff, self._backoff * 2)
+            if self.second_bucket:
+                bucket = self.second_bucket
+                bucket.rate = max(self.min_rate, bucket.rate * self.decrease_factor)
+                bucket.tokens = min(bucket.tokens, 0.0)
@@ -0,0 +1,252 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from .metrics import metrics
+from .mime_builder import WireMessage
+from .templating import RenderedMessage
+
+# In-memory budget for rendered bodies and built messages. Attachment bodies
+# are shared with the attachment cache and not counted here.
+DEFAULT_MEMORY_LIMIT = 32 * 1024 * 1024
+# Setting this to a directory turns on the on-disk tier
+RENDER_CACHE_DIR_ENV = 'KUKI_MAIL_RENDER_CACHE_DIR'
+DEFAULT_DISK_LIMIT = 256 * 1024 * 1024
+# Bigger messages (large attachments) stay memory only
+DISK_ENTRY_LIMIT = 8 * 1024 * 1024
+# Prepared messages kept per campaign and sender before starting over
+VARIANT_MEMORY_LIMIT = 64 * 1024 * 1024
+# Part of every key, bumped when rendering or the MIME layout changes so
+# stale disk entries are never served
+FORMAT_VERSION = 3
+
+
+def content_key(*parts):
+    # sha256 of template sources, variable values, addresses, attachment
+    # digests... as strings, None and tuples of them, whose repr is stable
+    # across processes (and cheaper than json.dumps per recipient)
+    return hashlib.sha256(repr((FORMAT_VERSION, parts)).encode('utf-8', 'surrogatepass')).hexdigest()
+
+
+def _variable_values(plan, variables):
+    # Only the variables the plan uses, in a stable order
+    return tuple(variables.get(name) for name in sorted(plan.variables))
+
+
+class RenderCache:
+    # Content-addressed: a message is keyed by the hash of its template
+    # sources (RenderPlan.key), the values of the variables it uses, the
+    # sender, the recipient and the attachment digests. The same test email
+    # clicked twice, a Streamlit rerun, a retried recipient or a resent
+    # campaign get the built message back instead of rendering and encoding
+    # it again. Entries are evicted least recently used to stay under
+    # `memory_limit`; with `disk_dir` entries stored with persist=True are
+    # also written there and survive restarts.
+
+    def __init__(self, memory_limit=DEFAULT_MEMORY_LIMIT, disk_dir=None, disk_limit=DEFAULT_DISK_LIMIT):
+        self.memory_limit = memory_limit
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self.disk_limit = disk_limit
+        self.memory_used = 0
+        self._disk_used = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def render(self, plan, variables, persist=False):
+        # RenderedMessage of a plan, for previews
+        if plan.key is None:
+            with metrics.timer('render'):
+                return plan.render(variables)
+        key = content_key('render', plan.key, _variable_values(plan, variables))
+        rendered = self._get(key, '.json')
+        if rendered is not None:
+            return rendered
+        with metrics.timer('render'):
+            rendered = plan.render(variables)
+        self._put(key, rendered, len(rendered.subject) + len(rendered.html) + len(rendered.text or ''), persist)
+        return rendered
+
+    def message(self, plan, variables, builder, to_addr, subject_prefix='', rendered=None, persist=False):
+        # The WireMessage for one recipient. `rendered` saves the render on a
+        # miss when the caller already has it (a preview).
+        if plan.key is None:
+            return self._build(plan, variables, builder, to_addr, subject_prefix, rendered)
+        key = content_key('message', plan.key, _variable_values(plan, variables), subject_prefix,
+                          builder.from_addr, to_addr, tuple((a.filename, a.digest) for a in builder.attachments))
+        message = self._get(key, '.eml')
+        if message is not None:
+            return message
+        message = self._build(plan, variables, builder, to_addr, subject_prefix, rendered)
+        # Only what this message owns counts, attachment bodies are shared
+        size = message.size - builder.shared_size
+        self._put(key, message, size, persist and message.size <= DISK_ENTRY_LIMIT)
+        return message
+
+    def _build(self, plan, variables, builder, to_addr, subject_prefix, rendered):
+        if rendered is None:
+            with metrics.timer('render'):
+                rendered = plan.render(variables)
+        with metrics.timer('build'):
+            return builder.build(to_addr, subject_prefix + rendered.subject, rendered.html, rendered.text)
+
+    def _get(self, key, suffix):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is not None:
+            metrics.increment('render_cache_hits')
+            return entry[0]
+        value = self._read(key, suffix)
+        if value is None:
+            metrics.increment('render_cache_misses')
+            return None
+        metrics.increment('render_cache_disk_hits')
+        size = value.size if suffix == '.eml' else len(value.html)
+        self._put(key, value, size, persist=False)
+        return value
+
+    def _put(self, key, value, size, persist):
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (value, size)
+                self.memory_used += size
+                while self.memory_used > self.memory_limit and len(self._entries) > 1:
+                    _, (_, evicted) = self._entries.popitem(last=False)
+                    self.memory_used -= evicted
+        if persist and self.disk_dir is not None:
+            self._write(key, value)
+
+    def _path(self, key, suffix):
+        return self.disk_dir / key[:2] / (key + suffix)
+
+    def _read(self, key, suffix):
+        if self.disk_dir is None:
+            return None
+        path = self._path(key, suffix)
+        try:
+            data = path.read_bytes()
+            os.utime(path)
+        except OSError:
+            return None
+        if suffix == '.eml':
+            return WireMessage([data], len(data))
+        return RenderedMessage(*json.loads(data))
+
+    def _write(self, key, value):
+        if isinstance(value, RenderedMessage):
+            path, data = self._path(key, '.json'), json.dumps(list(value)).encode('utf-8')
+        else:
+            path, data = self._path(key, '.eml'), b''.join(value.segments)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # Written under a temp name and renamed, a reader never sees half a file
+            with tempfile.NamedTemporaryFile(dir=path.parent, delete=False) as f:
+                f.write(data)
+            os.replace(f.name, path)
+        except OSError:
+            # The disk tier is an optimization, a full or read-only disk only costs speed
+            return
+        with self._lock:
+            if self._disk_used is None:
+                self._disk_used = sum(entry.stat().st_size for entry in self._disk_entries())
+            else:
+                self._disk_used += len(data)
+            over = self._disk_used > self.disk_limit
+        if over:
+            self._prune()
+
+    def _disk_entries(self):
+        return (entry for entry in self.disk_dir.glob('*/*') if entry.suffix in ('.eml', '.json'))
+
+    def _prune(self):
+        # Oldest used first (reads touch the mtime) down to 3/4 of the limit
+        entries = []
+        for entry in self._disk_entries():
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry))
+        entries.sort()
+        used = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if used <= self.disk_limit * 3 // 4:
+                break
+            try:
+                entry.unlink()
+            except OSError:
+                continue
+            used -= size
+        with self._lock:
+            self._disk_used = used
+
+    def clear(self, disk=False):
+        with self._lock:
+            self._entries.clear()
+            self.memory_used = 0
+        if disk and self.disk_dir is not None:
+            for entry in self._disk_entries():
+                entry.unlink(missing_ok=True)
+            with self._lock:
+                self._disk_used = 0
+
+
+class MessageVariants:
+    # Recipients whose template variables have the same values get the same
+    # subject and parts, only the To header differs. The variables are the
+    # ones the plan's templates use (found in the Jinja AST when they were
+    # compiled) that the recipient file has a column for, so each distinct
+    # tuple of values is rendered and encoded once and every recipient after
+    # that is a dict lookup plus one header. With many blank or repeated
+    # values (first names, an empty starting_line) that skips most of the work.
+
+    def __init__(self, plan, builder, variables, memory_limit=VARIANT_MEMORY_LIMIT):
+        self.plan = plan
+        self.builder = builder
+        self.variables = tuple(sorted(variables))
+        self.memory_limit = memory_limit
+        self.rendered = 0
+        self.messages = 0
+        self._prepared = {}
+        self._memory_used = 0
+        self._lock = threading.Lock()
+
+    def message(self, row):
+        values = tuple(map(row.get, self.variables))
+        prepared = self._prepared.get(values)
+        if prepared is None:
+            # Through the render cache, so a retry or a resend of the campaign
+            # in this process gets the rendered bodies back
+            rendered = render_cache.render(self.plan, dict(zip(self.variables, values)))
+            with metrics.timer('build'):
+                prepared = self.builder.prepare(rendered.subject, rendered.html, rendered.text)
+            with self._lock:
+                self.rendered += 1
+                self.messages += 1
+                # Nearly all distinct (unique names in every row): start over
+                # rather than hold a copy of every message
+                self._memory_used += prepared.size - self.builder.shared_size
+                if self._memory_used > self.memory_limit:
+                    self._prepared.clear()
+                    self._memory_used = 0
+                self._prepared[values] = prepared
+            metrics.increment('rendered')
+        else:
+            with self._lock:
+                self.messages += 1
+            metrics.increment('render_reused')
+        return self.builder.address(prepared, row.email)
+
+    @property
+    def ratio(self):
+        # Distinct renders per message, 1.0 when every recipient was different
+        return self.rendered / self.messages if self.messages else 1.0
+
+
+# Shared by the Streamlit apps so reruns, previews and resends reuse the work
+render_cache = RenderCache(disk_dir=os.getenv(RENDER_CACHE_DIR_ENV))
@@ -0,0 +1,132 @@
+import csv
+import heapq
+import io
+import itertools
+import random
+import smtplib
+import ssl
+import threading
+import time
+from pathlib import Path
+
+from .rate_limiter import reply_code
+from .settings import data_path
+
+TRANSIENT = 'transient'
+PERMANENT = 'permanent'
+FATAL = 'fatal'
+
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_BASE_DELAY = 30.0
+DEFAULT_MAX_DELAY = 15 * 60.0
+DEAD_LETTER_DIR = 'dead_letters'
+DEAD_LETTER_FIELDS = ('row', 'email', 'code', 'error', 'attempts', 'at')
+# Failures setting up the connection itself (a wrong password, no STARTTLS
+# or AUTH, a certificate that doesn't verify, a 5xx greeting): every other
+# recipient would get the same, so they stop the campaign
+SETUP_ERRORS = (smtplib.SMTPAuthenticationError, smtplib.SMTPConnectError, smtplib.SMTPHeloError,
+                smtplib.SMTPNotSupportedError, ssl.SSLCertVerificationError)
+
+
+def classify(error):
+    # 4xx replies, dropped connections and network errors are worth another
+    # try later; 5xx replies and everything else (bad data) are not, and
+    # connection setup failures are fatal unless the server said 4xx
+    code = reply_code(error)
+    if isinstance(error, SETUP_ERRORS) and not (code is not None and 400 <= code < 500):
+        return FATAL
+    if code is not None:
+        return TRANSIENT if 400 <= code < 500 else PERMANENT
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return TRANSIENT
+    if isinstance(error, smtplib.SMTPException):
+        return PERMANENT
+    if isinstance(error, OSError):
+        return TRANSIENT
+    return PERMANENT
+
+
+class RetryPolicy:
+    # Exponential backoff with "equal jitter": half of the doubled delay is
+    # fixed, the other half random, so retries neither fire immediately nor
+    # arrive in lockstep
+
+    def __init__(self, max_attempts=DEFAULT_MAX_ATTEMPTS, base_delay=DEFAULT_BASE_DELAY,
+                 max_delay=DEFAULT_MAX_DELAY, rng=random.random):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.rng = rng
+
+    def should_retry(self, error, attempts):
+        return attempts < self.max_attempts and classify(error) == TRANSIENT
+
+    def delay(self, attempts):
+        ceiling = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return ceiling / 2 + self.rng() * ceiling / 2
+
+
+class DelayQueue:
+    # Min-heap on due time. Sends waiting for their retry sit here instead of
+    # in a sleeping worker, so the workers keep sending everything else.
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._heap = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def push(self, item, delay):
+        with self._lock:
+            heapq.heappush(self._heap, (self.clock() + delay, next(self._counter), item))
+
+    def pop_due(self):
+        # The earliest item whose time has come, or None
+        with self._lock:
+            if self._heap and self._heap[0][0] <= self.clock():
+                return heapq.heappop(self._heap)[2]
+        return None
+
+    def next_due_in(self):
+        with self._lock:
+            if not self._heap:
+                return None
+            return max(0.0, self._heap[0][0] - self.clock())
+
+    def __len__(self):
+        return len(self._heap)
+
+
+class DeadLetters:
+    # Recipients that failed for good, appended to a CSV as they happen so
+    # the file survives a crash and can be downloaded or fed back in later
+
+    def __init__(self, campaign=None, path=None):
+        if path is None:
+            folder = data_path(DEAD_LETTER_DIR)
+            folder.mkdir(parents=True, exist_ok=True)
+            path = folder / f'{campaign}.csv'
+        self.path = Path(path)
+        # A new run retries whatever failed last time, start the file over
+        self.path.unlink(missing_ok=True)
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def add(self, row, email, error, attempts=1):
+        with self._lock:
+            is_new = not self.path.exists() or self.path.stat().st_size == 0
+            with open(self.path, 'a', newline='', encoding='utf-8') as f:
+                writer = csv.writer(f)
+                if is_new:
+                    writer.writerow(DEAD_LETTER_FIELDS)
+                writer.writerow((row, email, reply_code(error) or '', str(error), attempts,
+                                 time.strftime('%Y-%m-%d %H:%M:%S')))
+            self.count += 1
+
+    def export(self):
+        # CSV bytes for st.download_button
+        if not self.path.exists():
+            output = io.StringIO()
+            csv.writer(output).writerow(DEAD_LETTER_FIELDS)
+            return output.getvalue().encode('utf-8')
+        return self.path.read_bytes()
@@ -0,0 +1,604 @@
+import csv
+import io
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from .campaign import send_bulk_emails, campaign_plan
+from .journal import campaign_id
+from .layouts import SIMPLE
+from .rate_limiter import RateLimiter, DEFAULT_PER_SECOND, reply_code
+from .recipients import Recipient, RecipientSource
+from .retry import RetryPolicy, DEAD_LETTER_FIELDS, FATAL, classify
+from .send_engine import DEFAULT_CONCURRENCY
+from .settings import data_path
+from .suppression import shared_index
+from .transports import get_transport
+from .validation import validate_recipients
+
+SCHEDULE_FILE = 'schedule.sqlite3'
+
+# Schedule states
+ACTIVE = 'active'
+PAUSED = 'paused'
+CANCELLED = 'cancelled'
+DONE = 'done'
+
+# Queue item states
+PENDING = 'pending'
+SENDING = 'sending'
+SENT = 'sent'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+# Optional recipient column with an IANA zone name, e.g. Europe/Berlin
+TIMEZONE_COLUMN = 'timezone'
+DEFAULT_TIMEZONE = 'UTC'
+# Recipients of one time zone are spread over this many seconds after the
+# local send time instead of all going out on the minute
+DEFAULT_SPREAD = 3600
+# Due items sent per send_bulk_emails call
+BATCH_SIZE = 200
+# Longest sleep with nothing due, so schedules another process added
+# (the CLI next to the UI) are picked up without a wakeup
+IDLE_RECHECK = 60.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS schedules (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    sender_email TEXT NOT NULL,
+    config TEXT NOT NULL,
+    state TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS schedule_files (
+    schedule TEXT NOT NULL,
+    name TEXT NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (schedule, name)
+);
+CREATE TABLE IF NOT EXISTS queue (
+    id INTEGER PRIMARY KEY,
+    schedule TEXT NOT NULL,
+    step INTEGER NOT NULL,
+    due REAL NOT NULL,
+    row INTEGER NOT NULL,
+    email TEXT NOT NULL,
+    data TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    owner TEXT,
+    at REAL,
+    code INTEGER,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS queue_due ON queue (state, due);
+CREATE INDEX IF NOT EXISTS queue_schedule ON queue (schedule, state);
+"""
+
+
+def _owner():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    # Killed but not reaped yet (a container without an init) still answers kill(0)
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            return f.read().rpartition(')')[2].split()[0] != 'Z'
+    except OSError:
+        return True
+
+
+def _zone(name, default, cache):
+    # Unknown or empty zone names fall back to the default zone
+    zone = cache.get(name)
+    if zone is None:
+        try:
+            zone = ZoneInfo(name.strip()) if name and name.strip() else default
+        except (ZoneInfoNotFoundError, ValueError):
+            zone = default
+        cache[name] = zone
+    return zone
+
+
+def window_times(count, start, end=None):
+    # Evenly spaced send times from start to (just before) end
+    if end is None or end <= start or count <= 1:
+        return [start] * count
+    step = (end - start) / count
+    return [start + step * i for i in range(count)]
+
+
+def local_times(zones, day, at, spread=DEFAULT_SPREAD, not_before=None):
+    # `at` (a datetime.time) on `day` in each recipient's zone, or the next
+    # day where that moment already passed; recipients of one zone are
+    # spread evenly over `spread` seconds from there
+    not_before = time.time() if not_before is None else not_before
+    by_zone = {}
+    for index, zone in enumerate(zones):
+        by_zone.setdefault(zone, []).append(index)
+    times = [0.0] * len(zones)
+    for zone, indexes in by_zone.items():
+        moment = datetime.combine(day, at, tzinfo=zone)
+        while moment.timestamp() < not_before:
+            moment += timedelta(days=1)
+        for offset, when in zip(indexes, window_times(len(indexes), moment.timestamp(),
+                                                      moment.timestamp() + spread)):
+            times[offset] = when
+    return times
+
+
+def next_step_due(previous_due, delay, sent_at):
+    # A follow-up `delay` seconds after the previous step was due, which keeps
+    # the local hour of time-zone schedules. If the previous step went out
+    # late by more than half the delay (the scheduler was down), count from
+    # the actual send instead so two steps never arrive back to back.
+    due = previous_due + delay
+    if due < sent_at + delay / 2:
+        due = sent_at + delay
+    return due
+
+
+class ScheduleQueue:
+    # Persistent, time-ordered queue of every scheduled message in SQLite
+    # (WAL mode), one row per recipient and step, plus the schedules
+    # themselves and their attachments. Survives restarts: a message is
+    # only marked sent once the server accepted it.
+
+    def __init__(self, path=None):
+        self.path = path or data_path(SCHEDULE_FILE)
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None,
+                                     timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+
+    def _write(self, statements):
+        # [(sql, rows)] in one transaction, executemany for each
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                for sql, rows in statements:
+                    self._conn.executemany(sql, rows)
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+    def exists(self, schedule):
+        with self._lock:
+            return self._conn.execute('SELECT 1 FROM schedules WHERE id = ?', (schedule,)).fetchone() is not None
+
+    def add(self, schedule, name, sender_email, config, files, items):
+        # items: (step, due, row, email, data) tuples
+        self._write([
+            ('INSERT INTO schedules (id, name, sender_email, config, state, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+             [(schedule, name, sender_email, json.dumps(config), ACTIVE, time.time())]),
+            ('INSERT OR REPLACE INTO schedule_files (schedule, name, data) VALUES (?, ?, ?)',
+             [(schedule, file_name, data) for file_name, data in files]),
+            ('INSERT INTO queue (schedule, step, due, row, email, data, state) VALUES (?, ?, ?, ?, ?, ?, ?)',
+             ((schedule, step, due, row, email, data, PENDING) for step, due, row, email, data in items)),
+        ])
+
+    def schedule(self, schedule):
+        with self._lock:
+            found = self._conn.execute(
+                'SELECT name, sender_email, config, state FROM schedules WHERE id = ?', (schedule,)).fetchone()
+        if found is None:
+            raise ValueError(f"No scheduled campaign {schedule!r}")
+        name, sender_email, config, state = found
+        return {'id': schedule, 'name': name, 'sender_email': sender_email, 'state': state, **json.loads(config)}
+
+    def files(self, schedule):
+        with self._lock:
+            return self._conn.execute(
+                'SELECT name, data FROM schedule_files WHERE schedule = ? ORDER BY name', (schedule,)).fetchall()
+
+    def set_state(self, schedule, state):
+        statements = [('UPDATE schedules SET state = ? WHERE id = ?', [(state, schedule)])]
+        if state == CANCELLED:
+            statements.append(('UPDATE queue SET state = ?, at = ? WHERE schedule = ? AND state = ?',
+                               [(CANCELLED, time.time(), schedule, PENDING)]))
+        self._write(statements)
+
+    def _ready(self, senders):
+        # Active schedules of senders this process has a password for
+        marks = ', '.join('?' * len(senders))
+        return (f"q.state = '{PENDING}' AND s.state = '{ACTIVE}' AND s.sender_email IN ({marks})",
+                tuple(senders))
+
+    def next_due(self, senders):
+        if not senders:
+            return None
+        where, params = self._ready(senders)
+        with self._lock:
+            return self._conn.execute(
+                f'SELECT MIN(q.due) FROM queue q JOIN schedules s ON s.id = q.schedule WHERE {where}',
+                params).fetchone()[0]
+
+    def claim_due(self, senders, now=None, limit=BATCH_SIZE):
+        # The earliest due items of one schedule step, marked as ours
+        if not senders:
+            return []
+        now = time.time() if now is None else now
+        where, params = self._ready(senders)
+        with self._lock:
+            first = self._conn.execute(
+                f'SELECT q.schedule, q.step FROM queue q JOIN schedules s ON s.id = q.schedule '
+                f'WHERE {where} AND q.due <= ? ORDER BY q.due LIMIT 1', params + (now,)).fetchone()
+            if first is None:
+                return []
+            self._conn.execute('BEGIN IMMEDIATE')
+            items = self._conn.execute(
+                'SELECT id, schedule, step, due, row, email, data, attempts FROM queue '
+                'WHERE schedule = ? AND step = ? AND state = ? AND due <= ? ORDER BY due LIMIT ?',
+                first + (PENDING, now, limit)).fetchall()
+            self._conn.executemany('UPDATE queue SET state = ?, owner = ?, at = ? WHERE id = ?',
+                                   [(SENDING, _owner(), now, item[0]) for item in items])
+            self._conn.execute('COMMIT')
+        return items
+
+    def finish(self, updates, follow_ups):
+        # updates: (state, due, attempts, error, id); follow_ups as for add()
+        now = time.time()
+        self._write([
+            ('UPDATE queue SET state = ?, due = ?, attempts = ?, code = ?, error = ?, owner = NULL, at = ? '
+             'WHERE id = ?',
+             [(state, due, attempts, error and reply_code(error), error and str(error), now, item)
+              for state, due, attempts, error, item in updates]),
+            ('INSERT INTO queue (schedule, step, due, row, email, data, state) VALUES (?, ?, ?, ?, ?, ?, ?)',
+             [(schedule, step, due, row, email, data, PENDING) for schedule, step, due, row, email, data in follow_ups]),
+        ])
+
+    def release_abandoned(self):
+        # Items a crashed process on this machine had claimed go back to
+        # pending. The server may have accepted some of them before the
+        # crash, so those recipients can get that one message twice.
+        host = socket.gethostname()
+        with self._lock:
+            owners = [owner for (owner,) in self._conn.execute(
+                'SELECT DISTINCT owner FROM queue WHERE state = ? AND owner IS NOT NULL', (SENDING,))]
+        dead = [owner for owner in owners
+                if owner.rpartition(':')[0] == host and not _pid_alive(int(owner.rpartition(':')[2]))]
+        self._write([('UPDATE queue SET state = ?, owner = NULL WHERE state = ? AND owner = ?',
+                      [(PENDING, SENDING, owner) for owner in dead])])
+        return len(dead)
+
+    def dead_letters(self, schedule):
+        # Messages that failed for good, as the CSV a DeadLetters export has
+        with self._lock:
+            failed = self._conn.execute(
+                'SELECT row, email, code, error, attempts, at FROM queue WHERE schedule = ? AND state = ? ORDER BY at',
+                (schedule, FAILED)).fetchall()
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(DEAD_LETTER_FIELDS)
+        for row, email, code, error, attempts, at in failed:
+            writer.writerow((row, email, code or '', error, attempts,
+                             time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(at))))
+        return output.getvalue().encode('utf-8')
+
+    def summaries(self):
+        # One dict per schedule, newest first, for the CLI and the UI
+        with self._lock:
+            schedules = self._conn.execute(
+                'SELECT id, name, sender_email, config, state, created_at FROM schedules '
+                'ORDER BY created_at DESC').fetchall()
+            counts = self._conn.execute(
+                'SELECT schedule, state, COUNT(*) FROM queue GROUP BY schedule, state').fetchall()
+            due = dict(self._conn.execute(
+                'SELECT schedule, MIN(due) FROM queue WHERE state = ? GROUP BY schedule', (PENDING,)).fetchall())
+        by_schedule = {}
+        for schedule, state, count in counts:
+            by_schedule.setdefault(schedule, {})[state] = count
+        summaries = []
+        for schedule, name, sender_email, config, state, created_at in schedules:
+            states = by_schedule.get(schedule, {})
+            if state == ACTIVE and not states.get(PENDING) and not states.get(SENDING):
+                state = DONE
+            summaries.append({
+                'id': schedule, 'name': name, 'sender_email': sender_email, 'state': state,
+                'steps': len(json.loads(config)['steps']), 'created_at': created_at,
+                'next_due': due.get(schedule), 'counts': states,
+            })
+        return summaries
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def _file_bytes(file):
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, 'rb') as f:
+            return os.path.basename(file), f.read()
+    file.seek(0)
+    return os.path.basename(file.name), file.read()
+
+
+def schedule_campaign(recipients_file, sender_email, steps, attachments=(), name=None, start=None, end=None,
+                      local_time=None, spread=DEFAULT_SPREAD, default_timezone=DEFAULT_TIMEZONE, layout=SIMPLE,
+                      greeting=None, concurrency=DEFAULT_CONCURRENCY, per_second=DEFAULT_PER_SECOND,
+                      per_minute=None, per_day=None, check_deliverability=True, queue=None):
+    # Puts every recipient's first step in the queue. `steps` is a list of
+    # {'subject', 'content', 'delay'} dicts, delay being the seconds after
+    # the previous step (ignored for the first one). The first step goes out
+    # - evenly spread from `start` to `end` (timestamps; default: now), or
+    # - at `local_time` (datetime.time) on the day of `start` in each
+    #   recipient's zone from the `timezone` column, spread over `spread`.
+    # The same inputs give the same id; scheduling them again is a no-op.
+    if not steps:
+        raise ValueError("A scheduled campaign needs at least one step")
+    queue = queue or shared_scheduler().queue
+    recipients_name, recipients_data = _file_bytes(recipients_file)
+    start = time.time() if start is None else start
+    schedule = campaign_id(sender_email, json.dumps(steps, sort_keys=True), recipients_data, layout, greeting,
+                           str(round(start / 60)), str(end and round(end / 60)), str(local_time), str(spread),
+                           default_timezone)
+    if queue.exists(schedule):
+        return schedule
+
+    recipients = RecipientSource(io.BytesIO(recipients_data), recipients_name)
+    missing = recipients.missing_columns()
+    if missing:
+        raise ValueError(f"The recipient file has no {', '.join(missing)} column")
+    # Bad and duplicate addresses never enter the queue; suppressions are
+    # checked here and again when each message is due
+    report = validate_recipients(recipients, check_deliverability)
+    recipients.skip_rows = report.duplicates | report.invalid_rows.keys()
+    recipients.skip_rows |= shared_index().suppressed_rows(recipients)
+
+    columns = sorted(recipients.columns, key=recipients.columns.get)
+    rows = [(recipient.row, recipient.email, recipient.values) for recipient in recipients]
+    if local_time is not None:
+        try:
+            default = ZoneInfo(default_timezone)
+        except (ZoneInfoNotFoundError, ValueError):
+            raise ValueError(f"Unknown time zone {default_timezone!r}") from None
+        cache = {}
+        zones = [_zone(values[recipients.columns[TIMEZONE_COLUMN]] if TIMEZONE_COLUMN in recipients.columns
+                       and recipients.columns[TIMEZONE_COLUMN] < len(values) else '', default, cache)
+                 for _, _, values in rows]
+        times = local_times(zones, date.fromtimestamp(start), local_time, spread,
+                            not_before=max(start, time.time()))
+    else:
+        times = window_times(len(rows), start, end)
+
+    config = {
+        'steps': steps, 'columns': columns, 'layout': layout, 'greeting': greeting,
+        'concurrency': concurrency, 'per_second': per_second, 'per_minute': per_minute, 'per_day': per_day,
+        'start': start, 'end': end, 'local_time': local_time and local_time.isoformat(),
+        'default_timezone': default_timezone, 'invalid': len(report.invalid_rows),
+        'skipped': len(recipients.skip_rows),
+    }
+    items = ((0, due, row, email, json.dumps(values)) for due, (row, email, values) in zip(times, rows))
+    files = [_file_bytes(attachment) for attachment in attachments or []]
+    queue.add(schedule, name or f"{steps[0]['subject']} ({recipients_name})", sender_email, config, files, items)
+    shared_scheduler().notify()
+    return schedule
+
+
+class _QueuedRecipients:
+    # The claimed items as the recipient source send_bulk_emails expects
+
+    def __init__(self, columns, items):
+        self.columns = {column: index for index, column in enumerate(columns)}
+        self.items = items
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        for item in self.items:
+            yield Recipient(item[4], tuple(json.loads(item[6])), self.columns)
+
+
+class _BatchJournal:
+    # Stands in for a SendJournal: send_bulk_emails reports every result
+    # here, and the queue is updated in one transaction when the batch ends.
+    # Failures arrive through error() first, which sees the exception:
+    # transient ones are put back in the queue with a backoff, instead of
+    # holding the scheduler thread in the engine's retry loop.
+
+    def __init__(self, schedule, steps, items, retry):
+        self.campaign = schedule
+        self.steps = steps
+        self.items = {item[4]: item for item in items}
+        self.retry = retry
+        self.updates = []
+        self.follow_ups = []
+        self.reported = set()
+
+    def completed_rows(self):
+        return set()
+
+    def queued(self, row, email):
+        pass
+
+    def sent(self, row, email):
+        item_id, schedule, step, due, _, _, data, attempts = self.items[row]
+        self.reported.add(row)
+        self.updates.append((SENT, due, attempts + 1, None, item_id))
+        if step + 1 < len(self.steps):
+            next_due = next_step_due(due, self.steps[step + 1].get('delay', 0), time.time())
+            self.follow_ups.append((schedule, step + 1, next_due, row, email, data))
+
+    def error(self, recipient, error):
+        item_id, _, _, due, row, email, _, attempts = self.items[recipient.row]
+        self.reported.add(row)
+        attempts += 1
+        if self.retry.should_retry(error, attempts):
+            self.updates.append((PENDING, time.time() + self.retry.delay(attempts), attempts, error, item_id))
+        else:
+            self.updates.append((FAILED, due, attempts, error, item_id))
+
+    def failed(self, row, email, code=None, error=None):
+        # Already handled by error()
+        pass
+
+    def unreported(self, state):
+        # Items send_bulk_emails never reported: suppressed since they were
+        # queued (SKIPPED), or left unsent by a crash or stop (PENDING)
+        return [(state, item[3], item[7], None, item[0])
+                for row, item in self.items.items() if row not in self.reported]
+
+
+class Scheduler:
+    # Sends whatever the queue has due, on one background thread. The thread
+    # sleeps on a Condition until the earliest due item (or a new schedule,
+    # password or state change wakes it) instead of polling the queue.
+    # Passwords are never stored: after a restart a sender's schedules wait
+    # until add_password() is called again (the UI's Resume button, or the
+    # `python -m kuki_mail scheduler` worker).
+
+    def __init__(self, queue=None):
+        self.queue = queue or ScheduleQueue()
+        self._passwords = {}
+        self._wakeup = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        # sender -> ((password, concurrency), pool)
+        self._pools = {}
+        self._limiters = {}
+        self.last_error = None
+
+    def add_password(self, sender_email, password):
+        with self._wakeup:
+            self._passwords[sender_email] = password
+            self._wakeup.notify()
+        self.start()
+        return self
+
+    def has_password(self, sender_email):
+        return sender_email in self._passwords
+
+    def notify(self):
+        with self._wakeup:
+            self._wakeup.notify()
+
+    def set_state(self, schedule, state):
+        self.queue.set_state(schedule, state)
+        self.notify()
+
+    def start(self):
+        with self._wakeup:
+            if self._thread is not None and self._thread.is_alive():
+                return self
+            self.queue.release_abandoned()
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='kuki-mail-scheduler', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        with self._wakeup:
+            self._stopping = True
+            self._wakeup.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        for _, pool in self._pools.values():
+            pool.close()
+        self._pools.clear()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _next_batch(self):
+        with self._wakeup:
+            while not self._stopping:
+                senders = tuple(self._passwords)
+                items = self.queue.claim_due(senders)
+                if items:
+                    return items
+                due = self.queue.next_due(senders)
+                timeout = IDLE_RECHECK if due is None else min(IDLE_RECHECK, max(0.0, due - time.time()))
+                self._wakeup.wait(timeout)
+            return None
+
+    def _run(self):
+        while True:
+            items = self._next_batch()
+            if items is None:
+                return
+            try:
+                self._send(items)
+                self.last_error = None
+            except Exception as e:
+                # A bad schedule (e.g. a broken template) must not stop the others
+                self.last_error = f"{items[0][1]}: {e}"
+
+    def _send(self, items):
+        schedule_id, step = items[0][1], items[0][2]
+        schedule = self.queue.schedule(schedule_id)
+        sender_email = schedule['sender_email']
+        password = self._passwords[sender_email]
+        # Connections are reused across batches while the password (changed
+        # with add_password) and the connection count stay the same
+        settings = (password, schedule['concurrency'])
+        cached = self._pools.get(sender_email)
+        if cached is None or cached[0] != settings:
+            if cached is not None:
+                cached[1].close()
+            cached = self._pools[sender_email] = (settings, get_transport().pool(
+                sender_email, password, size=schedule['concurrency']))
+        pool = cached[1]
+        # Quotas hold across batches, so a window can't add up to a burst
+        limiter = self._limiters.get(schedule_id)
+        if limiter is None:
+            limiter = self._limiters[schedule_id] = RateLimiter(
+                schedule['per_second'], schedule['per_minute'], schedule['per_day'])
+        steps = schedule['steps']
+        plan = campaign_plan(steps[step]['subject'], steps[step]['content'], schedule['layout'],
+                             schedule['greeting'])
+        attachments = []
+        for file_name, data in self.queue.files(schedule_id):
+            attachment = io.BytesIO(data)
+            attachment.name = file_name
+            attachments.append(attachment)
+        journal = _BatchJournal(schedule_id, steps, items, RetryPolicy())
+        try:
+            send_bulk_emails(
+                _QueuedRecipients(schedule['columns'], items), sender_email, password, None, None, attachments,
+                pool=pool, concurrency=schedule['concurrency'], limiter=limiter, journal=journal,
+                on_error=journal.error, plan=plan, suppressions=shared_index(),
+            )
+        except BaseException as e:
+            self.queue.finish(journal.updates + journal.unreported(PENDING), journal.follow_ups)
+            if classify(e) == FATAL:
+                # A wrong password would fail the next batch the same way: the
+                # sender's schedules wait for add_password() (Resume) again
+                with self._wakeup:
+                    if self._passwords.get(sender_email) == password:
+                        del self._passwords[sender_email]
+            raise
+        self.queue.finish(journal.updates + journal.unreported(SKIPPED), journal.follow_ups)
+
+
+_shared_scheduler = None
+_shared_lock = threading.Lock()
+
+
+def shared_scheduler():
+    # One scheduler per process and data directory; its thread starts with
+    # the first password
+    global _shared_scheduler
+    with _shared_lock:
+        path = data_path(SCHEDULE_FILE)
+        if _shared_scheduler is None or _shared_scheduler.queue.path != path:
+            _shared_scheduler = Scheduler(ScheduleQueue(path))
+        return _shared_scheduler
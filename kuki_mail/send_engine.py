@@ -0,0 +1,363 @@
+import asyncio
+import queue
+import smtplib
+import threading
+import time
+from collections import namedtuple
+
+from .metrics import metrics
+from .retry import DelayQueue, FATAL, classify
+
+DEFAULT_CONCURRENCY = 4
+# Gmail allows at most 15 simultaneous SMTP connections per account
+MAX_CONCURRENCY = 15
+
+_STOP = object()
+_WORKER_DONE = object()
+
+EngineStats = namedtuple('EngineStats', ['sent', 'failed', 'elapsed'])
+
+
+class SendResult(namedtuple('SendResult', ['item', 'error', 'value', 'attempts'], defaults=(None, 1))):
+    # `value` is whatever send_one returned, e.g. the refused-recipients dict,
+    # `attempts` how many times the item was tried
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def batched(items, size):
+    # Groups an iterable into lists of up to `size` items, lazily
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def split_batch_result(result, address=lambda item: item.email):
+    # One SendResult per recipient of a multi-RCPT envelope. Recipients the
+    # server refused get an SMTPRecipientsRefused of their own; if the whole
+    # envelope failed, every recipient shares the error.
+    error = result.error
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        refused, error = error.recipients, None
+    else:
+        refused = result.value or {}
+    for item in result.item:
+        if error is not None:
+            yield SendResult(item, error, None, result.attempts)
+            continue
+        reply = refused.get(address(item))
+        if reply is None:
+            yield SendResult(item, None, None, result.attempts)
+        else:
+            yield SendResult(item, smtplib.SMTPRecipientsRefused({address(item): reply}), None, result.attempts)
+
+
+class SendEngine:
+    # Runs `concurrency` workers that each hold one pooled connection and pull
+    # work from a shared bounded queue. Results are funnelled back to the
+    # calling thread so UI callbacks (Streamlit) never run on a worker thread.
+    # An optional RateLimiter is shared by all workers, and an optional
+    # threading.Event lets another thread (a background job) cancel the run.
+    # With a retry.RetryPolicy, transient failures wait in a delay heap and
+    # are fed back to the workers when due; only final results reach
+    # on_result.
+
+    def __init__(self, pool, concurrency=DEFAULT_CONCURRENCY, queue_size=None, limiter=None, cancel_event=None,
+                 retry=None):
+        self.pool = pool
+        self.limiter = limiter
+        self.retry = retry
+        self.concurrency = max(1, int(concurrency))
+        self.queue_size = queue_size or self.concurrency * 4
+        self._cancelled = cancel_event if cancel_event is not None else threading.Event()
+        self.delayed = DelayQueue()
+        # Items put in the work queue or the delay heap without a final result yet
+        self._outstanding = 0
+        self._outstanding_lock = threading.Lock()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def _put(self, work, item):
+        # Blocking put that still notices cancellation
+        while not self.cancelled:
+            try:
+                work.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _add_outstanding(self, count):
+        with self._outstanding_lock:
+            self._outstanding += count
+            return self._outstanding
+
+    def requeue(self, item, attempts, error):
+        # Schedules another attempt if the retry policy allows it. The engine
+        # does this for failed items itself; on_result can call it for parts
+        # of an item, e.g. the refused recipients of a batch.
+        if self.retry is None or not self.retry.should_retry(error, attempts):
+            return False
+        self._add_outstanding(1)
+        self.delayed.push((item, attempts + 1), self.retry.delay(attempts))
+        metrics.increment('retries')
+        return True
+
+    def _feed_due(self, work):
+        while True:
+            entry = self.delayed.pop_due()
+            if entry is None or not self._put(work, entry):
+                return
+
+    def _produce(self, items, work, errors):
+        try:
+            for item in items:
+                self._feed_due(work)
+                self._add_outstanding(1)
+                if not self._put(work, (item, 1)):
+                    break
+            # Source exhausted: keep feeding retries until every item has a final result
+            while not self.cancelled and self._add_outstanding(0):
+                self._feed_due(work)
+                next_due = self.delayed.next_due_in()
+                self._cancelled.wait(min(0.1, next_due) if next_due is not None else 0.1)
+        except Exception as e:
+            errors.append(e)
+            self.cancel()
+        finally:
+            for _ in range(self.concurrency):
+                work.put(_STOP)
+
+    def _work(self, send_one, work, results, weight):
+        try:
+            with self.pool.session() as session:
+                while True:
+                    entry = work.get()
+                    if entry is _STOP:
+                        break
+                    if self.cancelled:
+                        continue
+                    item, attempts = entry
+                    if self.limiter is not None:
+                        self.limiter.acquire(weight(item) if weight is not None else 1)
+                    try:
+                        value = send_one(session, item)
+                    except Exception as e:
+                        if classify(e) == FATAL:
+                            # Every other item would fail the same way, stop
+                            # taking work; run() raises it via on_result
+                            self.cancel()
+                        if self.limiter is not None:
+                            self.limiter.on_error(e)
+                        results.put(SendResult(item, e, None, attempts))
+                        continue
+                    metrics.increment('sent')
+                    if self.limiter is not None:
+                        self.limiter.on_success()
+                    results.put(SendResult(item, None, value, attempts))
+        finally:
+            results.put(_WORKER_DONE)
+
+    def run(self, items, send_one, on_result=None, weight=None):
+        # weight(item) is the number of rate limiter tokens an item costs,
+        # e.g. the recipient count of a batched envelope
+        started = time.perf_counter()
+        work = queue.Queue(maxsize=self.queue_size)
+        results = queue.Queue()
+        producer_errors = []
+
+        producer = threading.Thread(target=self._produce, args=(items, work, producer_errors), daemon=True)
+        workers = [
+            threading.Thread(target=self._work, args=(send_one, work, results, weight), daemon=True)
+            for _ in range(self.concurrency)
+        ]
+        producer.start()
+        for worker in workers:
+            worker.start()
+
+        sent = failed = 0
+        running = len(workers)
+        try:
+            while running:
+                result = results.get()
+                if result is _WORKER_DONE:
+                    running -= 1
+                    continue
+                if result.ok or not self.requeue(result.item, result.attempts, result.error):
+                    if result.ok:
+                        sent += 1
+                    else:
+                        failed += 1
+                        metrics.increment('failed')
+                    if on_result is not None:
+                        on_result(result)
+                # After on_result, which may have requeued parts of the item
+                self._add_outstanding(-1)
+        except BaseException:
+            self.cancel()
+            raise
+        finally:
+            # Cancelled workers keep draining the queue until they see _STOP
+            producer.join()
+            for worker in workers:
+                worker.join()
+
+        if producer_errors:
+            raise producer_errors[0]
+        return EngineStats(sent, failed, time.perf_counter() - started)
+
+
+class AsyncSendEngine:
+    # SendEngine on an asyncio event loop, for async pools (async_smtp.
+    # AsyncSMTPPool, transports' async_pool): `concurrency` worker coroutines
+    # each hold one session and pull from a bounded asyncio.Queue, so
+    # hundreds of in-flight SMTP sessions cost sockets instead of threads.
+    # send_one(session, item) is a coroutine. Limiter, retries and
+    # cancellation work like SendEngine's; on_result runs on the loop, in
+    # whichever worker got the result. The items iterator is read on the
+    # loop too (RecipientSource parses a chunk at a time).
+
+    def __init__(self, pool, concurrency=DEFAULT_CONCURRENCY, queue_size=None, limiter=None, cancel_event=None,
+                 retry=None):
+        self.pool = pool
+        self.limiter = limiter
+        self.retry = retry
+        self.concurrency = max(1, int(concurrency))
+        self.queue_size = queue_size or self.concurrency * 4
+        self._cancelled = cancel_event if cancel_event is not None else threading.Event()
+        self.delayed = DelayQueue()
+        # Items put in the work queue or the delay heap without a final result
+        # yet; only touched on the loop, no lock needed
+        self._outstanding = 0
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    async def _put(self, work, item):
+        # Waiting put that still notices cancellation (set from another thread)
+        while not self.cancelled:
+            if not work.full():
+                work.put_nowait(item)
+                return True
+            try:
+                await asyncio.wait_for(work.put(item), 0.1)
+                return True
+            except asyncio.TimeoutError:
+                continue
+        return False
+
+    def requeue(self, item, attempts, error):
+        # See SendEngine.requeue
+        if self.retry is None or not self.retry.should_retry(error, attempts):
+            return False
+        self._outstanding += 1
+        self.delayed.push((item, attempts + 1), self.retry.delay(attempts))
+        metrics.increment('retries')
+        return True
+
+    async def _feed_due(self, work):
+        while True:
+            entry = self.delayed.pop_due()
+            if entry is None or not await self._put(work, entry):
+                return
+
+    async def _produce(self, items, work, errors):
+        try:
+            for item in items:
+                await self._feed_due(work)
+                self._outstanding += 1
+                if not await self._put(work, (item, 1)):
+                    break
+            # Source exhausted: keep feeding retries until every item has a final result
+            while not self.cancelled and self._outstanding:
+                await self._feed_due(work)
+                next_due = self.delayed.next_due_in()
+                await asyncio.sleep(min(0.1, next_due) if next_due is not None else 0.1)
+        except Exception as e:
+            errors.append(e)
+            self.cancel()
+        finally:
+            # Workers keep taking from the queue until they see _STOP, so these fit
+            for _ in range(self.concurrency):
+                await work.put(_STOP)
+
+    async def _work(self, send_one, work, on_result, weight, counts, errors):
+        stopped = False
+        try:
+            async with self.pool.session() as session:
+                while True:
+                    entry = await work.get()
+                    if entry is _STOP:
+                        stopped = True
+                        break
+                    if self.cancelled:
+                        continue
+                    item, attempts = entry
+                    if self.limiter is not None:
+                        await self.limiter.acquire_async(weight(item) if weight is not None else 1)
+                    try:
+                        value = await send_one(session, item)
+                    except Exception as e:
+                        if classify(e) == FATAL:
+                            self.cancel()
+                        if self.limiter is not None:
+                            self.limiter.on_error(e)
+                        result = SendResult(item, e, None, attempts)
+                    else:
+                        metrics.increment('sent')
+                        if self.limiter is not None:
+                            self.limiter.on_success()
+                        result = SendResult(item, None, value, attempts)
+                    if result.ok or not self.requeue(result.item, result.attempts, result.error):
+                        counts[0 if result.ok else 1] += 1
+                        if not result.ok:
+                            metrics.increment('failed')
+                        if on_result is not None:
+                            on_result(result)
+                    # After on_result, which may have requeued parts of the item
+                    self._outstanding -= 1
+        except Exception as e:
+            errors.append(e)
+            self.cancel()
+            # Keep taking from the queue up to _STOP, the producer is waiting on it
+            while not stopped:
+                stopped = await work.get() is _STOP
+
+    async def run(self, items, send_one, on_result=None, weight=None):
+        # weight(item) is the number of rate limiter tokens an item costs
+        started = time.perf_counter()
+        work = asyncio.Queue(maxsize=self.queue_size)
+        counts = [0, 0]
+        errors = []
+        tasks = [asyncio.ensure_future(self._produce(items, work, errors))]
+        tasks.extend(asyncio.ensure_future(self._work(send_one, work, on_result, weight, counts, errors))
+                     for _ in range(self.concurrency))
+        try:
+            # Producer and workers catch their own errors, this only raises
+            # when the caller is cancelled
+            await asyncio.gather(*tasks)
+        except BaseException:
+            self.cancel()
+            for task in tasks:
+                task.cancel()
+            raise
+        if errors:
+            raise errors[0]
+        return EngineStats(counts[0], counts[1], time.perf_counter() - started)
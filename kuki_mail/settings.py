@@ -0,0 +1,14 @@
+import os
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Where journals, caches and other local state live
+DATA_DIR = Path(os.getenv("KUKI_MAIL_DATA_DIR", ".kuki_mail"))
+
+
+def data_path(name):
+    DATA_DIR.mkdir(parents=True, exist_ok=True)
+    return DATA_DIR / name
@@ -0,0 +1,444 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from .jobs import QUEUED, RUNNING, DONE, FAILED, CANCELLED
+from .journal import SendJournal, campaign_id
+from .layouts import SIMPLE
+from .rate_limiter import DEFAULT_PER_SECOND
+from .recipients import RecipientSource
+from .retry import RetryPolicy, DeadLetters
+from .send_engine import DEFAULT_CONCURRENCY
+from .settings import data_path
+from .suppression import normalize_address, shared_index
+
+# A sharded campaign lives in data_path('shards')/<campaign>/: the manifest,
+# a copy of the recipient file and attachments, and per shard a journal,
+# a status file and the dead letters. Point KUKI_MAIL_DATA_DIR of several
+# machines at one shared directory and each can work on its own shards.
+SHARD_DIR = 'shards'
+MANIFEST_FILE = 'campaign.json'
+CANCEL_FILE = 'cancel'
+ATTACHMENT_DIR = 'attachments'
+# How often a shard rewrites its status file; the rewrite is also its heartbeat
+STATUS_INTERVAL = 2.0
+# A running shard whose status is older than this is reported as stalled
+STALE_AFTER = 30.0
+STALLED = 'stalled'
+
+
+def shard_of(email, count):
+    # crc32 of the normalized address is the same on every machine and
+    # Python version (unlike hash()), and duplicates land in the same shard
+    # so each shard can drop them on its own
+    return zlib.crc32(normalize_address(email).encode('utf-8')) % count
+
+
+def campaign_dir(campaign):
+    folder = data_path(SHARD_DIR) / campaign
+    folder.mkdir(parents=True, exist_ok=True)
+    return folder
+
+
+def _write_json(path, data):
+    # Write then rename, so a reader (maybe on another machine) never sees half a file
+    tmp = path.with_name(f'.{path.name}.{socket.gethostname()}.{os.getpid()}.tmp')
+    tmp.write_text(json.dumps(data, indent=2), encoding='utf-8')
+    os.replace(tmp, path)
+
+
+def _read_json(path):
+    try:
+        return json.loads(path.read_text(encoding='utf-8'))
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _file_name(file):
+    return os.path.basename(getattr(file, 'name', None) or str(file))
+
+
+def _read_bytes(file):
+    # Uploads (anything with getvalue/read) and paths alike
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, 'rb') as f:
+            return f.read()
+    if hasattr(file, 'getvalue'):
+        return file.getvalue()
+    file.seek(0)
+    return file.read()
+
+
+class ShardRecipients(RecipientSource):
+    # The rows of one shard of a recipient file. Row numbers stay those of
+    # the whole file, so journals and dead letters point at the real rows.
+
+    def __init__(self, file, index, count, filename=None, **options):
+        super().__init__(file, filename, **options)
+        self.index = index
+        self.count = count
+        self._length = None
+
+    def chunks(self):
+        index, count = self.index, self.count
+        for chunk in super().chunks():
+            chunk = [recipient for recipient in chunk if shard_of(recipient.email, count) == index]
+            if chunk:
+                yield chunk
+
+    def __len__(self):
+        # One pass over the file, again only if skip_rows was replaced since
+        if self._length is None or self._length[0] is not self.skip_rows:
+            self._length = (self.skip_rows, sum(len(chunk) for chunk in self.chunks()))
+        return self._length[1]
+
+
+def prepare_campaign(recipients_file, sender_email, subject, content, attachments=(), shards=1, name=None,
+                     concurrency=DEFAULT_CONCURRENCY, per_second=DEFAULT_PER_SECOND, per_minute=None, per_day=None,
+                     check_deliverability=True, layout=SIMPLE, greeting=None, skip_mailed=False, use_asyncio=False,
+                     owner=None):
+    # Copies everything a shard needs into the campaign folder and writes the
+    # manifest; the password is never stored, workers get it from their
+    # caller, and `owner` (jobs.owner_token) decides who the UI shows it to.
+    # The same file, content, sender and shard count give the same campaign
+    # id, so preparing again resumes instead of starting over.
+    recipients_name = _file_name(recipients_file)
+    recipients_data = _read_bytes(recipients_file)
+    campaign = campaign_id(sender_email, subject, content, recipients_data, f'shards={shards}', layout, greeting)
+    folder = campaign_dir(campaign)
+    (folder / CANCEL_FILE).unlink(missing_ok=True)
+
+    recipients_path = folder / f'recipients{os.path.splitext(recipients_name)[1] or ".csv"}'
+    recipients_path.write_bytes(recipients_data)
+    attachment_folder = folder / ATTACHMENT_DIR
+    attachment_folder.mkdir(exist_ok=True)
+    attachment_names = []
+    for attachment in attachments or []:
+        attachment_name = _file_name(attachment)
+        (attachment_folder / attachment_name).write_bytes(_read_bytes(attachment))
+        attachment_names.append(attachment_name)
+
+    manifest = _read_json(folder / MANIFEST_FILE) or {'created_at': time.time()}
+    manifest.update({
+        'campaign': campaign,
+        'name': name or f"{subject} ({recipients_name})",
+        'shards': shards,
+        'recipients': recipients_path.name,
+        'total': len(RecipientSource(recipients_path)),
+        'sender_email': sender_email,
+        'subject': subject,
+        'content': content,
+        'layout': layout,
+        'greeting': greeting,
+        'attachments': attachment_names,
+        'concurrency': concurrency,
+        'per_second': per_second,
+        'per_minute': per_minute,
+        'per_day': per_day,
+        'check_deliverability': check_deliverability,
+        'skip_mailed': skip_mailed,
+        'asyncio': use_asyncio,
+    })
+    if owner is not None:
+        manifest['owner'] = owner
+    _write_json(folder / MANIFEST_FILE, manifest)
+    return campaign
+
+
+def read_manifest(campaign):
+    manifest = _read_json(data_path(SHARD_DIR) / campaign / MANIFEST_FILE)
+    if manifest is None:
+        raise ValueError(f"No sharded campaign {campaign!r} in {data_path(SHARD_DIR)}")
+    return manifest
+
+
+class ShardStatus:
+    # Progress of one shard, rewritten every STATUS_INTERVAL seconds by a
+    # background thread as shard-<index>.json. The rewrite doubles as a
+    # heartbeat, and the same thread notices the campaign's cancel flag.
+    # Has the set_progress/add_error interface of a jobs.Job.
+
+    def __init__(self, campaign, index, count, cancel_event=None):
+        self.folder = campaign_dir(campaign)
+        self.path = self.folder / f'shard-{index}.json'
+        self.index = index
+        self.count = count
+        self.state = QUEUED
+        self.sent = 0
+        self.failed = 0
+        self.total = None
+        # Rows validation kept out of the send (sent to the dead letters instead)
+        self.invalid = 0
+        self.suppressed = 0
+        self.resumed = None
+        self.error = None
+        self.started_at = time.time()
+        self.finished_at = None
+        self.cancel_event = cancel_event if cancel_event is not None else threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name=f'kuki_shard_{index}', daemon=True)
+
+    def start(self):
+        self.state = RUNNING
+        self.write()
+        self._thread.start()
+        return self
+
+    def set_progress(self, sent, total=None):
+        if self.resumed is None:
+            self.resumed = sent
+        self.sent = sent
+        if total is not None:
+            self.total = total
+
+    def add_error(self, recipient=None, error=None):
+        self.failed += 1
+
+    def _loop(self):
+        while not self._stop.wait(STATUS_INTERVAL):
+            if (self.folder / CANCEL_FILE).exists():
+                self.cancel_event.set()
+            self.write()
+
+    def finish(self, state, error=None):
+        self.state = state
+        self.error = error
+        self.finished_at = time.time()
+        self._stop.set()
+        self._thread.join()
+        self.write()
+
+    def to_dict(self):
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        handled = self.sent - (self.resumed or 0) + self.failed
+        return {
+            'index': self.index,
+            'state': self.state,
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'sent': self.sent,
+            'failed': self.failed,
+            'total': self.total,
+            'invalid': self.invalid,
+            'suppressed': self.suppressed,
+            'resumed': self.resumed,
+            'error': self.error,
+            'throughput': handled / elapsed if elapsed > 0 and self.finished_at is None else 0.0,
+            'started_at': self.started_at,
+            'updated_at': time.time(),
+            'finished_at': self.finished_at,
+        }
+
+    def write(self):
+        _write_json(self.path, self.to_dict())
+
+
+def _share(limit, count):
+    # Quotas are for the whole campaign (one account), each shard takes an even part
+    return limit / count if limit else None
+
+
+def run_shard(campaign, index, sender_password, cancel_event=None):
+    # Sends one shard of a prepared campaign, headless, with its own journal,
+    # dead letters and status file. Rerunning a shard after a crash skips the
+    # rows its journal already has as sent.
+    from .campaign import send_bulk_emails, send_bulk_emails_async, campaign_plan
+    from .rate_limiter import RateLimiter
+    from .validation import validate_recipients
+
+    manifest = read_manifest(campaign)
+    count = manifest['shards']
+    status = ShardStatus(campaign, index, count, cancel_event).start()
+    folder = status.folder
+    attachments = [open(folder / ATTACHMENT_DIR / name, 'rb') for name in manifest['attachments']]
+    try:
+        recipients = ShardRecipients(folder / manifest['recipients'], index, count)
+        dead_letters = DeadLetters(path=folder / f'dead-letters-{index}.csv')
+        # No one to show the report to: bad addresses become dead letters, duplicates are dropped
+        report = validate_recipients(recipients, manifest.get('check_deliverability', True))
+        for row, email in report.invalid_rows.items():
+            dead_letters.add(row, email, ValueError("Invalid email address"))
+        status.invalid = len(report.invalid_rows)
+        recipients.skip_rows = report.duplicates | report.invalid_rows.keys()
+        # Every shard checks the one suppression index of this data directory
+        suppressions = shared_index()
+        suppressed = suppressions.suppressed_rows(recipients, manifest.get('skip_mailed', False), campaign)
+        status.suppressed = len(suppressed)
+        recipients.skip_rows |= suppressed
+        limiter = RateLimiter(_share(manifest['per_second'], count), _share(manifest['per_minute'], count),
+                              _share(manifest['per_day'], count))
+        with SendJournal(campaign, path=folder / f'shard-{index}.sqlite3') as journal:
+            plan = campaign_plan(manifest['subject'], manifest['content'], manifest.get('layout', SIMPLE),
+                                 manifest.get('greeting'))
+            options = dict(
+                plan=plan, concurrency=manifest['concurrency'], limiter=limiter, journal=journal,
+                on_progress=status.set_progress, on_error=status.add_error, cancel_event=status.cancel_event,
+                retry=RetryPolicy(), dead_letters=dead_letters, suppressions=suppressions,
+                skip_mailed=manifest.get('skip_mailed', False),
+            )
+            if manifest.get('asyncio'):
+                # All of the shard's connections on one event loop instead of a thread each
+                asyncio.run(send_bulk_emails_async(recipients, manifest['sender_email'], sender_password, None, None,
+                                                   attachments, **options))
+            else:
+                send_bulk_emails(recipients, manifest['sender_email'], sender_password, None, None,
+                                 attachments, **options)
+    except Exception as e:
+        status.finish(FAILED, str(e))
+        raise
+    finally:
+        for attachment in attachments:
+            attachment.close()
+    status.finish(CANCELLED if status.cancel_event.is_set() else DONE)
+    return status.to_dict()
+
+
+def cancel_campaign(campaign):
+    # Seen by every shard's status thread, wherever it runs
+    (campaign_dir(campaign) / CANCEL_FILE).touch()
+
+
+def run_local(campaign, sender_password, shards=None, processes=None, on_status=None, cancel_event=None):
+    # Coordinator for this machine: runs the given shards (all of them by
+    # default) in worker processes and reports the merged status to
+    # on_status until they finish. Processes are spawned, not forked, since
+    # the caller may be a threaded server (Streamlit); with a single worker
+    # the shards run on a thread of this process instead, skipping the
+    # interpreter start-up.
+    manifest = read_manifest(campaign)
+    indexes = list(range(manifest['shards'])) if shards is None else list(shards)
+    if shards is None:
+        (campaign_dir(campaign) / CANCEL_FILE).unlink(missing_ok=True)
+    workers = max(1, min(processes or len(indexes), len(indexes)))
+    if workers == 1:
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='kuki_shard')
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    with executor:
+        futures = [executor.submit(run_shard, campaign, index, sender_password) for index in indexes]
+        pending = futures
+        while pending:
+            _, pending = wait(pending, timeout=STATUS_INTERVAL)
+            if cancel_event is not None and cancel_event.is_set():
+                cancel_campaign(campaign)
+            if on_status is not None:
+                on_status(read_campaign(campaign))
+    errors = [str(future.exception()) for future in futures if future.exception() is not None]
+    if errors:
+        raise RuntimeError(f"{len(errors)} shard(s) failed: {errors[0]}")
+    return read_campaign(campaign)
+
+
+class CampaignStatus:
+    # Every shard's status file merged into campaign totals, for the
+    # coordinator, the CLI and the UI
+
+    def __init__(self, manifest, shards, now=None):
+        now = time.time() if now is None else now
+        self.campaign = manifest['campaign']
+        self.name = manifest.get('name', self.campaign)
+        self.count = manifest['shards']
+        self.created_at = manifest.get('created_at')
+        self.owner = manifest.get('owner')
+        self.shards = []
+        for index in range(self.count):
+            shard = dict(shards.get(index) or {'index': index, 'state': QUEUED, 'sent': 0, 'failed': 0})
+            if shard['state'] == RUNNING and now - shard.get('updated_at', 0) > STALE_AFTER:
+                shard['state'] = STALLED
+            self.shards.append(shard)
+        self.sent = sum(shard['sent'] for shard in self.shards)
+        self.failed = sum(shard['failed'] for shard in self.shards)
+        self.suppressed = sum(shard.get('suppressed', 0) for shard in self.shards)
+        totals = [shard.get('total') for shard in self.shards]
+        # Until every shard has counted its rows, the whole file's row count
+        self.total = sum(totals) if None not in totals else manifest.get('total', 0)
+        self.throughput = sum(shard.get('throughput') or 0.0 for shard in self.shards)
+        states = {shard['state'] for shard in self.shards}
+        if FAILED in states:
+            self.state = FAILED
+        elif STALLED in states:
+            self.state = STALLED
+        elif states == {DONE}:
+            self.state = DONE
+        elif states <= {DONE, CANCELLED}:
+            self.state = CANCELLED
+        elif RUNNING in states:
+            self.state = RUNNING
+        else:
+            self.state = QUEUED
+        self.errors = [f"Shard {shard['index']}: {shard['error']}" for shard in self.shards if shard.get('error')]
+
+    @property
+    def finished(self):
+        return self.state in (DONE, FAILED, CANCELLED)
+
+    @property
+    def progress(self):
+        if not self.total:
+            return 1.0 if self.finished else 0.0
+        return min(1.0, (self.sent + self.failed) / self.total)
+
+    @property
+    def eta(self):
+        if self.finished:
+            return 0.0
+        if self.throughput <= 0:
+            return None
+        return max(0, self.total - self.sent - self.failed) / self.throughput
+
+    def dead_letters(self):
+        # Every shard's dead letters as one CSV, for st.download_button
+        folder = data_path(SHARD_DIR) / self.campaign
+        lines = []
+        for index in range(self.count):
+            path = folder / f'dead-letters-{index}.csv'
+            if path.exists():
+                rows = path.read_bytes().splitlines(keepends=True)
+                lines.extend(rows if not lines else rows[1:])
+        return b''.join(lines)
+
+    def to_dict(self):
+        return {
+            'campaign': self.campaign,
+            'name': self.name,
+            'state': self.state,
+            'sent': self.sent,
+            'failed': self.failed,
+            'suppressed': self.suppressed,
+            'total': self.total,
+            'throughput': self.throughput,
+            'eta': self.eta,
+            'shards': self.shards,
+        }
+
+
+def read_campaign(campaign):
+    manifest = read_manifest(campaign)
+    folder = data_path(SHARD_DIR) / campaign
+    shards = {}
+    for index in range(manifest['shards']):
+        shard = _read_json(folder / f'shard-{index}.json')
+        if shard is not None:
+            shards[index] = shard
+    return CampaignStatus(manifest, shards)
+
+
+def list_campaigns(owner=None):
+    # Newest first; every campaign, or only those prepared with this owner
+    root = data_path(SHARD_DIR)
+    campaigns = []
+    for folder in root.iterdir() if root.exists() else ():
+        if (folder / MANIFEST_FILE).exists():
+            try:
+                status = read_campaign(folder.name)
+            except (ValueError, KeyError):
+                continue
+            if owner is None or status.owner == owner:
+                campaigns.append(status)
+    return sorted(campaigns, key=lambda status: status.created_at or 0, reverse=True)
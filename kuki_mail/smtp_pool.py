@@ -0,0 +1,163 @@
+import smtplib
+import socket
+import threading
+import queue
+from contextlib import contextmanager
+
+from .metrics import metrics
+from .mime_builder import send_wire_message
+
+SMTP_HOST = "smtp.gmail.com"
+SMTP_PORT = 587
+# How the connection is secured: STARTTLS upgrade, implicit TLS (port 465) or plain
+SECURITY_STARTTLS = 'starttls'
+SECURITY_SSL = 'ssl'
+SECURITY_NONE = 'none'
+# Gmail starts refusing messages after roughly 100 per connection,
+# so recycle the session before we hit that limit
+MAX_MESSAGES_PER_CONNECTION = 90
+
+
+class SMTPSession:
+    # One authenticated SMTP connection that is reused for many messages
+    # and transparently re-established when the server drops it
+
+    def __init__(self, sender_email, sender_password, host=SMTP_HOST, port=SMTP_PORT,
+                 max_messages=MAX_MESSAGES_PER_CONNECTION, timeout=30, security=SECURITY_STARTTLS, login=True):
+        self.sender_email = sender_email
+        self.sender_password = sender_password
+        self.host = host
+        self.port = port
+        self.security = security
+        self.login = login
+        self.max_messages = max_messages
+        self.timeout = timeout
+        self.server = None
+        self.messages_sent = 0
+
+    def connect(self):
+        self.close()
+        metrics.increment('connections')
+        # TCP connect, greeting and TLS handshake
+        with metrics.timer('connect'):
+            if self.security == SECURITY_SSL:
+                server = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout)
+            else:
+                server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            # Commands and message data are written in whole batches already, so
+            # Nagle would only hold back the last write until the server ACKs
+            server.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            try:
+                if self.security == SECURITY_STARTTLS:
+                    server.starttls()
+            except Exception:
+                server.close()
+                raise
+        try:
+            if self.login:
+                with metrics.timer('login'):
+                    server.login(self.sender_email, self.sender_password)
+        except Exception:
+            server.close()
+            raise
+        self.server = server
+        self.messages_sent = 0
+
+    def close(self):
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            self.server.close()
+        self.server = None
+
+    def _ensure_connected(self):
+        if self.server is None or self.messages_sent >= self.max_messages:
+            self.connect()
+
+    def _send(self, send_fn):
+        self._ensure_connected()
+        try:
+            result = send_fn(self.server)
+        except smtplib.SMTPServerDisconnected:
+            # The server closed an idle or exhausted connection, retry once on a fresh one
+            metrics.increment('reconnects')
+            self.connect()
+            result = send_fn(self.server)
+        self.messages_sent += 1
+        return result
+
+    def send_message(self, msg):
+        return self._send(lambda server: server.send_message(msg))
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        return self._send(lambda server: server.sendmail(from_addr, to_addrs, msg))
+
+    def send_wire(self, from_addr, to_addrs, message):
+        # Streams a mime_builder.WireMessage during DATA without joining it
+        return self._send(lambda server: send_wire_message(server, from_addr, to_addrs, message))
+
+
+class SMTPPool:
+    # Hands out authenticated sessions so that callers send many messages
+    # over each connection instead of logging in once per message
+
+    def __init__(self, sender_email, sender_password, size=1, session_class=SMTPSession, **session_options):
+        # session_class is any class taking (sender_email, sender_password,
+        # **session_options) with a send_wire() method, see transports.py
+        self.sender_email = sender_email
+        self.sender_password = sender_password
+        self.size = size
+        self.session_class = session_class
+        self.session_options = session_options
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._sessions = []
+
+    def _new_session(self):
+        session = self.session_class(self.sender_email, self.sender_password, **self.session_options)
+        self._sessions.append(session)
+        return session
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                return self._new_session()
+        return self._idle.get()
+
+    def release(self, session):
+        self._idle.put(session)
+
+    @contextmanager
+    def session(self):
+        session = self.acquire()
+        try:
+            yield session
+        finally:
+            self.release(session)
+
+    def send_message(self, msg):
+        with self.session() as session:
+            return session.send_message(msg)
+
+    def send_wire(self, from_addr, to_addrs, message):
+        with self.session() as session:
+            return session.send_wire(from_addr, to_addrs, message)
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions:
+                session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,214 @@
+import argparse
+import asyncio
+import ssl
+import threading
+import time
+from collections import deque
+
+# Messages kept in memory for inspection, older ones are only counted
+DEFAULT_KEEP = 100
+MAX_MESSAGE_SIZE = 50 * 1024 * 1024
+
+
+class SinkStats:
+    def __init__(self):
+        self.connections = 0
+        self.messages = 0
+        self.recipients = 0
+        self.bytes = 0
+        self.commands = 0
+        self.started = time.perf_counter()
+
+    def as_dict(self):
+        return {
+            'connections': self.connections,
+            'messages': self.messages,
+            'recipients': self.recipients,
+            'bytes': self.bytes,
+            'commands': self.commands,
+        }
+
+
+class SMTPSink:
+    # Minimal ESMTP server that accepts everything and delivers nowhere, for
+    # load tests and local runs. Speaks EHLO/HELO, AUTH PLAIN/LOGIN (any
+    # credentials), MAIL, RCPT, DATA, RSET, NOOP and QUIT, advertises
+    # PIPELINING, SIZE and 8BITMIME, and STARTTLS when given a server
+    # `tls_context`. Addresses containing `refuse` get a 550 on RCPT and a
+    # MAIL with SIZE= over MAX_MESSAGE_SIZE a 552, so refusals can be
+    # exercised too.
+    #
+    #   sink = SMTPSink().start()         # background thread, free port
+    #   ... SMTP to sink.host:sink.port ...
+    #   sink.stop()
+
+    def __init__(self, host='127.0.0.1', port=0, keep=DEFAULT_KEEP, refuse='refuse', latency=0.0,
+                 tls_context=None):
+        self.host = host
+        self.port = port
+        self.refuse = refuse
+        self.tls_context = tls_context
+        # Artificial delay before the DATA reply, to mimic a remote server
+        self.latency = latency
+        self.stats = SinkStats()
+        self.messages = deque(maxlen=keep)
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    async def _handle(self, reader, writer):
+        self.stats.connections += 1
+        write = writer.write
+        write(b'220 kuki-sink ESMTP ready\r\n')
+        mail_from = None
+        rcpt_to = []
+        secure = False
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self.stats.commands += 1
+                command = line[:4].upper()
+                if command == b'EHLO':
+                    starttls = b'250-STARTTLS\r\n' if self.tls_context is not None and not secure else b''
+                    write(b'250-kuki-sink\r\n250-PIPELINING\r\n%s'
+                          b'250-SIZE %d\r\n250-8BITMIME\r\n250 AUTH PLAIN LOGIN\r\n' % (starttls, MAX_MESSAGE_SIZE))
+                elif command == b'HELO':
+                    write(b'250 kuki-sink\r\n')
+                elif command == b'AUTH':
+                    parts = line.split()
+                    if parts[1:2] == [b'LOGIN']:
+                        # Username (unless sent inline) and password prompts,
+                        # whatever comes back is fine
+                        for _ in range(4 - len(parts)):
+                            write(b'334 VXNlcm5hbWU6\r\n')
+                            await writer.drain()
+                            await reader.readline()
+                    write(b'235 2.7.0 Authentication successful\r\n')
+                elif command == b'STAR' and self.tls_context is not None and not secure:
+                    write(b'220 2.0.0 Ready to start TLS\r\n')
+                    await writer.drain()
+                    await writer.start_tls(self.tls_context)
+                    # Back to the state after the greeting (RFC 3207)
+                    secure = True
+                    mail_from, rcpt_to = None, []
+                    continue
+                elif command == b'MAIL':
+                    size = line.upper().partition(b' SIZE=')[2].split(b' ')[0].strip()
+                    if size.isdigit() and int(size) > MAX_MESSAGE_SIZE:
+                        write(b'552 5.3.4 Message size exceeds fixed limit\r\n')
+                    else:
+                        mail_from = line[10:].split(b' ')[0].strip()
+                        rcpt_to = []
+                        write(b'250 2.1.0 OK\r\n')
+                elif command == b'RCPT':
+                    if mail_from is None:
+                        write(b'503 5.5.1 MAIL first\r\n')
+                    elif self.refuse and self.refuse.encode() in line:
+                        write(b'550 5.1.1 No such user\r\n')
+                    else:
+                        rcpt_to.append(line[8:].strip())
+                        write(b'250 2.1.5 OK\r\n')
+                elif command == b'DATA':
+                    if not rcpt_to:
+                        write(b'554 5.5.1 No valid recipients\r\n')
+                        continue
+                    write(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+                    await writer.drain()
+                    data = await reader.readuntil(b'\r\n.\r\n')
+                    if self.latency:
+                        await asyncio.sleep(self.latency)
+                    self._deliver(mail_from, rcpt_to, data)
+                    mail_from, rcpt_to = None, []
+                    write(b'250 2.0.0 OK queued\r\n')
+                elif command == b'RSET':
+                    mail_from, rcpt_to = None, []
+                    write(b'250 2.0.0 OK\r\n')
+                elif command == b'QUIT':
+                    write(b'221 2.0.0 Bye\r\n')
+                    break
+                else:
+                    write(b'250 2.0.0 OK\r\n')
+                await writer.drain()
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ssl.SSLError):
+            pass
+        finally:
+            writer.close()
+
+    def _deliver(self, mail_from, rcpt_to, data):
+        self.stats.messages += 1
+        self.stats.recipients += len(rcpt_to)
+        self.stats.bytes += len(data)
+        self.messages.append((mail_from, rcpt_to, data))
+
+    async def _start_server(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port, limit=MAX_MESSAGE_SIZE)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    def start(self):
+        started = threading.Event()
+        errors = []
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            try:
+                self._loop.run_until_complete(self._start_server())
+            except Exception as e:
+                errors.append(e)
+                started.set()
+                return
+            started.set()
+            self._loop.run_forever()
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name='kuki_smtp_sink', daemon=True)
+        self._thread.start()
+        started.wait()
+        if errors:
+            raise errors[0]
+        return self
+
+    def stop(self):
+        if self._loop is None:
+            return
+
+        # Stop listening; clients still connected just see the loop go away
+        self._loop.call_soon_threadsafe(self._server.close)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local SMTP sink that accepts and discards every message")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2525)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds to wait before acknowledging DATA")
+    parser.add_argument('--tls-cert', help="PEM certificate (and key, unless --tls-key) to offer STARTTLS with")
+    parser.add_argument('--tls-key', help="PEM private key of --tls-cert")
+    args = parser.parse_args()
+
+    tls_context = None
+    if args.tls_cert:
+        tls_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        tls_context.load_cert_chain(args.tls_cert, args.tls_key)
+    sink = SMTPSink(args.host, args.port, latency=args.latency, tls_context=tls_context).start()
+    print(f"SMTP sink listening on {sink.host}:{sink.port}", flush=True)
+    try:
+        while True:
+            time.sleep(5)
+            print(sink.stats.as_dict(), flush=True)
+    except KeyboardInterrupt:
+        sink.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,274 @@
+import csv
+import io
+import itertools
+import re
+import smtplib
+import sqlite3
+import struct
+import threading
+import time
+from hashlib import blake2b
+
+from .recipients import RecipientSource
+from .settings import data_path
+
+SUPPRESSION_FILE = 'suppressions.sqlite3'
+UNSUBSCRIBE = 'unsubscribe'
+BOUNCE = 'bounce'
+COMPLAINT = 'complaint'
+MANUAL = 'manual'
+REASONS = (UNSUBSCRIBE, BOUNCE, COMPLAINT, MANUAL)
+
+# Permanent recipient-level replies (no such mailbox, address rejected):
+# mailing the address again only hurts the sender's reputation
+BOUNCE_CODES = frozenset({550, 551, 553})
+# RFC 3463 enhanced status at the start of a reply; class 5, subject 1 is a
+# bad destination address (5.1.1 no such mailbox, 5.1.2 bad domain...)
+_ENHANCED_STATUS = re.compile(rb'\s*([245])\.(\d{1,3})\.\d{1,3}\b')
+# Gmail ignores dots and anything after a "+" in the local part
+GMAIL_SUFFIXES = ('@gmail.com', '@googlemail.com')
+LOAD_BATCH_SIZE = 1_000_000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS suppressed (
+    key INTEGER PRIMARY KEY,
+    address TEXT NOT NULL,
+    reason TEXT NOT NULL,
+    at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS mailed (
+    key INTEGER NOT NULL,
+    campaign TEXT NOT NULL,
+    at REAL NOT NULL,
+    PRIMARY KEY (key, campaign)
+) WITHOUT ROWID;
+"""
+
+
+def _fold_gmail(email):
+    at = email.rfind('@')
+    return f"{email[:at].split('+', 1)[0].replace('.', '')}@gmail.com"
+
+
+def normalize_address(email):
+    # The mailbox an address is delivered to: case-folded, and for Gmail
+    # without dots or a +tag, so j.doe+news@Gmail.com matches jdoe@gmail.com
+    email = email.strip().lower()
+    return _fold_gmail(email) if email.endswith(GMAIL_SUFFIXES) else email
+
+
+def normalize_addresses(addresses):
+    # normalize_address over a batch, inlined for bulk loads
+    emails = [email.strip().lower() for email in addresses]
+    return [_fold_gmail(email) if email.endswith(GMAIL_SUFFIXES) else email for email in emails if '@' in email]
+
+
+def _address_keys(normalized):
+    # 64 bits of blake2b as the SQLite integer key: a set of ints is a
+    # fraction of the memory of the address strings, and at a few million
+    # entries a collision is a one-in-a-billion event
+    digests = b''.join([blake2b(email.encode('utf-8'), digest_size=8).digest() for email in normalized])
+    return struct.unpack(f'>{len(normalized)}q', digests)
+
+
+def hard_bounce(error, email):
+    # Only the server refusing this very address for good is a bounce: a
+    # 550/551/553 RCPT reply for it, 5.1.x if the reply has an enhanced
+    # status. A refused sender or message (550 5.4.5 daily quota exceeded,
+    # 5.7.x content policy) is the same for every recipient and says nothing
+    # about their address.
+    if not isinstance(error, smtplib.SMTPRecipientsRefused):
+        return False
+    reply = error.recipients.get(email)
+    if reply is None or reply[0] not in BOUNCE_CODES:
+        return False
+    message = reply[1].encode('utf-8', 'replace') if isinstance(reply[1], str) else reply[1]
+    match = _ENHANCED_STATUS.match(message or b'')
+    return match is None or (match.group(1), match.group(2)) == (b'5', b'1')
+
+
+def address_key(email):
+    return _address_keys([normalize_address(email)])[0]
+
+
+def read_addresses(file, filename=None):
+    # The email column of a recipient-style file, or for a plain export
+    # without that header the first value of every line that has an "@"
+    source = RecipientSource(file, filename)
+    if source.kind in ('xlsx', 'xls'):
+        yield from (recipient.email for recipient in source if recipient.email)
+        return
+    binary = source._open_binary()
+    text = io.TextIOWrapper(binary, encoding='utf-8-sig', newline='')
+    try:
+        reader = csv.reader(text)
+        header = [column.strip() for column in next(reader, [])]
+        index = header.index('email') if 'email' in header else 0
+        if 'email' not in header and header and '@' in header[0]:
+            yield header[0]
+        for values in reader:
+            if len(values) > index and '@' in values[index]:
+                yield values[index]
+    finally:
+        text.detach()
+        if binary is not source.file:
+            binary.close()
+
+
+class SuppressionIndex:
+    # Addresses never to mail again (unsubscribes, hard bounces, complaints)
+    # and which addresses earlier campaigns already reached, keyed by the
+    # hash of the normalized address. The keys are read into sets once, so a
+    # check at send time is one hash and one set lookup.
+
+    def __init__(self, path=None):
+        self.path = path or data_path(SUPPRESSION_FILE)
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None,
+                                     timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+        self._keys = None
+        self._version = None
+
+    def _suppressed_keys(self, refresh=False):
+        # Reloaded at the start of a campaign if another process (a shard,
+        # the CLI) changed the file since; data_version tells without a scan
+        with self._lock:
+            version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+            if self._keys is None or (refresh and version != self._version):
+                self._keys = {key for (key,) in self._conn.execute('SELECT key FROM suppressed')}
+                self._version = version
+            return self._keys
+
+    def __contains__(self, email):
+        return address_key(email) in self._suppressed_keys()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM suppressed').fetchone()[0]
+
+    def counts(self):
+        with self._lock:
+            return dict(self._conn.execute('SELECT reason, COUNT(*) FROM suppressed GROUP BY reason'))
+
+    def reason(self, email):
+        with self._lock:
+            row = self._conn.execute('SELECT reason FROM suppressed WHERE key = ?', (address_key(email),)).fetchone()
+        return row[0] if row else None
+
+    def add(self, addresses, reason=MANUAL):
+        # Bulk load: one transaction per LOAD_BATCH_SIZE rows, keys sorted so
+        # SQLite appends to its B-tree instead of splitting pages all over.
+        # An address already in the list keeps its first reason.
+        added = 0
+        now = time.time()
+        addresses = iter(addresses)
+        while True:
+            normalized = normalize_addresses(itertools.islice(addresses, LOAD_BATCH_SIZE))
+            if not normalized:
+                return added
+            batch = dict(zip(_address_keys(normalized), normalized))
+            keys = sorted(batch)
+            rows = zip(keys, map(batch.__getitem__, keys), itertools.repeat(reason), itertools.repeat(now))
+            with self._lock:
+                before = self._conn.total_changes
+                self._conn.execute('BEGIN')
+                self._conn.executemany(
+                    'INSERT OR IGNORE INTO suppressed (key, address, reason, at) VALUES (?, ?, ?, ?)', rows)
+                self._conn.execute('COMMIT')
+                if self._keys is not None:
+                    self._keys.update(keys)
+                added += self._conn.total_changes - before
+
+    def remove(self, addresses):
+        keys = [(key,) for key in _address_keys(normalize_addresses(addresses))]
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.execute('BEGIN')
+            self._conn.executemany('DELETE FROM suppressed WHERE key = ?', keys)
+            self._conn.execute('COMMIT')
+            if self._keys is not None:
+                self._keys.difference_update(key for (key,) in keys)
+            return self._conn.total_changes - before
+
+    def add_bounce(self, email, error):
+        # Called with the error of a recipient's final failure, see hard_bounce
+        if hard_bounce(error, email):
+            self.add([email], BOUNCE)
+
+    def mailed_keys(self, exclude_campaign=None):
+        # Addresses other campaigns delivered to, for "don't mail anyone twice"
+        with self._lock:
+            cursor = self._conn.execute('SELECT key FROM mailed WHERE campaign != ?', (exclude_campaign or '',))
+            return {key for (key,) in cursor}
+
+    def record_mailed(self, campaign, addresses):
+        now = time.time()
+        rows = [(address_key(email), campaign, now) for email in addresses]
+        if not rows:
+            return
+        with self._lock:
+            self._conn.execute('BEGIN')
+            self._conn.executemany('INSERT OR IGNORE INTO mailed (key, campaign, at) VALUES (?, ?, ?)', rows)
+            self._conn.execute('COMMIT')
+
+    def checker(self, skip_mailed=False, campaign=None):
+        # email -> True when it must not be sent. Suppressions added while a
+        # campaign runs (its own hard bounces) are seen right away.
+        self._suppressed_keys(refresh=True)
+        mailed = self.mailed_keys(campaign) if skip_mailed else frozenset()
+
+        def is_suppressed(email):
+            key = address_key(email)
+            return key in self._keys or key in mailed
+        return is_suppressed
+
+    def suppressed_rows(self, recipients, skip_mailed=False, campaign=None):
+        # 0-based rows of a recipient file to leave out of a send, hashed a chunk at a time
+        keys = self._suppressed_keys(refresh=True)
+        if skip_mailed:
+            keys = keys | self.mailed_keys(campaign)
+        rows = []
+        for chunk in recipients.chunks():
+            chunk = [recipient for recipient in chunk if '@' in recipient.email]
+            chunk_keys = _address_keys(normalize_addresses(recipient.email for recipient in chunk))
+            rows.extend(recipient.row for recipient, key in zip(chunk, chunk_keys) if key in keys)
+        return frozenset(rows)
+
+    def export(self):
+        # CSV of the whole list, for a download or another tool
+        with self._lock:
+            rows = self._conn.execute('SELECT address, reason, at FROM suppressed ORDER BY at, address').fetchall()
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(('email', 'reason', 'at'))
+        writer.writerows((address, reason, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(at)))
+                         for address, reason, at in rows)
+        return output.getvalue()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+_shared_index = None
+_shared_lock = threading.Lock()
+
+
+def shared_index():
+    # One index per process and data directory, so its key set is read once
+    global _shared_index
+    with _shared_lock:
+        path = data_path(SUPPRESSION_FILE)
+        if _shared_index is None or _shared_index.path != path:
+            _shared_index = SuppressionIndex(path)
+        return _shared_index
+
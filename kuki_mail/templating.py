@@ -0,0 +1,186 @@
+from collections import namedtuple
+from functools import lru_cache
+
+_jinja_env = None
+
+RenderedMessage = namedtuple('RenderedMessage', ['subject', 'html', 'text'])
+
+
+class CompiledTemplate:
+    # A template reduced to literal text with variable slots in between.
+    # Rendering copies the literal list and drops values into the slots, so
+    # there is no parsing work per recipient. Sources using more than plain
+    # {{ var }} output fall back to a compiled (but still cached) jinja template.
+
+    __slots__ = ('parts', 'slots', 'variables', '_jinja')
+
+    def __init__(self, parts, slots, variables, jinja_template=None):
+        self.parts = parts
+        self.slots = slots
+        self.variables = variables
+        self._jinja = jinja_template
+
+    @property
+    def is_static(self):
+        return not self.variables
+
+    def render(self, variables):
+        if self._jinja is not None:
+            return self._jinja.render(variables)
+        if not self.slots:
+            # embed() of static children can leave several literal parts
+            return ''.join(self.parts)
+        out = list(self.parts)
+        for index, key in self.slots:
+            if key.__class__ is str:
+                out[index] = str(variables.get(key, ''))
+            else:
+                out[index] = key.render(variables)
+        return ''.join(out)
+
+    def embed(self, **children):
+        # Splice other compiled templates into this one's named slots, flattening
+        # where possible so a whole email renders as a single join
+        parts = []
+        slots = []
+        variables = set()
+        slot_keys = dict(self.slots)
+        for index, part in enumerate(self.parts):
+            key = slot_keys.get(index)
+            if key is None:
+                parts.append(part)
+                continue
+            child = children.get(key) if key.__class__ is str else None
+            if child is None:
+                slots.append((len(parts), key))
+                parts.append('')
+                variables |= {key} if key.__class__ is str else key.variables
+            elif child._jinja is None:
+                offset = len(parts)
+                parts.extend(child.parts)
+                slots.extend((offset + i, k) for i, k in child.slots)
+                variables |= child.variables
+            else:
+                slots.append((len(parts), child))
+                parts.append('')
+                variables |= child.variables
+        return CompiledTemplate(parts, slots, frozenset(variables))
+
+
+def _from_pieces(pieces):
+    # pieces is a sequence of ('text', str) / ('var', name) tuples
+    parts = []
+    slots = []
+    variables = set()
+    last_was_text = False
+    for kind, value in pieces:
+        if kind == 'text':
+            if last_was_text:
+                parts[-1] += value
+            else:
+                parts.append(value)
+            last_was_text = True
+        else:
+            slots.append((len(parts), value))
+            parts.append('')
+            variables.add(value)
+            last_was_text = False
+    return CompiledTemplate(parts, slots, frozenset(variables))
+
+
+def _jinja():
+    # jinja2 is imported the first time a template needs it, {name} style
+    # placeholders and headless sends that use them never load it
+    global _jinja_env
+    if _jinja_env is None:
+        from jinja2 import Environment
+        # Same defaults as jinja2.Template, which the UIs used before
+        _jinja_env = Environment(autoescape=False)
+    return _jinja_env
+
+
+def _flat_pieces(ast):
+    # Only plain text and {{ name }} outputs can be turned into slots
+    from jinja2 import nodes
+    pieces = []
+    for node in ast.body:
+        if not isinstance(node, nodes.Output):
+            return None
+        for child in node.nodes:
+            if isinstance(child, nodes.TemplateData):
+                pieces.append(('text', child.data))
+            elif isinstance(child, nodes.Name) and child.ctx == 'load':
+                pieces.append(('var', child.name))
+            else:
+                return None
+    return pieces
+
+
+@lru_cache(maxsize=256)
+def compile_jinja(source):
+    from jinja2 import meta
+    ast = _jinja().parse(source)
+    pieces = _flat_pieces(ast)
+    if pieces is not None:
+        return _from_pieces(pieces)
+    # Loops, filters, conditionals... let jinja handle them, compiled only once
+    variables = frozenset(meta.find_undeclared_variables(ast))
+    return CompiledTemplate([], [], variables, _jinja().from_string(source))
+
+
+def compile_placeholders(source, placeholders):
+    # Literal token replacement, e.g. {'{name}': 'name'} for the str.replace
+    # style templates used by email_sender.py
+    pieces = [('text', source)]
+    for token, name in placeholders.items():
+        expanded = []
+        for kind, value in pieces:
+            if kind != 'text' or token not in value:
+                expanded.append((kind, value))
+                continue
+            chunks = value.split(token)
+            for i, chunk in enumerate(chunks):
+                if i:
+                    expanded.append(('var', name))
+                if chunk:
+                    expanded.append(('text', chunk))
+        pieces = expanded
+    return _from_pieces(pieces)
+
+
+class RenderPlan:
+    # Everything that is the same for every recipient of a campaign, compiled
+    # once: subject, HTML (greeting/body already spliced into the layout) and
+    # the optional plain-text part. `key` is a hash of the sources it was
+    # compiled from (see render_cache.content_key), plans without one are
+    # never cached.
+
+    def __init__(self, subject, html, text=None, key=None):
+        self.subject = subject
+        self.html = html
+        self.text = text
+        self.key = key
+
+    @property
+    def variables(self):
+        variables = self.subject.variables | self.html.variables
+        if self.text is not None:
+            variables |= self.text.variables
+        return variables
+
+    @property
+    def is_personalized(self):
+        return bool(self.variables)
+
+    def render(self, variables):
+        return RenderedMessage(
+            self.subject.render(variables),
+            self.html.render(variables),
+            self.text.render(variables) if self.text is not None else None,
+        )
+
+
+@lru_cache(maxsize=32)
+def compile_layout(layout):
+    # Layouts (see layouts.py) only have {greeting} and {content} slots
+    return compile_placeholders(layout, {'{greeting}': 'greeting', '{content}': 'content'})
@@ -0,0 +1,249 @@
+import asyncio
+import itertools
+import os
+import socket
+import threading
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+from .async_smtp import AsyncSMTPPool
+from .settings import data_path
+from .smtp_pool import SMTPPool, SMTP_HOST, SMTP_PORT, SECURITY_STARTTLS, SECURITY_NONE
+
+# Which backend the apps send through:
+#   KUKI_MAIL_TRANSPORT=smtp     SMTP_HOST / SMTP_PORT / SMTP_SECURITY (starttls, ssl, none) / SMTP_LOGIN
+#   KUKI_MAIL_TRANSPORT=sink     in-process SMTP server that discards everything (KUKI_MAIL_SINK_PORT)
+#   KUKI_MAIL_TRANSPORT=maildir  one file per message under KUKI_MAIL_MAILDIR
+#   KUKI_MAIL_TRANSPORT=null     drop messages without any I/O
+# Every transport hands out SMTPPool-compatible pools, so the send engine
+# and the apps don't care which one is configured, and async_pool()s for
+# send_engine.AsyncSendEngine: asyncio SMTP clients for smtp and sink, the
+# blocking sessions on the loop's executor for the others.
+TRANSPORT_ENV = 'KUKI_MAIL_TRANSPORT'
+DEFAULT_TRANSPORT = 'smtp'
+
+
+class SMTPTransport:
+    name = 'smtp'
+
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, security=SECURITY_STARTTLS, login=True, timeout=30):
+        self.host = host
+        self.port = port
+        self.security = security
+        self.login = login
+        self.timeout = timeout
+
+    def describe(self):
+        return f"{self.host}:{self.port}"
+
+    def pool(self, sender_email, sender_password, size=1):
+        return SMTPPool(sender_email, sender_password, size=size, host=self.host, port=self.port,
+                        security=self.security, login=self.login, timeout=self.timeout)
+
+    def async_pool(self, sender_email, sender_password, size=1):
+        return AsyncSMTPPool(sender_email, sender_password, size=size, host=self.host, port=self.port,
+                             security=self.security, login=self.login, timeout=self.timeout)
+
+    def close(self):
+        pass
+
+
+class SinkTransport:
+    # Real SMTP over loopback against smtp_sink.SMTPSink, started on first use
+    name = 'sink'
+
+    def __init__(self, sink=None, **sink_options):
+        self.sink = sink
+        self.sink_options = sink_options
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self.sink is None:
+                from .smtp_sink import SMTPSink
+                self.sink = SMTPSink(**self.sink_options).start()
+        return self.sink
+
+    def describe(self):
+        sink = self.start()
+        return f"local SMTP sink on {sink.host}:{sink.port}"
+
+    def pool(self, sender_email, sender_password, size=1):
+        sink = self.start()
+        return SMTPPool(sender_email, sender_password, size=size, host=sink.host, port=sink.port,
+                        security=SECURITY_NONE, login=False)
+
+    def async_pool(self, sender_email, sender_password, size=1):
+        sink = self.start()
+        return AsyncSMTPPool(sender_email, sender_password, size=size, host=sink.host, port=sink.port,
+                             security=SECURITY_NONE, login=False)
+
+    def close(self):
+        with self._lock:
+            if self.sink is not None:
+                self.sink.stop()
+                self.sink = None
+
+
+def _unstuff(segment):
+    # Wire segments are dot-stuffed for DATA; files get the message as written.
+    # Only text parts can contain stuffed lines, and never at their start.
+    if segment.find(b'\r\n..') == -1:
+        return segment
+    return bytes(segment).replace(b'\r\n..', b'\r\n.')
+
+
+class MaildirSession:
+    # Delivers into a Maildir (tmp/ then rename into new/), one file per
+    # message with the envelope in Return-Path / X-Envelope-To headers
+    _counter = itertools.count()
+
+    def __init__(self, sender_email, sender_password, path):
+        self.path = Path(path)
+        for folder in ('tmp', 'new', 'cur'):
+            (self.path / folder).mkdir(parents=True, exist_ok=True)
+        self.hostname = socket.gethostname().replace('/', '_').replace(':', '_')
+        self.messages_sent = 0
+
+    def send_wire(self, from_addr, to_addrs, message):
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+        name = f"{time.time():.6f}.P{os.getpid()}Q{next(self._counter)}.{self.hostname}"
+        envelope = f"Return-Path: <{from_addr}>\r\nX-Envelope-To: {', '.join(to_addrs)}\r\n"
+        tmp_path = self.path / 'tmp' / name
+        with open(tmp_path, 'wb') as f:
+            f.write(envelope.encode('utf-8'))
+            for segment in message.segments:
+                f.write(_unstuff(segment))
+        os.replace(tmp_path, self.path / 'new' / name)
+        self.messages_sent += 1
+        return {}
+
+    def close(self):
+        pass
+
+
+class MaildirTransport:
+    name = 'maildir'
+
+    def __init__(self, path=None):
+        self.path = Path(path) if path else data_path('maildir')
+
+    def describe(self):
+        return f"Maildir {self.path}"
+
+    def pool(self, sender_email, sender_password, size=1):
+        return SMTPPool(sender_email, sender_password, size=size, session_class=MaildirSession, path=self.path)
+
+    def async_pool(self, sender_email, sender_password, size=1):
+        return ThreadedAsyncPool(self.pool(sender_email, sender_password, size))
+
+    def close(self):
+        pass
+
+
+class NullSession:
+    def __init__(self, sender_email, sender_password):
+        self.messages_sent = 0
+
+    def send_wire(self, from_addr, to_addrs, message):
+        self.messages_sent += 1
+        return {}
+
+    def close(self):
+        pass
+
+
+class NullTransport:
+    # Measures everything up to the wire: rendering, building, the engine
+    name = 'null'
+
+    def describe(self):
+        return "null transport (messages are dropped)"
+
+    def pool(self, sender_email, sender_password, size=1):
+        return SMTPPool(sender_email, sender_password, size=size, session_class=NullSession)
+
+    def async_pool(self, sender_email, sender_password, size=1):
+        return ThreadedAsyncPool(self.pool(sender_email, sender_password, size))
+
+    def close(self):
+        pass
+
+
+class _ThreadedSession:
+    def __init__(self, session):
+        self.session = session
+
+    async def send_wire(self, from_addr, to_addrs, message):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.session.send_wire, from_addr, to_addrs, message)
+
+
+class ThreadedAsyncPool:
+    # The async_pool() interface over a blocking pool, for transports with
+    # nothing to wait on but the disk (maildir) or nothing at all (null):
+    # sends run on the event loop's default executor
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.size = pool.size
+
+    @asynccontextmanager
+    async def session(self):
+        loop = asyncio.get_running_loop()
+        session = await loop.run_in_executor(None, self.pool.acquire)
+        try:
+            yield _ThreadedSession(session)
+        finally:
+            self.pool.release(session)
+
+    async def send_wire(self, from_addr, to_addrs, message):
+        async with self.session() as session:
+            return await session.send_wire(from_addr, to_addrs, message)
+
+    async def close(self):
+        self.pool.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+def _flag(value):
+    return str(value).strip().lower() not in ('0', 'false', 'no', 'off', '')
+
+
+def transport_from_env(environ=None):
+    environ = os.environ if environ is None else environ
+    kind = environ.get(TRANSPORT_ENV, DEFAULT_TRANSPORT).strip().lower()
+    if kind == 'smtp':
+        return SMTPTransport(
+            host=environ.get('SMTP_HOST', SMTP_HOST),
+            port=int(environ.get('SMTP_PORT', SMTP_PORT)),
+            security=environ.get('SMTP_SECURITY', SECURITY_STARTTLS).strip().lower(),
+            login=_flag(environ.get('SMTP_LOGIN', '1')),
+        )
+    if kind == 'sink':
+        return SinkTransport(port=int(environ.get('KUKI_MAIL_SINK_PORT', 0)))
+    if kind == 'maildir':
+        return MaildirTransport(environ.get('KUKI_MAIL_MAILDIR'))
+    if kind == 'null':
+        return NullTransport()
+    raise ValueError(f"Unknown {TRANSPORT_ENV} {kind!r}, expected smtp, sink, maildir or null")
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport():
+    # One configured transport per process, so Streamlit reruns share the sink
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = transport_from_env()
+        return _transport
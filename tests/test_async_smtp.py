@@ -0,0 +1,148 @@
+# The asyncio SMTP client against the in-process SMTP sink: EHLO, AUTH,
+# PIPELINING on and off, refusals, SIZE, 8BITMIME, reconnects and STARTTLS
+# (with a throwaway self-signed certificate, skipped without the openssl CLI).
+#
+#   python -m pytest tests/test_async_smtp.py
+import asyncio
+import shutil
+import smtplib
+import ssl
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from kuki_mail.async_smtp import AsyncSMTP, AsyncSMTPPool, AsyncSMTPSession
+from kuki_mail.metrics import metrics
+from kuki_mail.mime_builder import MessageBuilder, WireMessage
+from kuki_mail.smtp_pool import SECURITY_NONE, SECURITY_STARTTLS
+from kuki_mail.smtp_sink import SMTPSink, MAX_MESSAGE_SIZE
+
+SENDER = "test@example.com"
+MESSAGE = MessageBuilder(SENDER).build("someone@example.com", "Check", "<p>Hello</p>", "Hello")
+
+
+@pytest.fixture(scope="module")
+def sink():
+    with SMTPSink() as sink:
+        yield sink
+
+
+@pytest.fixture(scope="module")
+def tls_sink(tmp_path_factory):
+    if shutil.which("openssl") is None:
+        pytest.skip("no openssl CLI to make a certificate with")
+    folder = tmp_path_factory.mktemp("tls")
+    cert, key = folder / "cert.pem", folder / "key.pem"
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-subj", "/CN=127.0.0.1", "-addext", "subjectAltName=IP:127.0.0.1",
+                    "-keyout", str(key), "-out", str(cert)], check=True, capture_output=True)
+    server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    server_context.load_cert_chain(cert, key)
+    with SMTPSink(tls_context=server_context) as sink:
+        sink.cafile = cert
+        yield sink
+
+
+def run_client(sink, transaction, pipelining=True):
+    # Runs transaction(client) on a fresh connection to the sink
+    async def run():
+        client = AsyncSMTP(sink.host, sink.port, SECURITY_NONE, timeout=10)
+        await client.connect()
+        if not pipelining:
+            del client.extensions['pipelining']
+        try:
+            return await transaction(client)
+        finally:
+            await client.quit()
+    return asyncio.run(run())
+
+
+def test_ehlo_extensions(sink):
+    async def extensions(client):
+        return set(client.extensions)
+    assert {'pipelining', 'size', '8bitmime', 'auth'} <= run_client(sink, extensions)
+
+
+@pytest.mark.parametrize("mechanism", [None, "PLAIN", "LOGIN"])
+def test_auth(sink, mechanism):
+    async def login(client):
+        return await client.login("user", "secret", mechanism=mechanism)
+    assert run_client(sink, login)[0] == 235
+
+
+@pytest.mark.parametrize("pipelining", [True, False])
+def test_one_recipient_refused(sink, pipelining):
+    async def send(client):
+        return await client.send_wire(SENDER, ["a@example.com", "refuse@example.com", "b@example.com"], MESSAGE)
+    before = sink.stats.messages
+    refused = run_client(sink, send, pipelining)
+    assert list(refused) == ["refuse@example.com"]
+    assert refused["refuse@example.com"][0] == 550
+    assert sink.stats.messages == before + 1
+    mail_from, rcpt_to, data = sink.messages[-1]
+    assert rcpt_to == [b"<a@example.com>", b"<b@example.com>"]
+    assert data == b"".join(MESSAGE.segments) + b".\r\n"
+
+
+@pytest.mark.parametrize("pipelining", [True, False])
+def test_every_recipient_refused(sink, pipelining):
+    async def send(client):
+        with pytest.raises(smtplib.SMTPRecipientsRefused) as refused:
+            await client.send_wire(SENDER, ["refuse@example.com", "refuse2@example.com"], MESSAGE)
+        # The connection is still usable after the reset
+        assert await client.send_wire(SENDER, "a@example.com", MESSAGE) == {}
+        return refused.value.recipients
+    before = sink.stats.messages
+    recipients = run_client(sink, send, pipelining)
+    assert sorted(recipients) == ["refuse2@example.com", "refuse@example.com"]
+    assert sink.stats.messages == before + 1
+
+
+def test_size_over_limit(sink):
+    async def send(client):
+        with pytest.raises(smtplib.SMTPSenderRefused) as refused:
+            await client.send_wire(SENDER, "a@example.com", WireMessage([b"x\r\n"], MAX_MESSAGE_SIZE + 1))
+        return refused.value.smtp_code
+    assert run_client(sink, send) == 552
+
+
+def test_eight_bit(sink):
+    async def send(client):
+        return await client.send_wire(SENDER, "a@example.com", MESSAGE, eight_bit=True)
+    assert run_client(sink, send) == {}
+
+
+def test_session_reconnects_after_the_server_drops(sink):
+    async def run():
+        session = AsyncSMTPSession(SENDER, "secret", host=sink.host, port=sink.port, security=SECURITY_NONE)
+        try:
+            await session.send_wire(SENDER, "a@example.com", MESSAGE)
+            # QUIT behind the session's back, the sink hangs up
+            await session.client.command('QUIT')
+            await session.send_wire(SENDER, "b@example.com", MESSAGE)
+        finally:
+            await session.close()
+    connections, messages = sink.stats.connections, sink.stats.messages
+    reconnects = metrics.snapshot()['counters'].get('reconnects', 0)
+    asyncio.run(run())
+    assert sink.stats.connections == connections + 2
+    assert sink.stats.messages == messages + 2
+    assert metrics.snapshot()['counters'].get('reconnects', 0) == reconnects + 1
+
+
+def test_starttls_pool(tls_sink):
+    context = ssl.create_default_context(cafile=str(tls_sink.cafile))
+
+    async def run():
+        async with AsyncSMTPPool(SENDER, "secret", size=2, host=tls_sink.host, port=tls_sink.port,
+                                 security=SECURITY_STARTTLS, tls_context=context) as pool:
+            await asyncio.gather(*(pool.send_wire(SENDER, f"tls{i}@example.com", MESSAGE) for i in range(4)))
+            return all(session.client.writer.get_extra_info('ssl_object') is not None
+                       for session in pool._sessions)
+    assert asyncio.run(run())
+    assert tls_sink.stats.messages == 4
+    assert tls_sink.stats.connections == 2
@@ -0,0 +1,38 @@
+# Eviction from the attachment cache against messages still holding the
+# encoded bodies.
+#
+#   python -m pytest tests/test_attachments.py
+import gc
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from kuki_mail.attachments import AttachmentCache
+from kuki_mail.mime_builder import MessageBuilder
+
+
+def test_evicted_spilled_body_stays_valid_while_a_builder_holds_it():
+    cache = AttachmentCache(spill_threshold=1000, max_spilled=1)
+    first = cache.get(os.urandom(9000), "first.bin")
+    assert first.spilled
+    builder = MessageBuilder("me@example.com", [first])
+    expected = bytes(first.body)
+    del first
+
+    second = cache.get(os.urandom(9000), "second.bin")
+    assert cache.spilled_count == 1 and second.spilled
+    message = builder.build("you@example.com", "Report", "<p>Attached</p>")
+    assert expected in b"".join(bytes(segment) for segment in message.segments)
+
+
+def test_evicted_spilled_body_is_released_with_its_last_holder():
+    cache = AttachmentCache(spill_threshold=1000, max_spilled=1)
+    first = cache.get(os.urandom(9000), "first.bin")
+    spill_file = first._spill_file
+    cache.get(os.urandom(9000), "second.bin")
+    assert not spill_file.closed
+    del first
+    gc.collect()
+    assert spill_file.closed